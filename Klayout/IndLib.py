@@ -1,5 +1,55 @@
 import pya
 import math
+import os
+import sys
+
+# L, Q and SRF in the display text of the inductors, see IndMetrics.py
+try:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+except NameError:
+    pass
+try:
+    import IndMetrics
+except ImportError:
+    IndMetrics = None
+
+# cache key of a PCell: its class and parameters
+def metrics_key(pcell):
+    return (type(pcell).__name__,) + tuple(str(getattr(pcell, p.name))
+        for p in pcell.get_parameters() if p.name != "metrics")
+
+# solved metrics if known, the estimate otherwise
+def metrics_text(pcell):
+    if IndMetrics is None or not pcell.metrics:
+        return ""
+    return IndMetrics.format_metrics(IndMetrics.service.lookup(
+        metrics_key(pcell), pcell.metrics_geometry()))
+
+# solve the produced cell in the background if it is not known yet
+def request_metrics(pcell):
+    if IndMetrics is None or not pcell.metrics:
+        return
+    geometry = pcell.metrics_geometry()
+    try:
+        IndMetrics.service.request(metrics_key(pcell), geometry,
+            lambda file_name: IndMetrics.write_solve_layout(pcell.cell,
+                pcell.l.layer, geometry["feeds"], pcell.w, file_name))
+    except Exception as e:
+        # the metrics are optional, the PCell itself is fine
+        print("IndLib: no metrics, " + str(e))
+
+# redraw when solves have finished, so the new display texts are shown
+def refresh_metrics():
+    if IndMetrics.service.poll():
+        view = pya.Application.instance().main_window().current_view()
+        if view is not None:
+            view.update_content()
+
+# the geometry of a PCell as IndMetrics.estimate expects it
+def pcell_geometry(pcell, s):
+    return IndMetrics.pcell_geometry(type(pcell).__name__, {"r":pcell.r,
+        "w":pcell.w, "s":s, "f":pcell.f, "ct":getattr(pcell, "ct", False),
+        "layer":pcell.l.layer})
 
 class PGS(pya.PCellDeclarationHelper):
     def __init__(self):
@@ -7,6 +57,7 @@ class PGS(pya.PCellDeclarationHelper):
 
         self.param("l", self.TypeLayer, "Layer", default = pya.LayerInfo(68, 20))
         self.param("r", self.TypeDouble, "radius", default = 100)
+        self.param("merge", self.TypeBoolean, "merge touching fingers", default = False)
         
 
     def display_text_impl(self):
@@ -28,83 +79,32 @@ class PGS(pya.PCellDeclarationHelper):
         
         n_arms = math.floor(r/(w+s))
         
-        pts = []
-        pts.append(pya.Point.from_dpoint(pya.DPoint(-w/2,-w/2)))
-        pts.append(pya.Point.from_dpoint(pya.DPoint( w/2,-w/2)))
-        pts.append(pya.Point.from_dpoint(pya.DPoint( w/2, w/2)))
-        pts.append(pya.Point.from_dpoint(pya.DPoint(-w/2, w/2)))
-            
-        self.cell.shapes(self.l_layer).insert(pya.Polygon(pts))
-            
-        
-        for i in range(n_arms):
+        # all fingers are rectangles, (left, bottom, right, top) in database
+        # units; center square first, then 8 fingers per arm
+        boxes = [(-w/2, -w/2, w/2, w/2)]
+        for o in [(w+s)*i for i in range(n_arms)]:
+            boxes += [
             # top right
-            pts = []
-            pts.append(pya.Point.from_dpoint(pya.DPoint( -w/2+(w+s)*i, w/2+(w+s)*i)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint(  w/2+(w+s)*i, w/2+(w+s)*i)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint(  w/2+(w+s)*i, r)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint( -w/2+(w+s)*i, r)))
-            
-            self.cell.shapes(self.l_layer).insert(pya.Polygon(pts))
-            
-            pts = []
-            pts.append(pya.Point.from_dpoint(pya.DPoint( w/2+(w+s)*i, 2.5*w + (w+s)*i)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint( w/2+(w+s)*i, 1.5*w + (w+s)*i)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint( r          , 1.5*w + (w+s)*i)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint( r          , 2.5*w + (w+s)*i)))
-            
-            self.cell.shapes(self.l_layer).insert(pya.Polygon(pts))
-            
+            ( -w/2+o,   w/2+o,    w/2+o,  r        ),
+            (  w/2+o,   1.5*w+o,  r,      2.5*w+o  ),
             # bottom right
-            pts = []
-            pts.append(pya.Point.from_dpoint(pya.DPoint( w/2+(w+s)*i, -w/2-(w+s)*i)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint( w/2+(w+s)*i,  w/2-(w+s)*i)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint( r          ,  w/2-(w+s)*i)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint( r          , -w/2-(w+s)*i)))
-            
-            self.cell.shapes(self.l_layer).insert(pya.Polygon(pts))
-            
-            pts = []
-            pts.append(pya.Point.from_dpoint(pya.DPoint( 2.5*w + (w+s)*i, -w/2-(w+s)*i)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint( 1.5*w + (w+s)*i, -w/2-(w+s)*i)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint( 1.5*w + (w+s)*i, -r)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint( 2.5*w + (w+s)*i, -r)))
-            
-            self.cell.shapes(self.l_layer).insert(pya.Polygon(pts))
-            
+            (  w/2+o,  -w/2-o,    r,      w/2-o    ),
+            (  1.5*w+o, -r,       2.5*w+o, -w/2-o  ),
             # bottom left
-            pts = []
-            pts.append(pya.Point.from_dpoint(pya.DPoint( -w/2-(w+s)*i, -w/2-(w+s)*i)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint(  w/2-(w+s)*i, -w/2-(w+s)*i)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint(  w/2-(w+s)*i, -r)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint( -w/2-(w+s)*i, -r)))
-            
-            self.cell.shapes(self.l_layer).insert(pya.Polygon(pts))
-            
-            pts = []
-            pts.append(pya.Point.from_dpoint(pya.DPoint( -w/2-(w+s)*i, -2.5*w - (w+s)*i)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint( -w/2-(w+s)*i, -1.5*w - (w+s)*i)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint( -r          , -1.5*w - (w+s)*i)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint( -r          , -2.5*w - (w+s)*i)))
-            
-            self.cell.shapes(self.l_layer).insert(pya.Polygon(pts))
-            
+            ( -w/2-o,  -r,        w/2-o,  -w/2-o   ),
+            ( -r,      -2.5*w-o, -w/2-o,  -1.5*w-o ),
             # top left
-            pts = []
-            pts.append(pya.Point.from_dpoint(pya.DPoint( -1.5*w-(w+s)*i, w/2+(w+s)*i)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint( -2.5*w-(w+s)*i, w/2+(w+s)*i)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint( -2.5*w-(w+s)*i, r)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint( -1.5*w-(w+s)*i, r)))
-            
-            self.cell.shapes(self.l_layer).insert(pya.Polygon(pts))
-            
-            pts = []
-            pts.append(pya.Point.from_dpoint(pya.DPoint( -0.5*w-(w+s)*i, -0.5*w + (w+s)*i)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint( -0.5*w-(w+s)*i,  0.5*w + (w+s)*i)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint( -r          ,  0.5*w + (w+s)*i)))
-            pts.append(pya.Point.from_dpoint(pya.DPoint( -r          , -0.5*w + (w+s)*i)))
-            
-            self.cell.shapes(self.l_layer).insert(pya.Polygon(pts))
+            ( -2.5*w-o, w/2+o,   -1.5*w-o, r       ),
+            ( -r,      -0.5*w+o, -0.5*w-o, 0.5*w+o )
+            ]
+        
+        # one region, inserted at once instead of a polygon per finger
+        region = pya.Region()
+        for box in boxes:
+            region.insert(pya.Box(pya.DBox(*box)))
+        if self.merge:
+            region.merge()
+        self.cell.shapes(self.l_layer).insert(region)
 
 class Oct_inductor(pya.PCellDeclarationHelper):
     def __init__(self):
@@ -114,9 +114,13 @@ class Oct_inductor(pya.PCellDeclarationHelper):
         self.param("r", self.TypeInt, "Radius", default = 100)
         self.param("s", self.TypeDouble, "Line separation", default = 15)
         self.param("f", self.TypeDouble, "Feed length", default = 15)
+        self.param("metrics", self.TypeBoolean, "show L, Q and SRF", default = True)
 
     def display_text_impl(self):
-        return "octogonal inductor(N=1,R=" + ('%.1f' % self.r) + ",W=" + ('%.1f' % self.w) + ")"
+        return "octogonal inductor(N=1,R=" + ('%.1f' % self.r) + ",W=" + ('%.1f' % self.w) + ")" + metrics_text(self)
+  
+    def metrics_geometry(self):
+        return pcell_geometry(self, self.s)
   
     def can_create_from_shape_impl(self):
         return self.shape.is_box() or self.shape.is_polygon() or self.shape.is_path()
@@ -148,6 +152,7 @@ class Oct_inductor(pya.PCellDeclarationHelper):
         
         # create the shape
         self.cell.shapes(self.l_layer).insert(pya.Path(pts, self.w/gr))
+        request_metrics(self)
 
 
 class Square_inductor(pya.PCellDeclarationHelper):
@@ -162,9 +167,13 @@ class Square_inductor(pya.PCellDeclarationHelper):
         self.param("d", self.TypeDouble, "Line separation", default = 10)
         self.param("f", self.TypeDouble, "feed length", default = 10)
         self.param("ct", self.TypeBoolean, "center tap", default = False)
+        self.param("metrics", self.TypeBoolean, "show L, Q and SRF", default = True)
 
     def display_text_impl(self):
-        return "inductor(R=" + ('%.1f' % self.r) + ",w=" + ('%.1f' % self.w) + ",d=" + ('%.1f' % self.d) + ")"
+        return "inductor(R=" + ('%.1f' % self.r) + ",w=" + ('%.1f' % self.w) + ",d=" + ('%.1f' % self.d) + ")" + metrics_text(self)
+  
+    def metrics_geometry(self):
+        return pcell_geometry(self, self.d)
   
     def can_create_from_shape_impl(self):
         return self.shape.is_box() or self.shape.is_polygon() or self.shape.is_path()
@@ -198,6 +207,7 @@ class Square_inductor(pya.PCellDeclarationHelper):
         
     # create the shape
         self.cell.shapes(self.l_layer).insert(pya.Path(path_nodes, self.w/gr))
+        request_metrics(self)
 
 
         
@@ -213,9 +223,13 @@ class Oct_double_inductor(pya.PCellDeclarationHelper):
         self.param("s", self.TypeDouble, "Line separation", default = 5)
         self.param("f", self.TypeDouble, "Feed length", default = 5)
         self.param("ct", self.TypeBoolean, "center tap", default = False)
+        self.param("metrics", self.TypeBoolean, "show L, Q and SRF", default = True)
         
     def display_text_impl(self):
-        return "octogonal inductor(N=2,R=" + ('%.1f' % self.r) + ",W=" + ('%.1f' % self.w) + ")"
+        return "octogonal inductor(N=2,R=" + ('%.1f' % self.r) + ",W=" + ('%.1f' % self.w) + ")" + metrics_text(self)
+        
+    def metrics_geometry(self):
+        return pcell_geometry(self, self.s)
         
     def can_create_from_shape_impl(self):
         return self.shape.is_box() or self.shape.is_polygon() or self.shape.is_path()
@@ -300,23 +314,26 @@ class Oct_double_inductor(pya.PCellDeclarationHelper):
         exc_y = w - (2*n_y-1)*via_w - 2*via_d
         exc_x = (ri*c_a-c_c-w/2-s) - (2*n_x-1)*via_w - 2*via_d
         
-        for i in range(n_y):
-            for j in range(n_x):
-                pts = []
-                pts.append(pya.Point.from_dpoint(pya.DPoint( w+s + via_d + via_s*j + exc_x/2          ,r-via_d-via_s*i-exc_y/2 + w/2)))
-                pts.append(pya.Point.from_dpoint(pya.DPoint( w+s + via_d + via_s*j + exc_x/2          ,r-via_d-via_w-via_s*i-exc_y/2 + w/2)))
-                pts.append(pya.Point.from_dpoint(pya.DPoint( w+s + via_d + via_s*j + exc_x/2 + via_w  ,r-via_d-via_w-via_s*i-exc_y/2 + w/2)))
-                pts.append(pya.Point.from_dpoint(pya.DPoint( w+s + via_d + via_s*j + exc_x/2 + via_w  ,r-via_d-via_s*i-exc_y/2 + w/2)))
+        # one via cell placed as an n_x by n_y array per via farm, instead
+        # of n_x*n_y separate polygons; the converters see each array as one
+        # via cluster without looking at the pillars one by one
+        via_name = "VIA_" + str(l_via.layer) + "_" + str(l_via.datatype)
+        if self.layout.has_cell(via_name):
+            via_cell = self.layout.cell_by_name(via_name)
+        else:
+            via_cell = self.layout.add_cell(via_name)
+            self.layout.cell(via_cell).shapes(self.layout.layer(l_via)).insert(
+                pya.Box(0, 0, round(via_w), round(via_w)))
         
-                self.cell.shapes(self.layout.layer(l_via)).insert(pya.Polygon(pts))
-                
-                pts = []
-                pts.append(pya.Point.from_dpoint(pya.DPoint( -w-s - via_d - via_s*j - exc_x/2          ,ri-via_d-via_s*i-exc_y/2 + w/2)))
-                pts.append(pya.Point.from_dpoint(pya.DPoint( -w-s - via_d - via_s*j - exc_x/2          ,ri-via_d-via_w-via_s*i-exc_y/2 + w/2)))
-                pts.append(pya.Point.from_dpoint(pya.DPoint( -w-s - via_d - via_s*j - exc_x/2 - via_w  ,ri-via_d-via_w-via_s*i-exc_y/2 + w/2)))
-                pts.append(pya.Point.from_dpoint(pya.DPoint( -w-s - via_d - via_s*j - exc_x/2 - via_w  ,ri-via_d-via_s*i-exc_y/2 + w/2)))
+        # bottom left corner of the first via of each farm, the arrays step
+        # away from the center in x and down in y
+        origin = pya.Point.from_dpoint(pya.DPoint( w+s + via_d + exc_x/2, r-via_d-via_w-exc_y/2 + w/2))
+        self.cell.insert(pya.CellInstArray(via_cell, pya.Trans(origin),
+            pya.Vector(round(via_s), 0), pya.Vector(0, -round(via_s)), n_x, n_y))
         
-                self.cell.shapes(self.layout.layer(l_via)).insert(pya.Polygon(pts))
+        origin = pya.Point.from_dpoint(pya.DPoint( -w-s - via_d - exc_x/2 - via_w, ri-via_d-via_w-exc_y/2 + w/2))
+        self.cell.insert(pya.CellInstArray(via_cell, pya.Trans(origin),
+            pya.Vector(-round(via_s), 0), pya.Vector(0, -round(via_s)), n_x, n_y))
         
         # underpass
         pts = []
@@ -326,6 +343,7 @@ class Oct_double_inductor(pya.PCellDeclarationHelper):
         pts.append(pya.Point.from_dpoint(pya.DPoint( ri*c_a+via_s, r )))
         
         self.cell.shapes(self.layout.layer(l_under)).insert(pya.Path(pts, w))
+        request_metrics(self)
 
 class IndLib(pya.Library):
 
@@ -344,3 +362,10 @@ class IndLib(pya.Library):
 
 # Instantiate and register the library
 IndLib()
+
+# poll for finished solves, only if KLayout has the Qt bindings
+if IndMetrics is not None and hasattr(pya, "QTimer"):
+    metrics_timer = pya.QTimer()
+    metrics_timer.interval = 500
+    metrics_timer.timeout = refresh_metrics
+    metrics_timer.start()
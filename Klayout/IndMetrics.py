@@ -0,0 +1,267 @@
+# Copyright 2023 J.N.G.W. Verest
+# j.n.g.w.verest@tue.nl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Inductance, quality factor and self resonance of the IndLib PCells
+# A solver run takes seconds to minutes, far too long for produce_impl or
+# display_text_impl, which run in the UI thread of KLayout. MetricsService
+# answers immediately with the solved metrics of a parameter set if they are
+# known, otherwise with a closed form estimate, and solves the layout in a
+# background thread (converters/fastsolve.py in a separate Python process).
+# Solved metrics are kept in an LRU cache keyed by the PCell parameters, so
+# going back to an earlier design shows its metrics at once.
+
+# CAVEATS:
+#   The estimate is the current sheet approximation of the inductance [1]
+#   with a skin effect corrected series resistance and the plate capacitance
+#   to the substrate; it is shown with "~" instead of "=" in the display
+#   text. KLayout shows the solved values once it asks for the display text
+#   again, IndLib triggers a redraw when a solve has finished.
+#   The solve uses the Python found as INDLIB_PYTHON (python3 by default),
+#   which needs numpy and gdspy, and the converters next to this directory
+#   or in INDLIB_CONVERTERS. A failed solve keeps the estimate.
+#   Only pure Python is used here, KLayout's own Python may lack numpy.
+
+# File history:
+# Initial version
+
+
+import os
+import sys
+import json
+import math
+import queue
+import tempfile
+import threading
+import subprocess
+from collections import OrderedDict
+
+converters_dir = os.environ.get("INDLIB_CONVERTERS",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "converters"))
+if converters_dir not in sys.path:
+    sys.path.append(converters_dir)
+
+from sky130_stack import layer_resistivities, layer_heights, stack_bottom
+
+
+
+# metrics settings
+settings = {
+"python":os.environ.get("INDLIB_PYTHON", "python3"),
+"frequency":10e9,   # frequency of L and Q in Hz, the VCO frequency
+"cache_size":64,    # number of solved parameter sets kept
+"timeout":900       # seconds per solve
+}
+
+mu_0 = 4e-7*math.pi
+eps_0 = 8.854e-12
+eps_r = 3.9
+
+# current sheet coefficients c1..c4 per shape [1]
+current_sheet = {
+"square":(1.27, 2.07, 0.18, 0.13),
+"octagon":(1.07, 2.29, 0.00, 0.19)
+}
+
+
+# ============= geometry ===============
+
+# octagon corners as drawn by IndLib, (1, c_a), (c_a, 1), ... times the radius
+def octagon_length(r):
+    c_a = 1/(1+1/math.sqrt(2))
+    return r*(8*c_a + 4*math.sqrt(2)*(1-c_a))
+
+# geometry for estimate() of an IndLib inductor PCell, by class name, with
+# the parameters r, w, s (d of Square_inductor), f, ct and layer in um
+def pcell_geometry(name, p):
+    r, w, s, f = p["r"], p["w"], p["s"], p["f"]
+    ct = int(bool(p.get("ct", False)))
+    if name == "Oct_inductor":
+        return {"shape":"octagon", "turns":1, "d_out":2*r+w, "d_in":2*r-w,
+            "w":w, "layer":p["layer"], "length":octagon_length(r) + 2*f,
+            "feeds":((s/2, -r-f), (-s/2, -r-f))}
+    if name == "Square_inductor":
+        x = s*(1+0.5*ct)
+        return {"shape":"square", "turns":1, "d_out":2*r+w, "d_in":2*r-w,
+            "w":w, "layer":p["layer"], "length":8*r + 2*f,
+            "feeds":((-x, -r-f), (x, -r-f))}
+    if name == "Oct_double_inductor":
+        ri = r-w-s
+        x = s+w*(1+ct)/2
+        return {"shape":"octagon", "turns":2, "d_out":2*r+w, "d_in":2*ri-w,
+            "w":w, "layer":p["layer"],
+            "length":octagon_length(r) + octagon_length(ri) + 2*f,
+            "feeds":((x, -r-f), (-x, -r-f))}
+    raise ValueError("unknown inductor PCell " + str(name))
+
+
+# ============= estimate ===============
+
+# closed form metrics of a spiral; geometry as returned by the PCells, all
+# lengths in um: shape, turns, d_out, d_in, w, length and layer
+def estimate(geometry, frequency=None):
+    if frequency is None:
+        frequency = settings["frequency"]
+    c1, c2, c3, c4 = current_sheet[geometry["shape"]]
+    d_avg = (geometry["d_out"] + geometry["d_in"])/2
+    fill = (geometry["d_out"] - geometry["d_in"])/(geometry["d_out"] + geometry["d_in"])
+    inductance = (mu_0*geometry["turns"]**2*d_avg*1e-6*c1/2
+        *(math.log(c2/fill) + c3*fill + c4*fill**2))
+
+    # series resistance with the current in one skin depth of the metal
+    layer = str(geometry["layer"])
+    rho = float(layer_resistivities[layer])*1e-6
+    t = float(layer_heights[layer])*1e-6
+    delta = math.sqrt(rho/(math.pi*frequency*mu_0))
+    t_eff = delta*(1 - math.exp(-t/delta))
+    length = geometry["length"]*1e-6
+    w = geometry["w"]*1e-6
+    resistance = rho*length/(w*t_eff)
+
+    # plate capacitance to the substrate, split over both ends as in
+    # fastsolve.capacitance_metrics
+    capacitance = eps_0*eps_r*length*w/(float(stack_bottom[layer])*1e-6)
+    return {
+        "frequency":frequency,
+        "L":inductance,
+        "R":resistance,
+        "Q":2*math.pi*frequency*inductance/resistance,
+        "C":capacitance,
+        "SRF":1/(2*math.pi*math.sqrt(inductance*capacitance/2))
+    }
+
+# short text for the display text of a PCell, "~" marks an estimated value,
+# "=" one in metrics["solved"]
+def format_metrics(metrics):
+    solved = metrics.get("solved", ())
+    text = ""
+    for name, scale, unit in (("L", 1e9, "nH"), ("Q", 1, ""), ("SRF", 1e-9, "GHz")):
+        if metrics.get(name) is not None:
+            text += (" " + name + ("=" if name in solved else "~")
+                + ('%.3g' % (metrics[name]*scale)) + unit)
+    return text
+
+
+# ============= solving ===============
+
+# metrics of a GDS file with ports, solved in a separate process
+def solve_gds(gds_file, frequency=None):
+    if frequency is None:
+        frequency = settings["frequency"]
+    output = subprocess.run([settings["python"],
+        os.path.join(converters_dir, "fastsolve.py"), gds_file, str(frequency)],
+        cwd=converters_dir, capture_output=True, text=True,
+        timeout=settings["timeout"], check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+# write a copy of a PCell cell with a port pair at the feeds, as expected by
+# the converters; feeds are two points in um, in the UI thread only
+def write_solve_layout(cell, layer, feeds, size, file_name):
+    import pya
+    layout = pya.Layout()
+    layout.dbu = cell.layout().dbu
+    target = layout.create_cell(cell.name)
+    target.copy_tree(cell)
+    pin = layout.layer(pya.LayerInfo(layer, 16))
+    label = layout.layer(pya.LayerInfo(layer, 5))
+    for (x, y), name in zip(feeds, ("port_1p", "port_1m")):
+        target.shapes(pin).insert(pya.DBox(x-size/2, y-size/2, x+size/2, y+size/2))
+        target.shapes(label).insert(pya.DText(name, x, y))
+    layout.write(file_name)
+
+
+# ============= background service ===============
+
+class MetricsService:
+    def __init__(self, solve=solve_gds, cache_size=None):
+        self.solve = solve
+        self.cache_size = cache_size or settings["cache_size"]
+        # parameter key -> metrics, most recently used last
+        self.cache = OrderedDict()
+        self.pending = set()
+        self.finished = []
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    # metrics of a parameter set, the estimate until it is solved
+    def lookup(self, key, geometry):
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        return estimate(geometry)
+
+    # queue a solve of a parameter set that is neither known nor queued;
+    # write_layout(file_name) writes the layout with ports and is called
+    # right away, in the thread of the caller
+    def request(self, key, geometry, write_layout):
+        with self.lock:
+            if key in self.cache or key in self.pending:
+                return
+            self.pending.add(key)
+        handle, file_name = tempfile.mkstemp(suffix=".gds", prefix="indlib_")
+        os.close(handle)
+        try:
+            write_layout(file_name)
+        except Exception:
+            os.remove(file_name)
+            with self.lock:
+                self.pending.discard(key)
+            raise
+        self.jobs.put((key, geometry, file_name))
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def store(self, key, value):
+        with self.lock:
+            self.cache[key] = value
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            self.pending.discard(key)
+            self.finished.append(key)
+
+    def run(self):
+        while True:
+            key, geometry, file_name = self.jobs.get()
+            metrics = estimate(geometry)
+            try:
+                solved = self.solve(file_name)
+                metrics.update(solved)
+                metrics["solved"] = sorted(solved)
+                if "SRF" not in solved:
+                    # solved inductance, estimated capacitance
+                    metrics["SRF"] = 1/(2*math.pi*math.sqrt(metrics["L"]*metrics["C"]/2))
+            except Exception as e:
+                # keep the estimate, do not try this parameter set again
+                metrics["error"] = type(e).__name__ + ": " + str(e)
+            finally:
+                os.remove(file_name)
+            self.store(key, metrics)
+
+    # keys solved since the last call, to refresh the view from the UI thread
+    def poll(self):
+        with self.lock:
+            finished = self.finished
+            self.finished = []
+        return finished
+
+# one service for all PCells
+service = MetricsService()
+
+
+# References:
+# [1]   S. S. Mohan, M. del Mar Hershenson, S. P. Boyd and T. H. Lee, "Simple accurate expressions for planar spiral inductances", IEEE JSSC 34(10), 1999.
@@ -0,0 +1,308 @@
+# Copyright 2023 J.N.G.W. Verest
+# j.n.g.w.verest@tue.nl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Design space search over the IndLib inductors
+# Finds the inductors with a target inductance at the VCO frequency, the
+# highest Q and a self resonance well above the band. All combinations of
+# radius, width, spacing, turns, center tap and layer are estimated with
+# IndMetrics.estimate, which takes microseconds; only those within a loose
+# tolerance of the target are kept. The best of them by estimated Q are
+# solved with FastHenry2 and FasterCap, several at a time, until a few
+# rounds of solves no longer improve the result. The result is the Pareto
+# front of inductance error, Q, SRF and area.
+
+# CAVEATS:
+#   The solves use the IndLib PCells themselves, so the layouts are exactly
+#   the ones placed in the editor; they need KLayout (the macro editor or
+#   "klayout -b"). Without pya only the estimates are ranked. N=1 is the 1
+#   turn octagon or square, N=2 the 2 turn octagon with its underpass on
+#   the layer below; the 1 turn octagon has no center tap. The area is the
+#   bounding box of the coil without the feeds.
+#
+#   Usage:
+#     klayout -b -r IndOptimize.py -rd target=1e-9
+#     python IndOptimize.py [target_L] (estimates only)
+#   prints the Pareto front, one design per line.
+
+# File history:
+# Initial version
+
+
+import os
+import sys
+import math
+import tempfile
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+except NameError:
+    pass
+import IndMetrics
+
+
+
+# default search options, lengths in um
+default_options = {
+"target":1e-9,            # inductance at the frequency in H
+"frequency":10e9,         # VCO frequency in Hz
+"tolerance":0.05,         # allowed relative error of the solved inductance
+"estimate_tolerance":0.3, # allowed relative error of the estimated inductance
+"srf_ratio":2.0,          # minimum SRF as multiple of the frequency
+"shapes":["octagon"],     # octagon and/or square
+"r":[30, 40, 50, 60, 80, 100, 125, 150],
+"w":[4, 6, 8, 10, 15, 20],
+"s":[2, 3, 5, 8, 15],     # turn spacing, the feed spacing of 1 turn coils
+"N":[1, 2],               # turns
+"ct":[False],             # center tap variants, [False, True] for both
+"layers":[71, 72],        # met4, met5
+"f":10,                   # feed length
+"min_gap":1.0,            # minimum spacing between feeds and taps
+"shortlist":16,           # estimated designs to solve at most
+"workers":4,              # parallel solves
+"patience":2,             # stop after this many rounds without improvement
+"verbose":True
+}
+
+# PCell class and registered name per shape and turns
+pcells = {
+("octagon", 1):("Oct_inductor", "1 turn Oct. Inductor"),
+("square", 1):("Square_inductor", "1 turn Sqr. Inductor"),
+("octagon", 2):("Oct_double_inductor", "2 turn Oct. Inductor")
+}
+
+
+# ============= design space ===============
+
+# True if a design can be drawn: feeds and center tap apart, an open inner
+# turn and room for at least one via next to the underpass
+def feasible(design, min_gap):
+    r, w, s, ct = design["r"], design["w"], design["s"], design["ct"]
+    if design["pcell"] == "Oct_inductor":
+        return s - w >= min_gap
+    if design["pcell"] == "Square_inductor":
+        x = s*(1+0.5*ct)
+        gap = x - w if ct else 2*x - w
+        return gap >= min_gap and 2*r - w > 2*x
+    c_a = 1/(1+1/math.sqrt(2))
+    c_b = math.sqrt(2 + math.sqrt(2))/2
+    ri = r-w-s
+    return (s >= min_gap and 2*ri - w > 0
+        and ri*c_a - w*c_b/2 - w/2 - s >= 0.8 + 2*0.36)
+
+# all drawable designs of the options, as parameter dicts
+def designs(opts):
+    found = []
+    for shape, turns, layer, r, w, s, ct in itertools.product(opts["shapes"],
+        opts["N"], opts["layers"], opts["r"], opts["w"], opts["s"], opts["ct"]):
+        if (shape, turns) not in pcells:
+            continue
+        pcell = pcells[(shape, turns)][0]
+        if ct and pcell == "Oct_inductor":
+            continue
+        design = {"pcell":pcell, "N":turns, "r":r, "w":w, "s":s,
+            "f":opts["f"], "ct":ct, "layer":layer}
+        if feasible(design, opts["min_gap"]):
+            found.append(design)
+    return found
+
+def area(design):
+    return (2*design["r"] + design["w"])**2
+
+# designs with the estimated inductance within estimate_tolerance of the
+# target and a high enough SRF, best estimated Q first
+def prune(candidates, opts):
+    kept = []
+    for design in candidates:
+        geometry = IndMetrics.pcell_geometry(design["pcell"], design)
+        metrics = IndMetrics.estimate(geometry, opts["frequency"])
+        if (abs(metrics["L"]/opts["target"] - 1) <= opts["estimate_tolerance"]
+            and metrics["SRF"] >= opts["srf_ratio"]*opts["frequency"]):
+            kept.append(point(design, metrics, opts))
+    kept.sort(key=lambda p: -p["Q"])
+    return kept
+
+# a design with its metrics, as put on the Pareto front
+def point(design, metrics, opts, solved=False):
+    return dict(design, L=metrics["L"], Q=metrics["Q"], SRF=metrics.get("SRF"),
+        C=metrics.get("C"), area=area(design),
+        error=abs(metrics["L"]/opts["target"] - 1), solved=solved)
+
+
+# ============= Pareto front ===============
+
+# objectives to minimize
+def objectives(p):
+    return (p["error"], -p["Q"], -(p["SRF"] or 0), p["area"])
+
+def dominates(a, b):
+    oa = objectives(a)
+    ob = objectives(b)
+    return all(x <= y for x, y in zip(oa, ob)) and oa != ob
+
+def pareto_front(points):
+    return [p for p in points if not any(dominates(q, p) for q in points)]
+
+
+# ============= solving ===============
+
+# write a design as placed by IndLib, with ports at its feeds, in the main
+# thread; needs KLayout, IndLib is registered here unless it already is
+def write_design(design, file_name):
+    import pya
+    if pya.Library.library_by_name("IndLib") is None:
+        import IndLib
+    layout = pya.Layout()
+    separation = "d" if design["pcell"] == "Square_inductor" else "s"
+    r = int(design["r"]) if design["pcell"] == "Oct_inductor" else design["r"]
+    parameters = {"l":pya.LayerInfo(design["layer"], 20), "r":r,
+        "w":design["w"], separation:design["s"], "f":design["f"],
+        "metrics":False}
+    if design["pcell"] != "Oct_inductor":
+        parameters["ct"] = design["ct"]
+    name = pcells[(("square" if design["pcell"] == "Square_inductor"
+        else "octagon"), design["N"])][1]
+    cell = layout.create_cell(name, "IndLib", parameters)
+    geometry = IndMetrics.pcell_geometry(design["pcell"], design)
+    IndMetrics.write_solve_layout(cell, design["layer"], geometry["feeds"],
+        design["w"], file_name)
+
+# solve designs in parallel: layouts written here, solves in threads each
+# running a solver process; returns metrics or None for failed solves
+def solve_designs(batch, opts):
+    files = []
+    for design in batch:
+        handle, file_name = tempfile.mkstemp(suffix=".gds", prefix="indopt_")
+        os.close(handle)
+        write_design(design, file_name)
+        files.append(file_name)
+
+    def solve(file_name):
+        try:
+            return IndMetrics.solve_gds(file_name, opts["frequency"])
+        except Exception as e:
+            if opts["verbose"]:
+                print("solve failed: " + type(e).__name__ + ": " + str(e))
+            return None
+        finally:
+            os.remove(file_name)
+
+    with ThreadPoolExecutor(max_workers=opts["workers"]) as executor:
+        return list(executor.map(solve, files))
+
+def can_solve():
+    try:
+        import pya
+    except ImportError:
+        return False
+    return True
+
+
+# ============= search ===============
+
+# solve the shortlist in rounds of "workers" designs; stops when "patience"
+# rounds added nothing to the front, or when no remaining design can beat
+# the best solved Q, even with the most optimistic ratio of solved to
+# estimated Q seen so far. solve(batch, opts) returns the metrics per design
+def confirm(shortlist, opts, solve=solve_designs):
+    solved = []
+    ratio = 0
+    best_q = 0
+    idle = 0
+    stopped = "shortlist solved"
+    for start in range(0, len(shortlist), opts["workers"]):
+        batch = shortlist[start:start+opts["workers"]]
+        front = pareto_front(solved)
+        added = False
+        for estimated, metrics in zip(batch, solve(batch, opts)):
+            if metrics is None or metrics.get("Q") is None:
+                continue
+            if "SRF" not in metrics:
+                # solved inductance, estimated capacitance
+                metrics = dict(metrics, SRF=1/(2*math.pi
+                    *math.sqrt(metrics["L"]*estimated["C"]/2)))
+            ratio = max(ratio, metrics["Q"]/estimated["Q"])
+            p = point(estimated, metrics, opts, solved=True)
+            p["estimate"] = {k: estimated[k] for k in ("L", "Q", "SRF")}
+            solved.append(p)
+            if (p["error"] <= opts["tolerance"]
+                and p["SRF"] >= opts["srf_ratio"]*opts["frequency"]):
+                best_q = max(best_q, p["Q"])
+                added = added or not any(dominates(q, p) for q in front)
+        if opts["verbose"]:
+            print("solved " + str(len(solved)) + " of " + str(len(shortlist))
+            + ", best Q " + ('%.3g' % best_q))
+
+        idle = 0 if added else idle + 1
+        remaining = shortlist[start+opts["workers"]:]
+        if remaining and idle >= opts["patience"]:
+            stopped = "no improvement in " + str(idle) + " rounds"
+            break
+        if remaining and best_q > 0 and remaining[0]["Q"]*ratio < best_q:
+            stopped = "remaining designs cannot beat Q " + ('%.3g' % best_q)
+            break
+    return solved, stopped
+
+# search the design space; returns the Pareto front of the designs meeting
+# the targets, solved ones if solving is possible, and search statistics
+def optimize(options=None, solve=None):
+    opts = dict(default_options)
+    if options:
+        opts.update(options)
+    candidates = designs(opts)
+    estimated = prune(candidates, opts)
+    shortlist = estimated[:opts["shortlist"]]
+    if opts["verbose"]:
+        print(str(len(candidates)) + " designs, " + str(len(estimated))
+        + " within the estimate tolerance")
+
+    if solve is None and can_solve():
+        solve = solve_designs
+    if solve is not None:
+        points, stopped = confirm(shortlist, opts, solve)
+        tolerance = opts["tolerance"]
+    else:
+        points, stopped = shortlist, "estimates only, no KLayout"
+        tolerance = opts["estimate_tolerance"]
+
+    meeting = [p for p in points if p["error"] <= tolerance
+        and p["SRF"] >= opts["srf_ratio"]*opts["frequency"]]
+    front = sorted(pareto_front(meeting), key=lambda p: -p["Q"])
+    return {"front":front, "points":points, "candidates":len(candidates),
+        "estimated":len(estimated), "solved":sum(p["solved"] for p in points),
+        "stopped":stopped}
+
+def format_point(p):
+    return (p["pcell"] + " r=" + str(p["r"]) + " w=" + str(p["w"])
+        + " s=" + str(p["s"]) + " ct=" + str(int(p["ct"]))
+        + " layer=" + str(p["layer"]) + IndMetrics.format_metrics(dict(p,
+        solved=("L", "Q", "SRF") if p["solved"] else ()))
+        + " area=" + ('%.0f' % p["area"]) + "um2")
+
+
+# ============= main ===============
+
+if __name__ == "__main__":
+    options = {}
+    if "target" in globals():
+        # klayout -rd target=...
+        options["target"] = float(globals()["target"])
+    elif len(sys.argv) >= 2:
+        options["target"] = float(sys.argv[1])
+    result = optimize(options)
+    print(result["stopped"] + ", " + str(result["solved"]) + " solved")
+    for p in result["front"]:
+        print(format_point(p))
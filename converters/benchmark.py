@@ -0,0 +1,590 @@
+# Copyright 2023 J.N.G.W. Verest
+# j.n.g.w.verest@tue.nl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmark suite for the gds2FastHenry and gds2FasterCap converters
+# Generates synthetic layouts of increasing size, times both converters on
+# each of them and compares the measured scaling against a stored baseline.
+
+# CAVEATS:
+#   The synthetic layouts follow the same conventions as the IndLib PCells:
+#   coils are paths, ports are polygons on purpose 16 with a label on
+#   purpose 5, vias are squares on purpose 44. Every converter run gets a
+#   fresh process, but the time is taken inside that process, after numpy,
+#   the geometry backend and the converter have been imported, so the
+#   interpreter start-up does not hide the scaling of the conversion itself.
+#
+#   Usage:
+#     python benchmark.py                   run and compare against baseline
+#     python benchmark.py --update-baseline run and store a new baseline
+#     python benchmark.py --quick           only the two smallest sizes
+#     python benchmark.py --backend both    gdspy and gdstk side by side
+#     python benchmark.py --parity          compare the geometry backends,
+#                                           exit code 1 if they disagree
+
+# File history:
+# Initial version
+
+
+import gdspy
+import sys
+import os
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+from pathlib import Path
+
+import gds_backend
+import gds2fasthenry
+import gds2fastercap
+
+
+
+converter_dir = Path(__file__).resolve().parent
+
+# baselines are stored per geometry backend
+def baseline_default(backend):
+    if backend == "gdspy":
+        return converter_dir / "benchmark_baseline.json"
+    return converter_dir / ("benchmark_baseline_" + backend + ".json")
+
+# converters to be benchmarked, script name and output file suffix
+converters = {
+"fasthenry":("gds2fasthenry.py", "out_fasthenry.inp"),
+"fastercap":("gds2fastercap.py", "_out_fastercap.qui")
+}
+
+# allowed increase of the fitted scaling exponent w.r.t. the baseline
+slope_tolerance = 0.3
+
+# allowed increase of the wall time of the largest layout w.r.t. the baseline
+time_tolerance = 3.0
+
+# layout sizes per case, the size is the case specific scaling variable
+case_sizes = {
+"octagon":[2, 4, 8, 16],    # turns of the spiral
+"via_farm":[8, 16, 32, 64], # via rows/columns per cluster
+"via_array":[8, 16, 32, 64], # same, placed as arrays of one via cell
+"pgs":[50, 100, 200, 400],  # radius of the shield in um
+"coil_array":[2, 4, 6, 8]   # coils per row/column
+}
+
+# runs shorter than this are too noisy to fit a slope to
+noise_floor = 0.02
+
+
+# ============= layout generation ===============
+
+def add_port(cell, name, pos, layer=72, size=10):
+    cell.add(gdspy.Rectangle(
+        (pos[0]-size/2, pos[1]-size/2),
+        (pos[0]+size/2, pos[1]+size/2), layer=layer, datatype=16))
+    cell.add(gdspy.Label(name, pos, layer=layer, texttype=5))
+
+def octagon_points(r, c_a=1/(1+1/np.sqrt(2))):
+    # corners of a regular octagon with "radius" r, starting at the bottom
+    return [(r*c_a, -r), (r, -r*c_a), (r, r*c_a), (r*c_a, r),
+            (-r*c_a, r), (-r, r*c_a), (-r, -r*c_a), (-r*c_a, -r)]
+
+def subdivide(pts, sub):
+    # split every segment in sub pieces, adds vertices but not geometry
+    if sub <= 1:
+        return pts
+    out = []
+    for i in range(len(pts)-1):
+        a = np.array(pts[i])
+        b = np.array(pts[i+1])
+        for k in range(sub):
+            out.append(tuple(a + (b-a)*k/sub))
+    out.append(pts[-1])
+    return out
+
+# single layer multi-turn octagonal spiral, many vertices
+def make_octagon(cell, turns, w=5, s=5, r=40, sub=4):
+    # turns start and end at the bottom, offset by g, and step inwards over
+    # a short diagonal which keeps a spacing of about w+s to the next turn
+    g = 2*(w+s)
+    pts = []
+    for t in range(turns):
+        rad = r + (turns-t)*(w+s)
+        pts += [(g, -rad)] + octagon_points(rad) + [(-g, -rad)]
+    pts.append((g, -r))
+    pts = subdivide(pts, sub)
+    cell.add(gdspy.FlexPath(pts, w, layer=72, datatype=20, gdsii_path=True))
+    add_port(cell, "port_1p", pts[0])
+    add_port(cell, "port_1m", pts[-1])
+    return len(pts)
+
+# two Metal5 arms connected by a Metal4 underpass with dense via farms
+def make_via_farm(cell, n, via_w=0.8, via_s=1.6):
+    w = n*via_s + via_s
+    x = 20 + w
+    arm = [(-x-50, -w-30), (-x-50, 0), (-x, 0)]
+    cell.add(gdspy.FlexPath(arm, w, layer=72, datatype=20, gdsii_path=True))
+    cell.add(gdspy.FlexPath([(-x, 0), (x, 0)], w, layer=71, datatype=20,
+        gdsii_path=True))
+    arm = [(x, 0), (x+50, 0), (x+50, -w-30)]
+    cell.add(gdspy.FlexPath(arm, w, layer=72, datatype=20, gdsii_path=True))
+
+    # via farm centered on both ends of the underpass
+    offs = (np.arange(n) - (n-1)/2)*via_s
+    for cx in (-x, x):
+        for i in range(n):
+            for j in range(n):
+                x0 = cx + offs[j] - via_w/2
+                y0 = offs[i] - via_w/2
+                cell.add(gdspy.Rectangle((x0, y0), (x0+via_w, y0+via_w),
+                    layer=71, datatype=44))
+    add_port(cell, "port_1p", (-x-50, -w-30))
+    add_port(cell, "port_1m", (x+50, -w-30))
+    return 2*n*n
+
+# the via farm layout with each farm placed as one array of a via cell, as
+# IndLib.Oct_double_inductor does
+def make_via_array(cell, n, via_w=0.8, via_s=1.6):
+    w = n*via_s + via_s
+    x = 20 + w
+    arm = [(-x-50, -w-30), (-x-50, 0), (-x, 0)]
+    cell.add(gdspy.FlexPath(arm, w, layer=72, datatype=20, gdsii_path=True))
+    cell.add(gdspy.FlexPath([(-x, 0), (x, 0)], w, layer=71, datatype=20,
+        gdsii_path=True))
+    arm = [(x, 0), (x+50, 0), (x+50, -w-30)]
+    cell.add(gdspy.FlexPath(arm, w, layer=72, datatype=20, gdsii_path=True))
+
+    via_cell = gdspy.Cell("VIA_" + str(n), exclude_from_current=True)
+    via_cell.add(gdspy.Rectangle((0, 0), (via_w, via_w), layer=71,
+        datatype=44))
+    o = -(n-1)/2*via_s - via_w/2
+    for cx in (-x, x):
+        cell.add(gdspy.CellArray(via_cell, n, n, (via_s, via_s),
+            origin=(cx+o, o)))
+    add_port(cell, "port_1p", (-x-50, -w-30))
+    add_port(cell, "port_1m", (x+50, -w-30))
+    return 2*n*n
+
+# patterned ground shield as generated by IndLib.PGS, under a single coil
+def make_pgs(cell, r, w=0.14, s=0.14):
+    n_arms = int(np.floor(r/(w+s)))
+    cell.add(gdspy.Rectangle((-w/2, -w/2), (w/2, w/2), layer=68, datatype=20))
+    for i in range(n_arms):
+        o = (w+s)*i
+        fingers = [
+        ((-w/2+o, w/2+o), (w/2+o, r)),
+        ((w/2+o, 1.5*w+o), (r, 2.5*w+o)),
+        ((w/2+o, -w/2-o), (r, w/2-o)),
+        ((1.5*w+o, -r), (2.5*w+o, -w/2-o)),
+        ((-w/2-o, -r), (w/2-o, -w/2-o)),
+        ((-r, -2.5*w-o), (-w/2-o, -1.5*w-o)),
+        ((-2.5*w-o, w/2+o), (-1.5*w-o, r)),
+        ((-r, -0.5*w+o), (-0.5*w-o, 0.5*w+o))]
+        for a, b in fingers:
+            cell.add(gdspy.Rectangle(a, b, layer=68, datatype=20))
+
+    rad = 0.8*r
+    pts = [(12, -rad-15), (12, -rad)] + octagon_points(rad)[:-1] \
+        + [(-rad/(1+1/np.sqrt(2)), -rad), (-12, -rad), (-12, -rad-15)]
+    pts[2] = (rad/(1+1/np.sqrt(2)), -rad)
+    cell.add(gdspy.FlexPath(pts, 5, layer=72, datatype=20, gdsii_path=True))
+    add_port(cell, "port_1p", pts[0])
+    add_port(cell, "port_1m", pts[-1])
+    return 8*n_arms+1
+
+# array of single turn octagons, each with its own port pair
+def make_coil_array(cell, k, r=50, pitch=150):
+    coil = 0
+    for ix in range(k):
+        for iy in range(k):
+            cx = ix*pitch
+            cy = iy*pitch
+            pts = [(12, -r-15), (12, -r)] + octagon_points(r)[1:-1] \
+                + [(-12, -r), (-12, -r-15)]
+            pts = [(x+cx, y+cy) for x, y in pts]
+            cell.add(gdspy.FlexPath(pts, 5, layer=72, datatype=20,
+                gdsii_path=True))
+            coil += 1
+            add_port(cell, "port_"+str(coil)+"p", pts[0])
+            add_port(cell, "port_"+str(coil)+"m", pts[-1])
+    return k*k
+
+generators = {
+"octagon":make_octagon,
+"via_farm":make_via_farm,
+"via_array":make_via_array,
+"pgs":make_pgs,
+"coil_array":make_coil_array
+}
+
+# write synthetic layout, returns the number of elements in the layout
+def generate_layout(case, size, file_name):
+    lib = gdspy.GdsLibrary()
+    cell = gdspy.Cell(case.upper() + "_" + str(size), exclude_from_current=True)
+    elements = generators[case](cell, size)
+    # added afterwards to include the cells referenced by the layout
+    lib.add(cell)
+    lib.write_gds(file_name)
+    return elements
+
+
+# ============= measurement ===============
+
+# the child times the conversion itself, after importing the converter and
+# everything it loads, and reports its own peak resident set size: ru_maxrss
+# of a child also contains the resident size of the parent at the fork
+runner = (
+"import os, sys, time, runpy\n"
+"sys.path.insert(0, sys.argv[1])\n"
+"sys.argv = sys.argv[2:]\n"
+"__import__(os.path.splitext(os.path.basename(sys.argv[0]))[0])\n"
+"t_start = time.perf_counter()\n"
+"try:\n"
+"    runpy.run_path(sys.argv[0], run_name='__main__')\n"
+"finally:\n"
+"    sys.stderr.write('\\nTime %.6f\\n' % (time.perf_counter() - t_start))\n"
+"    try:\n"
+"        for line in open('/proc/self/status'):\n"
+"            if line.startswith('VmHWM:'):\n"
+"                sys.stderr.write('VmHWM ' + line.split()[1] + '\\n')\n"
+"    except OSError:\n"
+"        pass\n"
+)
+
+# run a converter in a fresh process, returns conversion time, peak rss and
+# output size
+def run_converter(converter, gds_file, work_dir, backend="gdspy"):
+    script, suffix = converters[converter]
+    env = dict(os.environ, GDS_BACKEND=backend)
+    proc = subprocess.run([sys.executable, "-c", runner, str(converter_dir),
+        str(converter_dir / script), str(gds_file)], cwd=work_dir, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    err = proc.stderr.decode().strip().splitlines()
+
+    max_rss_kb = None
+    if err and err[-1].startswith("VmHWM "):
+        max_rss_kb = int(err.pop().split()[1])
+    t_convert = None
+    if err and err[-1].startswith("Time "):
+        t_convert = float(err.pop().split()[1])
+
+    output = Path(work_dir) / (Path(gds_file).stem + suffix)
+    if proc.returncode != 0 or not output.exists() or t_convert is None:
+        return {"ok":False, "error":err[-1:]}
+    output_bytes = output.stat().st_size
+    output.unlink()
+    return {
+        "ok":True,
+        "time":t_convert,
+        "max_rss_kb":max_rss_kb,
+        "output_bytes":output_bytes
+    }
+
+# exponent of time ~ elements^slope, fitted on the runs above the noise floor
+def scaling_exponent(elements, times):
+    times = np.array(times, dtype=float)
+    elements = np.array(elements, dtype=float)
+    keep = times > noise_floor
+    if np.count_nonzero(keep) < 2:
+        return None
+    return float(np.polyfit(np.log(elements[keep]), np.log(times[keep]), 1)[0])
+
+# best of repeat runs, the minimum is the least disturbed measurement
+def measure(converter, gds_file, work_dir, repeat, backend):
+    best = None
+    for _ in range(repeat):
+        run = run_converter(converter, gds_file, work_dir, backend)
+        if not run["ok"]:
+            return run
+        if (best is None) or (run["time"] < best["time"]):
+            best = run
+    return best
+
+def run_case(case, sizes, work_dir, repeat, backend):
+    result = {}
+    elements = []
+    for size in sizes:
+        gds_file = Path(work_dir) / (case + "_" + str(size) + ".gds")
+        elements.append(generate_layout(case, size, gds_file))
+
+    for converter in converters:
+        runs = []
+        for size, n, in zip(sizes, elements):
+            gds_file = Path(work_dir) / (case + "_" + str(size) + ".gds")
+            run = measure(converter, gds_file, work_dir, repeat, backend)
+            run["size"] = size
+            run["elements"] = n
+            if run["ok"]:
+                run["throughput"] = n / run["time"]
+                print("%-5s %-10s %-10s size=%-4d elem=%-6d t=%7.3fs rss=%7.1fMB out=%9dB"
+                    % (backend, case, converter, size, n, run["time"],
+                    (run["max_rss_kb"] or 0)/1024, run["output_bytes"]))
+            else:
+                print("%-5s %-10s %-10s size=%-4d FAILED %s"
+                    % (backend, case, converter, size, run["error"]))
+            runs.append(run)
+
+        ok = [r for r in runs if r["ok"]]
+        slope = scaling_exponent([r["elements"] for r in ok],
+            [r["time"] for r in ok])
+        result[converter] = {"runs":runs, "slope":slope}
+    return result
+
+
+# ============= regression check ===============
+
+def compare(results, baseline, slope_tol, time_tol):
+    failures = []
+    for case in results:
+        for converter in results[case]:
+            new = results[case][converter]
+            old = baseline.get(case, {}).get(converter)
+            if old is None:
+                continue
+
+            # a conversion that used to work should keep working
+            for r_new, r_old in zip(new["runs"], old["runs"]):
+                if r_old["ok"] and not r_new["ok"]:
+                    failures.append(case + "/" + converter + " size "
+                    + str(r_new["size"]) + " fails to convert")
+
+            if (new["slope"] is not None) and (old["slope"] is not None):
+                if new["slope"] > old["slope"] + slope_tol:
+                    failures.append(case + "/" + converter
+                    + " scaling exponent " + ('%.2f' % new["slope"])
+                    + " > baseline " + ('%.2f' % old["slope"]))
+
+            if time_tol > 0:
+                ok_new = [r for r in new["runs"] if r["ok"]]
+                ok_old = [r for r in old["runs"] if r["ok"]]
+                if ok_new and ok_old and ok_new[-1]["size"] == ok_old[-1]["size"]:
+                    if ok_new[-1]["time"] > time_tol*ok_old[-1]["time"]:
+                        failures.append(case + "/" + converter
+                        + " largest layout " + ('%.2f' % ok_new[-1]["time"])
+                        + "s > " + str(time_tol) + " x baseline "
+                        + ('%.2f' % ok_old[-1]["time"]) + "s")
+    return failures
+
+
+# ============= backend parity ===============
+
+def polygon_area(pts):
+    x = pts[:, 0]
+    y = pts[:, 1]
+    return 0.5*abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+# vertex cycle without repeated points, rotated to start at the smallest
+# vertex and oriented counter clockwise, so equal outlines compare equal
+def normalize_outline(pts, decimals=6):
+    pts = np.round(np.asarray(pts, dtype=float), decimals)
+    keep = np.any(pts != np.roll(pts, 1, axis=0), axis=1)
+    pts = pts[keep] if keep.any() else pts[:1]
+    x = pts[:, 0]
+    y = pts[:, 1]
+    if np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)) < 0:
+        pts = pts[::-1]
+    start = np.lexsort((pts[:, 1], pts[:, 0]))[0]
+    return np.roll(pts, -start, axis=0)
+
+# compare the geometry both backends hand to the converters, and the decks
+def backend_parity(gds_file):
+    problems = []
+    cells = {}
+    for backend in gds_backend.backend_names:
+        cell = gds_backend.load_cell(gds_file, backend, verbose=False)
+        cells[backend] = (gds_backend.describe(cell), gds_backend.flatten(cell))
+    (desc_a, a), (desc_b, b) = cells["gdspy"], cells["gdstk"]
+
+    if desc_a != desc_b:
+        problems.append("cell summary " + desc_a + " != " + desc_b)
+
+    labels_a = [(l.text, tuple(np.round(l.position, 6))) for l in a.get_labels()]
+    labels_b = [(l.text, tuple(np.round(l.position, 6))) for l in b.get_labels()]
+    if labels_a != labels_b:
+        problems.append("labels differ")
+
+    paths_a = a.get_paths()
+    paths_b = b.get_paths()
+    if len(paths_a) != len(paths_b):
+        problems.append("number of paths differs")
+    for i, (p, q) in enumerate(zip(paths_a, paths_b)):
+        if (list(p.layers) != list(q.layers)
+        or not np.array_equal(p.points, q.points)
+        or not np.array_equal(p.widths, q.widths)):
+            problems.append("path " + str(i) + " spine differs")
+        outline_a = p.get_polygons()
+        outline_b = q.get_polygons()
+        area_a = sum(polygon_area(np.asarray(x)) for x in outline_a)
+        area_b = sum(polygon_area(np.asarray(x)) for x in outline_b)
+        if abs(area_a - area_b) > 1e-6*max(area_a, 1):
+            problems.append("path " + str(i) + " outline area differs")
+        elif len(outline_a) == 1 and len(outline_b) == 1:
+            if not np.allclose(normalize_outline(outline_a[0]),
+                normalize_outline(outline_b[0]), atol=1e-6):
+                problems.append("path " + str(i) + " outline differs")
+
+    spec_a = a.get_polygons(by_spec=True)
+    spec_b = b.get_polygons(by_spec=True)
+    if set(spec_a) != set(spec_b):
+        problems.append("layer/datatype pairs differ")
+    for key in set(spec_a) & set(spec_b):
+        area_a = sum(polygon_area(np.asarray(x)) for x in spec_a[key])
+        area_b = sum(polygon_area(np.asarray(x)) for x in spec_b[key])
+        if abs(area_a - area_b) > 1e-6*max(area_a, 1):
+            problems.append("area on " + str(key) + " differs")
+
+    # decks, fasthenry only depends on spines and must match exactly; a
+    # conversion has to work on both backends or fail the same way on both
+    decks = {}
+    errors = {}
+    for name, convert in [("fasthenry", gds2fasthenry.convert_fasthenry),
+        ("fastercap", gds2fastercap.convert_fastercap)]:
+        decks[name] = []
+        errors[name] = []
+        for backend in gds_backend.backend_names:
+            try:
+                decks[name].append(convert(gds_file, {"write":False,
+                    "verbose":False, "backend":backend})["deck"])
+                errors[name].append(None)
+            except Exception as e:
+                decks[name].append(None)
+                errors[name].append(type(e).__name__ + ": " + str(e))
+        failed = [b for b, e in zip(gds_backend.backend_names, errors[name]) if e]
+        if len(failed) == 1:
+            problems.append(name + " fails on " + failed[0] + " only: "
+            + errors[name][gds_backend.backend_names.index(failed[0])])
+        elif failed and errors[name][0] != errors[name][1]:
+            problems.append(name + " fails differently: " + " / ".join(
+                errors[name]))
+    if decks["fasthenry"][0] != decks["fasthenry"][1]:
+        problems.append("fasthenry decks differ")
+    if None in decks["fastercap"]:
+        fastercap = "fails on " + ", ".join(b for b, e in
+            zip(gds_backend.backend_names, errors["fastercap"]) if e)
+    elif decks["fastercap"][0] == decks["fastercap"][1]:
+        fastercap = "identical"
+    else:
+        # outlines differ on the DBU grid, so the triangles differ too
+        fastercap = "differs (triangulation)"
+    return problems, fastercap
+
+def run_parity(cases, work_dir):
+    failures = []
+    for case in cases:
+        for size in case_sizes[case]:
+            gds_file = Path(work_dir) / (case + "_" + str(size) + ".gds")
+            generate_layout(case, size, gds_file)
+            problems, fastercap = backend_parity(gds_file)
+            print("%-10s size=%-4d parity %-5s fastercap deck %s"
+                % (case, size, "ok" if not problems else "FAIL", fastercap))
+            for problem in problems:
+                failures.append(case + " size " + str(size) + ": " + problem)
+    return failures
+
+def speedup_table(results):
+    print("\nspeed-up of gdstk w.r.t. gdspy, largest layout of every case")
+    for case in results["gdspy"]:
+        for converter in results["gdspy"][case]:
+            a = results["gdspy"][case][converter]["runs"][-1]
+            b = results["gdstk"][case][converter]["runs"][-1]
+            if a["ok"] and b["ok"]:
+                print("%-10s %-10s %6.2fx" % (case, converter, a["time"]/b["time"]))
+
+
+# ============= main ===============
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the GDS converters")
+    parser.add_argument("--cases", nargs="+", default=list(case_sizes),
+        choices=list(case_sizes))
+    parser.add_argument("--quick", action="store_true",
+        help="only run the two smallest layouts of every case")
+    parser.add_argument("--backend", default="gdspy",
+        choices=gds_backend.backend_names + ["both"])
+    parser.add_argument("--parity", action="store_true",
+        help="check that gdspy and gdstk give the converters the same geometry")
+    parser.add_argument("--baseline",
+        help="baseline file, default depends on the backend")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--output", help="write all measurements to json")
+    parser.add_argument("--repeat", type=int, default=2,
+        help="runs per layout, the fastest one is kept")
+    parser.add_argument("--slope-tol", type=float, default=slope_tolerance)
+    parser.add_argument("--time-tol", type=float, default=time_tolerance,
+        help="0 disables the absolute time check")
+    args = parser.parse_args(argv)
+
+    if args.parity:
+        with tempfile.TemporaryDirectory() as work_dir:
+            failures = run_parity(args.cases, work_dir)
+        for failure in failures:
+            print("PARITY: " + failure)
+        if not failures:
+            print("gdspy and gdstk backends agree")
+        return 1 if failures else 0
+
+    backends = [args.backend]
+    if args.backend == "both":
+        backends = list(gds_backend.backend_names)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for backend in backends:
+            results[backend] = {}
+            for case in args.cases:
+                sizes = case_sizes[case]
+                if args.quick:
+                    sizes = sizes[:2]
+                results[backend][case] = run_case(case, sizes, work_dir,
+                    args.repeat, backend)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if len(backends) == 2:
+        speedup_table(results)
+
+    failures = []
+    for backend in backends:
+        baseline_file = args.baseline or str(baseline_default(backend))
+        if args.update_baseline:
+            baseline = {}
+            if Path(baseline_file).exists():
+                with open(baseline_file) as f:
+                    baseline = json.load(f)
+            baseline.update(results[backend])
+            with open(baseline_file, 'w') as f:
+                json.dump(baseline, f, indent=1)
+            print("Baseline written to " + baseline_file)
+            continue
+
+        if not Path(baseline_file).exists():
+            print("No " + backend + " baseline found, run with --update-baseline first")
+            continue
+
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        failures += [backend + " " + x for x in compare(results[backend],
+            baseline, args.slope_tol, args.time_tol if not args.quick else 0)]
+
+    for failure in failures:
+        print("REGRESSION: " + failure)
+    if not failures and not args.update_baseline:
+        print("No scaling regressions found")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
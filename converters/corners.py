@@ -0,0 +1,310 @@
+# Copyright 2023 J.N.G.W. Verest
+# j.n.g.w.verest@tue.nl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Process corners and Monte Carlo samples of the SKY130 stack
+# The layout is extracted and triangulated once. The decks are then rendered
+# once with placeholders instead of the values of the stack tables of
+# sky130_stack.py, and every sample of the stack (metal thickness, dielectric
+# thickness, metal, via and substrate resistivity) is a single substitution
+# in that template. Only the FastHenry2 via sections, which divide the via
+# resistivity by the number of pillars, are generated per sample.
+
+# CAVEATS:
+#   The variations are relative and normally distributed, per metal or via
+#   layer and independent of each other. A dielectric varies the distance
+#   to the metal below it, so all metals above it move; a metal grows
+#   upwards from its bottom. Every sample is a stack of its own, a dict
+#   like sky130_stack.default_stack, passed to the deck writers; the shared
+#   tables are never changed, so conversions in other threads (worker.py,
+#   the metrics service) are not affected.
+#   The "typical" corner gives the decks of a normal conversion.
+#
+#   Usage:
+#     python corners.py [gds_file] [samples]   Monte Carlo samples
+#     python corners.py [gds_file] corners     the corners
+#   writes one deck per sample and solver and a [gds_file]_corners.jsonl
+#   with one solver job per line.
+
+# File history:
+# Initial version
+
+
+import re
+import sys
+import json
+import numpy as np
+from pathlib import Path
+
+import gds_model
+import validate
+import sky130_stack
+import gds2fasthenry
+import gds2fastercap
+
+
+
+# default options
+default_options = {
+"mode":"montecarlo",  # "montecarlo" or "corners"
+"samples":100,        # Monte Carlo samples
+"seed":0,             # random seed of the samples
+"sigma":{             # relative standard deviations
+    "thickness":0.05,     # metal thickness
+    "dielectric":0.03,    # dielectric thickness below a metal
+    "resistivity":0.05,   # metal resistivity
+    "via":0.10,           # via resistance
+    "substrate":0.20      # substrate resistivity
+    },
+"n_sigma":3,          # distance of the corners in standard deviations
+"solvers":["fasthenry", "fastercap"],
+"write":True,         # write the decks and the job file
+"verbose":True,
+"backend":None,       # geometry backend, gdspy or gdstk, see gds_backend.py
+"validate":True       # check the geometry first, see validate.py
+}
+
+# corners as multiples of n_sigma per variation, the others are typical;
+# thin metal gives the most resistance, thick metal (more sidewall) and
+# thin dielectric give the most capacitance
+corners = {
+"typical":{},
+"resistive":{"thickness":-1, "resistivity":1, "via":1},
+"conductive":{"thickness":1, "resistivity":-1, "via":-1},
+"capacitive":{"thickness":1, "dielectric":-1},
+"uncapacitive":{"thickness":-1, "dielectric":1},
+"slow":{"thickness":-1, "dielectric":-1, "resistivity":1, "via":1}
+}
+
+# the stack tables varied per sample, all per layer
+tables = ("stack_heights", "stack_bottom", "stack_top", "layer_heights",
+    "layer_resistivities", "via_resistivities")
+
+
+# ============= stack samples ===============
+
+# relative factors of the samples, arrays [N, layers] and [N] for the
+# substrate, from standard normal draws g (a dict of the same shapes)
+def factors(g, sigma):
+    return {name:1 + sigma[name]*g[name] for name in sigma}
+
+def normal_draws(samples, seed):
+    rng = np.random.default_rng(seed)
+    metals = len(sky130_stack.layerlist)
+    vias = len(sky130_stack.via_resistivities)
+    return {
+        "thickness":rng.standard_normal((samples, metals)),
+        "dielectric":rng.standard_normal((samples, metals)),
+        "resistivity":rng.standard_normal((samples, metals)),
+        "via":rng.standard_normal((samples, vias)),
+        "substrate":rng.standard_normal(samples)
+    }
+
+def corner_draws(names, n_sigma):
+    metals = len(sky130_stack.layerlist)
+    vias = len(sky130_stack.via_resistivities)
+    shapes = {"thickness":metals, "dielectric":metals, "resistivity":metals,
+        "via":vias, "substrate":None}
+    draws = {}
+    for name, size in shapes.items():
+        signs = np.array([corners[c].get(name, 0) for c in names], dtype=np.float64)
+        draws[name] = n_sigma*(signs[:, None]*np.ones(size) if size else signs)
+    return draws
+
+# the nominal value if it did not change, as written in the table
+def table_value(nominal, x, digits=4):
+    if x == float(nominal):
+        return nominal
+    return repr(round(float(x), digits))
+
+def significant(nominal, x, digits=4):
+    if x == float(nominal):
+        return nominal
+    return repr(float('%.*g' % (digits, x)))
+
+# stack tables of all samples at once: heights of all metals by cumulative
+# sums over the layers; returns one dict of tables per sample
+def stack_samples(f):
+    layers = [str(layer) for layer in sky130_stack.layerlist]
+    bottom = np.array([float(sky130_stack.stack_bottom[l]) for l in layers])
+    top = np.array([float(sky130_stack.stack_top[l]) for l in layers])
+    center = np.array([float(sky130_stack.stack_heights[l]) for l in layers])
+    gap = bottom - np.concatenate([[0], top[:-1]])
+    t = top - bottom
+
+    gap_s = gap*f["dielectric"]
+    t_s = t*f["thickness"]
+    bottom_s = np.cumsum(gap_s, axis=1) + np.cumsum(t_s, axis=1) - t_s
+    top_s = bottom_s + t_s
+    center_s = bottom_s + (center - bottom)*f["thickness"]
+    rho = np.array([float(sky130_stack.layer_resistivities[l]) for l in layers])
+    rho_s = rho*f["resistivity"]
+    vias = list(sky130_stack.via_resistivities)
+    via = np.array([sky130_stack.via_resistivities[v] for v in vias])
+    via_s = via*f["via"]
+    rho_subs_s = sky130_stack.rho_subs*f["substrate"]
+
+    samples = []
+    for n in range(len(rho_s)):
+        values = {
+            "stack_heights":{l:table_value(sky130_stack.stack_heights[l], center_s[n, k])
+                for k, l in enumerate(layers)},
+            "stack_bottom":{l:table_value(sky130_stack.stack_bottom[l], bottom_s[n, k])
+                for k, l in enumerate(layers)},
+            "stack_top":{l:table_value(sky130_stack.stack_top[l], top_s[n, k])
+                for k, l in enumerate(layers)},
+            "layer_heights":{l:table_value(sky130_stack.layer_heights[l],
+                t_s[n, k]) for k, l in enumerate(layers)},
+            "layer_resistivities":{l:significant(sky130_stack.layer_resistivities[l],
+                rho_s[n, k]) for k, l in enumerate(layers)},
+            "via_resistivities":{v:float(via_s[n, k]) for k, v in enumerate(vias)},
+            "rho_subs":(sky130_stack.rho_subs if f["substrate"][n] == 1
+                else float('%.4g' % rho_subs_s[n]))
+        }
+        samples.append(values)
+    return samples
+
+# ============= deck templates ===============
+
+# placeholder of a table value, not found in any deck
+def placeholder(name, layer=None):
+    return "\x00" + name + ("/" + layer if layer is not None else "") + "\x00"
+
+placeholder_pattern = re.compile("\x00([^\x00]+)\x00")
+
+def placeholder_values():
+    values = {name:{layer:placeholder(name, layer)
+        for layer in getattr(sky130_stack, name)} for name in tables}
+    # divided by the pillar count, the via sections are rendered per sample
+    values["via_resistivities"] = dict(sky130_stack.via_resistivities)
+    values["rho_subs"] = placeholder("rho_subs")
+    return values
+
+# the values of a sample by placeholder name
+def placeholder_mapping(values):
+    mapping = {name + "/" + layer:value for name in tables
+        for layer, value in values[name].items()}
+    mapping["rho_subs"] = str(values["rho_subs"])
+    return mapping
+
+# deck sections of a solver with a stack
+def deck_sections(solver, model, stack):
+    if solver == "fasthenry":
+        return gds2fasthenry.fasthenry_sections(model, stack=stack)
+    return gds2fastercap.fastercap_sections(model, stack)
+
+# the deck of a solver as a list of %-format strings with the table values
+# as named fields and (function, arguments) for the sections that are
+# generated per sample, which get the stack of the sample as last argument
+def deck_template(solver, model):
+    parts = []
+    for name, function, arguments in deck_sections(solver, model,
+        placeholder_values()):
+        if solver == "fasthenry" and isinstance(name, tuple) and name[0] == "via":
+            parts.append((function, arguments[:-1]))
+            continue
+        text = placeholder_pattern.sub(r"%(\1)s",
+            function(model, *arguments).replace("%", "%%"))
+        if parts and isinstance(parts[-1], str):
+            parts[-1] += text
+        else:
+            parts.append(text)
+    return parts
+
+# the deck of one sample, with the stack values, from a template
+def render_template(parts, model, values):
+    mapping = placeholder_mapping(values)
+    return "".join(part % mapping if isinstance(part, str)
+        else part[0](model, *part[1], values) for part in parts)
+
+
+# ============= conversion ===============
+
+def deck_name(stem, solver, tag):
+    if solver == "fasthenry":
+        return stem + "out_fasthenry_" + tag + ".inp"
+    return stem + "_out_fastercap_" + tag + ".qui"
+
+# extract a layout once and render the decks of all samples; returns the
+# tags and factors of the samples, the decks per solver and, with "write",
+# the solver jobs, one per sample with its deck names
+def convert_corners(library_or_path, options=None):
+    opts = dict(default_options)
+    if options:
+        opts.update(options)
+    sigma = dict(default_options["sigma"])
+    sigma.update(opts["sigma"])
+    verbose = opts["verbose"]
+
+    model = gds_model.get_model(library_or_path, opts["backend"],
+        sky130_stack.layerlist, panels=False, verbose=verbose)
+    if opts["validate"]:
+        validate.require_valid(model, opts["solvers"], verbose)
+    if "fastercap" in opts["solvers"] and not bool(model["has_panels"]):
+        gds_model.add_panels(model)
+
+    if opts["mode"] == "corners":
+        tags = list(corners)
+        draws = corner_draws(tags, opts["n_sigma"])
+    else:
+        tags = ["mc" + str(n) for n in range(opts["samples"])]
+        draws = normal_draws(opts["samples"], opts["seed"])
+    f = factors(draws, sigma)
+    samples = stack_samples(f)
+
+    decks = {}
+    for solver in opts["solvers"]:
+        parts = deck_template(solver, model)
+        decks[solver] = [render_template(parts, model, values)
+            for values in samples]
+
+    result = {"cell":str(model["cell_name"][()]), "tags":tags,
+        "factors":{name:value.tolist() for name, value in f.items()},
+        "samples":samples, "decks":decks}
+    if opts["write"]:
+        if isinstance(library_or_path, (str, Path)):
+            stem = Path(library_or_path).stem
+        else:
+            stem = result["cell"]
+        jobs = []
+        for n, tag in enumerate(tags):
+            job = {"sample":tag, "factors":{name:value[n].tolist()
+                for name, value in f.items()}}
+            for solver in opts["solvers"]:
+                job[solver] = deck_name(stem, solver, tag)
+                with open(job[solver], 'w') as out:
+                    out.write(decks[solver][n])
+            jobs.append(job)
+        result["jobs_name"] = stem + "_corners.jsonl"
+        with open(result["jobs_name"], 'w') as out:
+            out.write("".join(json.dumps(job) + "\n" for job in jobs))
+        result["jobs"] = jobs
+        if verbose:
+            print(str(len(tags)) + " samples written, jobs in " + result["jobs_name"])
+    return result
+
+
+# ============= main ===============
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2:
+        options = {}
+        if len(sys.argv) >= 3:
+            if sys.argv[2] == "corners":
+                options["mode"] = "corners"
+            else:
+                options["samples"] = int(sys.argv[2])
+        convert_corners(sys.argv[1], options)
+    else:
+        print ("Usage: corners.py [gds_file] [samples | corners]")
@@ -0,0 +1,310 @@
+# Copyright 2023 J.N.G.W. Verest
+# j.n.g.w.verest@tue.nl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Integer database unit geometry kernel
+# Vertices are kept as int64 database units (DBU, from the units record of
+# the GDS library, 1 nm in the files written by KLayout and gdspy) in packed
+# arrays, so point comparisons are exact and the predicates (orientation,
+# point in triangle, edge crossing) are exact integer arithmetic on whole
+# arrays. Port, Segment and ViaCluster are small __slots__ records which
+# refer into the packed arrays of a geometry model instead of holding
+# tuples of float coordinates.
+
+# CAVEATS:
+#   Coordinates are snapped to the DBU grid, which is where the layout was
+#   drawn anyway; the decks still print micrometers with 3 decimals. The
+#   predicates are exact as long as coordinates stay below 2^31 DBU (2 m
+#   at 1 nm), products of two differences then fit in int64. A model keeps
+#   its database unit as "dbu", see model_unit.
+#   The records are views: they stay valid as long as the model arrays do.
+#   Derived positions that are not vertices, the port and via cluster
+#   centers, stay float micrometers.
+
+# File history:
+# Initial version
+
+
+import numpy as np
+
+
+
+# micrometer per database unit, for layouts without a units record
+dbu = 1e-3
+
+
+# ============= conversion ===============
+
+# float micrometer coordinates to DBU on the grid
+def to_dbu(xy, unit=dbu):
+    return np.rint(np.asarray(xy, dtype=np.float64)/unit).astype(np.int64)
+
+# DBU coordinates to float micrometers
+def to_um(ixy, unit=dbu):
+    return np.asarray(ixy, dtype=np.float64)*unit
+
+# polygon without consecutive repeated vertices and without a closing
+# vertex, on which the backends do not agree
+def distinct_vertices(ixy):
+    ixy = np.asarray(ixy)
+    keep = np.ones(len(ixy), dtype=bool)
+    keep[1:] = np.any(ixy[1:] != ixy[:-1], axis=1)
+    ixy = ixy[keep]
+    if len(ixy) > 1 and np.all(ixy[-1] == ixy[0]):
+        ixy = ixy[:-1]
+    return ixy
+
+# one int64 key per point, equal keys for equal points, for exact hashing,
+# sorting and lookup of points
+def point_keys(ixy):
+    ixy = np.asarray(ixy, dtype=np.int64)
+    return (ixy[..., 0] << 32) + (ixy[..., 1] & 0xffffffff)
+
+# mask of the points in ixy equal to point p
+def same_point(ixy, p):
+    return np.all(np.asarray(ixy) == np.asarray(p), axis=-1)
+
+# mask of the points that occur more than once
+def repeated_points(ixy):
+    keys = point_keys(ixy)
+    unique, inverse, counts = np.unique(keys, return_inverse=True,
+        return_counts=True)
+    return counts[inverse] > 1
+
+
+# ============= exact predicates ===============
+
+# sign of the turn p -> q -> r: 1 left, -1 right, 0 collinear
+def orient(p, q, r):
+    return np.sign((q[..., 0]-p[..., 0])*(r[..., 1]-p[..., 1])
+        - (q[..., 1]-p[..., 1])*(r[..., 0]-p[..., 0]))
+
+# twice the signed area of a closed outline
+def area2(ixy):
+    x = np.asarray(ixy[:, 0], dtype=np.int64)
+    y = np.asarray(ixy[:, 1], dtype=np.int64)
+    return int(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+# mask of points inside or on triangle (a, b, c), broadcast over points
+def in_triangle(points, a, b, c):
+    d1 = orient(a, b, points)
+    d2 = orient(b, c, points)
+    d3 = orient(c, a, points)
+    has_neg = (d1 < 0) | (d2 < 0) | (d3 < 0)
+    has_pos = (d1 > 0) | (d2 > 0) | (d3 > 0)
+    return ~(has_neg & has_pos)
+
+# one half of the convex hull of sorted points, turning left: every vertex
+# that does not turn left is dropped in the same pass, a run of them lies
+# on the right of the chord between the kept neighbours
+def half_hull(pts):
+    while len(pts) > 2:
+        keep = np.ones(len(pts), dtype=bool)
+        keep[1:-1] = orient(pts[:-2], pts[1:-1], pts[2:]) > 0
+        if keep.all():
+            break
+        pts = pts[keep]
+    return pts
+
+# convex hull of DBU points, counter-clockwise without collinear points,
+# monotone chain with the exact orientation test, vectorised per pass
+def convex_hull(ixy):
+    pts = np.unique(np.asarray(ixy, dtype=np.int64).reshape(-1, 2), axis=0)
+    if len(pts) < 3:
+        return pts
+    return np.concatenate([half_hull(pts)[:-1], half_hull(pts[::-1])[:-1]])
+
+# True for every pair of edges of a closed outline that properly cross each
+# other, edges sharing a vertex are not compared
+def crossing_edges(ixy):
+    a = np.asarray(ixy, dtype=np.int64)
+    b = np.roll(a, -1, axis=0)
+    o1 = orient(a[:, None], b[:, None], a[None, :])
+    o2 = orient(a[:, None], b[:, None], b[None, :])
+    o3 = orient(a[None, :], b[None, :], a[:, None])
+    o4 = orient(a[None, :], b[None, :], b[:, None])
+    cross = (o1*o2 < 0) & (o3*o4 < 0)
+    n = len(a)
+    k = np.arange(n)
+    near = (np.abs(k[:, None] - k[None, :]) <= 1) | (np.abs(k[:, None] - k[None, :]) == n-1)
+    return np.triu(cross & ~near)
+
+
+# ============= triangulation ===============
+
+# mask of the ears among vertices idx of the outline ring: left turns whose
+# triangle holds none of the vertices that do not turn left, except copies
+# of its own corners; a vertex without a turn is always cut off. Tested in
+# blocks of vertices at once
+def find_ears(ipts, idx, before, after, turn, alive, block=256):
+    idx = np.asarray(idx, dtype=np.int64)
+    ear = turn[idx] == 0
+    convex = np.flatnonzero(turn[idx] > 0)
+    other = ipts[alive & (turn <= 0)][None]
+    for start in range(0, len(convex), block):
+        k = idx[convex[start:start+block]]
+        a = ipts[before[k]][:, None]
+        b = ipts[k][:, None]
+        c = ipts[after[k]][:, None]
+        inside = in_triangle(other, a, b, c) & ~(same_point(other, a)
+            | same_point(other, b) | same_point(other, c))
+        ear[convex[start:start+block]] = ~inside.any(axis=1)
+    return ear
+
+# all triangles of an outline in DBU, as an array [T,3,2], counter-clockwise,
+# by ear clipping; only the neighbours of a cut vertex change, so only their
+# turn and ear state are updated. Vertices without a turn are dropped
+# without a triangle; an outline that crosses itself can run out of ears,
+# then the next left turn (or any vertex) is cut off regardless
+def triangulate(ipts):
+    ipts = np.asarray(ipts, dtype=np.int64).reshape(-1, 2)
+    if area2(ipts) < 0:
+        ipts = ipts[::-1]
+    n = len(ipts)
+    before = np.roll(np.arange(n), 1)
+    after = np.roll(np.arange(n), -1)
+    turn = orient(ipts[before], ipts, ipts[after]) if n else np.zeros(0)
+    alive = np.ones(n, dtype=bool)
+    ear = find_ears(ipts, np.arange(n), before, after, turn, alive)
+
+    triangles = []
+    i = 0
+    left = n
+    stall = 0
+    while left >= 3:
+        if not ear[i] and stall <= left:
+            i = after[i]
+            stall += 1
+            continue
+        if not ear[i]:
+            # a full round without an ear, cut a left turn if there is one
+            for _ in range(left):
+                if turn[i] > 0:
+                    break
+                i = after[i]
+        a = before[i]
+        c = after[i]
+        if turn[i] != 0:
+            triangles.append(ipts[[a, i, c]])
+        alive[i] = False
+        after[a] = c
+        before[c] = a
+        left -= 1
+        for j in (a, c):
+            turn[j] = orient(ipts[before[j]], ipts[j], ipts[after[j]])
+        ear[[a, c]] = find_ears(ipts, [a, c], before, after, turn, alive)
+        i = c
+        stall = 0
+    return np.array(triangles, dtype=np.int64).reshape(-1, 3, 2)
+
+
+# ============= records ===============
+
+# packed polygons or paths: all vertices in one array, polygon k is
+# xy[offsets[k]:offsets[k+1]]
+class PointStore:
+    __slots__ = ("xy", "offsets")
+
+    def __init__(self, xy, offsets):
+        self.xy = np.asarray(xy)
+        self.offsets = np.asarray(offsets)
+
+    @classmethod
+    def from_model(cls, model, xy_key, offsets_key):
+        return cls(model[xy_key], model[offsets_key])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, k):
+        return self.xy[self.offsets[k]:self.offsets[k+1]]
+
+# a port: name, layer and its position, the center of its pin in um, a
+# row of the port point array
+class Port:
+    __slots__ = ("name", "layer", "points", "index")
+
+    def __init__(self, name, layer, points, index):
+        self.name = name
+        self.layer = layer
+        self.points = points
+        self.index = index
+
+    @property
+    def xy(self):
+        return self.points[self.index]
+
+    def __repr__(self):
+        return "Port(" + repr(self.name) + ", " + str(self.layer) + ", " + str(self.xy) + ")"
+
+# a segment between two consecutive nodes of a path
+class Segment:
+    __slots__ = ("nodes", "path", "first", "width")
+
+    def __init__(self, nodes, path, first, width):
+        self.nodes = nodes
+        self.path = path
+        self.first = first
+        self.width = width
+
+    @property
+    def ends(self):
+        return self.nodes.xy[self.first:self.first+2]
+
+    def __repr__(self):
+        return ("Segment(path " + str(self.path) + ", " + str(self.ends.tolist())
+        + ", w=" + str(self.width) + ")")
+
+# via cluster between the path ends of two paths on adjacent layers; the
+# center is the mean of the pillar centers, in um as it is off the grid
+class ViaCluster:
+    __slots__ = ("paths", "ends", "layer", "count", "center")
+
+    def __init__(self, paths, ends, layer, count, center):
+        self.paths = paths
+        self.ends = ends
+        self.layer = layer
+        self.count = count
+        self.center = center
+
+    def __repr__(self):
+        return ("ViaCluster(paths " + str(self.paths) + ", layer "
+        + str(self.layer) + ", " + str(self.count) + " pillars)")
+
+# records of a geometry model (see gds_model.py), views on its DBU arrays;
+# the writers build the ones of a single path or cluster as they need them
+
+# micrometer per database unit of a model
+def model_unit(model):
+    return float(model["dbu"])
+
+def model_ports(model):
+    return [Port(str(model["port_name"][k]), int(model["port_layer"][k]),
+        model["port_xy"], k) for k in range(len(model["port_name"]))]
+
+def model_nodes(model):
+    return PointStore.from_model(model, "node_xy", "path_offsets")
+
+# segments of path k, numbered like the nodes, minus one per path
+def path_segments(model, k, nodes=None):
+    if nodes is None:
+        nodes = model_nodes(model)
+    return [Segment(nodes, k, index, float(model["seg_width"][index-k]))
+        for index in range(nodes.offsets[k], nodes.offsets[k+1]-1)]
+
+def via_cluster(model, c):
+    return ViaCluster(tuple(int(x) for x in model["cluster_paths"][c]),
+        tuple(int(x) for x in model["cluster_ends"][c]),
+        int(model["cluster_layer"][c]), int(model["cluster_count"][c]),
+        model["cluster_xy"][c])
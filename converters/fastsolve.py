@@ -0,0 +1,243 @@
+# Copyright 2023 J.N.G.W. Verest
+# j.n.g.w.verest@tue.nl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run FastHenry2 and FasterCap on the converted decks and read the results
+# Converts a layout with gds2fastmodel.py, runs both solvers on the decks and
+# reduces the impedance and capacitance matrices to the inductor metrics:
+# inductance, series resistance and quality factor at one frequency, total
+# capacitance and the self resonance frequency.
+
+# CAVEATS:
+#   The solvers are external programs, found on the PATH or given by the
+#   FASTHENRY and FASTERCAP environment variables. Without FasterCap only
+#   L, R and Q are returned. The metrics are for the first port pair, the
+#   other port grounded; the self resonance uses half of the total
+#   capacitance of all coil conductors, as for a pi model with both ends
+#   loaded. Patterned ground shields count as ground.
+#
+#   Usage:
+#     python fastsolve.py [gds_file] [frequency]
+#   prints the metrics as one JSON line.
+
+# File history:
+# Initial version
+
+
+import os
+import re
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+from pathlib import Path
+
+import gds2fastmodel
+import gds2fastercap
+
+
+
+# default solve options
+default_options = {
+"frequency":10e9,      # frequency of L, R and Q in Hz
+"fasthenry":None,      # solver executables, from the environment or the PATH
+"fastercap":None,      #   if None
+"fastercap_args":["-a0.01"], # relative accuracy of the capacitance
+"timeout":600,         # seconds per solver run
+"work_dir":None,       # directory for decks and results, a temporary one if None
+"backend":None,        # geometry backend, gdspy or gdstk, see gds_backend.py
+"verbose":False
+}
+
+# executable of a solver, None if not installed
+def find_solver(name, executable=None):
+    if executable is None:
+        executable = os.environ.get(name.upper(), name)
+    return shutil.which(executable)
+
+
+# ============= result files ===============
+
+# impedance matrices of a FastHenry2 Zc.mat file, as a list of
+# (frequency, complex matrix)
+def read_zc(path):
+    result = []
+    header = re.compile(r"Impedance matrix for frequency\s*=\s*(\S+)\s+(\d+)\s*x\s*(\d+)")
+    with open(path) as f:
+        lines = f.read().splitlines()
+    i = 0
+    while i < len(lines):
+        match = header.search(lines[i])
+        i += 1
+        if match is None:
+            continue
+        frequency = float(match.group(1))
+        rows = int(match.group(2))
+        z = np.zeros((rows, int(match.group(3))), dtype=complex)
+        for row in range(rows):
+            # "  0.0585  +0.00192j  ...", the sign of the imaginary part is
+            # sometimes separated from the value
+            tokens = lines[i].replace("+ ", "+").replace("- ", "-").split()
+            values = [complex(tokens[k] + tokens[k+1].rstrip("j") + "j")
+                for k in range(0, len(tokens)-1, 2)]
+            z[row, :len(values)] = values
+            i += 1
+        result.append((frequency, z))
+    return result
+
+# last capacitance matrix in the output of a FasterCap batch run, in F,
+# with names=True also the conductor names of its rows
+def read_fastercap(text, names=False):
+    lines = text.splitlines()
+    dimension = re.compile(r"Dimension\s+(\d+)\s*x\s*(\d+)")
+    found = None
+    for i, line in enumerate(lines):
+        match = dimension.search(line)
+        if match is not None:
+            found = (i, int(match.group(1)))
+    if found is None:
+        raise ValueError("no capacitance matrix in the FasterCap output")
+    i, n = found
+    c = np.zeros((n, n))
+    conductors = []
+    for row in range(n):
+        tokens = lines[i+1+row].split()
+        c[row] = [float(x) for x in tokens[-n:]]
+        conductors.append(" ".join(tokens[:-n]))
+    if names:
+        return c, conductors
+    return c
+
+# the block of the coil conductors, without the rows and columns of the
+# patterned ground shields, which are grounded (FasterCap prefixes the
+# conductor names with the group, e.g. g1_PGS)
+def coil_block(c, names):
+    shield = gds2fastercap.shield_conductor
+    keep = [k for k, name in enumerate(names)
+        if name.split("_")[-1] != shield]
+    return c[np.ix_(keep, keep)]
+
+
+# ============= metrics ===============
+
+# L, R and Q of the first port at the solved frequency closest to frequency
+# (on a log scale)
+def impedance_metrics(zc, frequency):
+    frequencies = np.array([f for f, z in zc])
+    k = int(np.argmin(np.abs(np.log(frequencies/frequency))))
+    f, z = zc[k]
+    z11 = z[0, 0]
+    return {
+        "frequency":float(f),
+        "L":float(z11.imag/(2*np.pi*f)),
+        "R":float(z11.real),
+        "Q":float(z11.imag/z11.real) if z11.real > 0 else None
+    }
+
+# total capacitance and self resonance frequency with inductance L; with
+# the conductor names the capacitance of the coil, the shields grounded
+def capacitance_metrics(c, inductance, names=None):
+    if names is not None:
+        c = coil_block(c, names)
+    c_total = float(np.sum(c))
+    srf = None
+    if inductance and c_total > 0:
+        srf = float(1/(2*np.pi*np.sqrt(inductance*c_total/2)))
+    return {"C":c_total, "SRF":srf}
+
+
+# ============= solving ===============
+
+def run_solver(arguments, work_dir, timeout):
+    return subprocess.run(arguments, cwd=work_dir, capture_output=True,
+        text=True, timeout=timeout, check=True)
+
+# run FastHenry2 on a deck text in its own directory, returns the impedance
+# matrices as read_zc does
+def run_fasthenry(deck, executable=None, timeout=None):
+    fasthenry = find_solver("fasthenry", executable)
+    if fasthenry is None:
+        raise FileNotFoundError("FastHenry2 not found, set FASTHENRY")
+    with tempfile.TemporaryDirectory() as work_dir:
+        deck_name = os.path.join(work_dir, "deck.inp")
+        with open(deck_name, 'w') as f:
+            f.write(deck)
+        run_solver([fasthenry, deck_name], work_dir,
+            timeout or default_options["timeout"])
+        return read_zc(os.path.join(work_dir, "Zc.mat"))
+
+# run FasterCap on a deck text in its own directory, returns the
+# capacitance matrix (and names) as read_fastercap does
+def run_fastercap(deck, executable=None, timeout=None, arguments=None,
+    names=False):
+    fastercap = find_solver("fastercap", executable)
+    if fastercap is None:
+        raise FileNotFoundError("FasterCap not found, set FASTERCAP")
+    if arguments is None:
+        arguments = default_options["fastercap_args"]
+    with tempfile.TemporaryDirectory() as work_dir:
+        deck_name = os.path.join(work_dir, "deck.qui")
+        with open(deck_name, 'w') as f:
+            f.write(deck)
+        output = run_solver([fastercap, "-b", deck_name] + list(arguments),
+            work_dir, timeout or default_options["timeout"])
+        return read_fastercap(output.stdout, names)
+
+# convert a layout, run the solvers and return the metrics as a dict with
+# frequency, L, R, Q and, if FasterCap is installed, C and SRF
+def solve_layout(gds_file, options=None):
+    opts = dict(default_options)
+    if options:
+        opts.update(options)
+    fasthenry = find_solver("fasthenry", opts["fasthenry"])
+    fastercap = find_solver("fastercap", opts["fastercap"])
+    if fasthenry is None:
+        raise FileNotFoundError("FastHenry2 not found, set FASTHENRY")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = Path(opts["work_dir"] or temp_dir)
+        stem = Path(gds_file).stem
+        result = gds2fastmodel.convert_fastmodel(str(gds_file), {
+            "fasthenry_name":str(work_dir / (stem + "out_fasthenry.inp")),
+            "fastercap_name":str(work_dir / (stem + "_out_fastercap.qui")),
+            "verbose":opts["verbose"],
+            "backend":opts["backend"]
+        })
+
+        run_solver([fasthenry, result["fasthenry"]["output_name"]], work_dir,
+            opts["timeout"])
+        metrics = impedance_metrics(read_zc(work_dir / "Zc.mat"),
+            opts["frequency"])
+
+        if fastercap is not None:
+            output = run_solver([fastercap, "-b",
+                result["fastercap"]["output_name"]] + opts["fastercap_args"],
+                work_dir, opts["timeout"])
+            c, names = read_fastercap(output.stdout, names=True)
+            metrics.update(capacitance_metrics(c, metrics["L"], names))
+    return metrics
+
+
+# ============= main ===============
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2:
+        options = {}
+        if len(sys.argv) >= 3:
+            options["frequency"] = float(sys.argv[2])
+        print(json.dumps(solve_layout(sys.argv[1], options)))
+    else:
+        print ("Usage: fastsolve.py [gds_file] [frequency]")
@@ -0,0 +1,216 @@
+# Copyright 2023 J.N.G.W. Verest
+# j.n.g.w.verest@tue.nl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Adaptive frequency sweep for FastHenry2
+# The deck of gds2fasthenry.py solves one point per decade from 1 MHz to
+# f_max, too few near the operating frequency and too many where R and L
+# are flat. adaptive_sweep starts with a coarse set of frequencies, solves
+# the midpoints of all intervals and compares them to the interpolation of
+# the points on both sides; only intervals where the interpolation is off by
+# more than the tolerance are split again. The result is the smallest set of
+# frequencies that describes the impedance to the tolerance.
+
+# CAVEATS:
+#   R and L = Im(Z)/w of every matrix element are interpolated linearly on a
+#   log frequency scale. A sharp feature between two points which agree with
+#   their midpoint is not found; the focus frequencies are always solved.
+#   FastHenry2 takes a single .freq card, so every frequency is a separate
+#   run of the deck; with "workers" > 1 they run in parallel. The solver
+#   cost is about linear in the number of frequencies either way.
+#
+#   Usage:
+#     python freq_sweep.py [gds_file] [tolerance]
+#   prints the frequencies, R and L of the first port, with "write" one
+#   deck per frequency is written as well.
+
+# File history:
+# Initial version
+
+
+import re
+import sys
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import gds2fasthenry
+import fastsolve
+
+
+
+# default sweep options
+default_options = {
+"fmin":1e6,          # lowest frequency in Hz
+"fmax":None,         # highest frequency in Hz, f_max of the deck if None
+"points":4,          # log spaced frequencies to start with, fmin and fmax included
+"focus":[10e9],      # frequencies that are always solved, if within range
+"tolerance":0.01,    # allowed relative error of the interpolated impedance
+"max_points":32,     # stop refining at this number of solved frequencies
+"min_ratio":1.05,    # do not split intervals narrower than this ratio
+"workers":1,         # parallel FastHenry2 runs
+"fasthenry":None,    # solver executable, see fastsolve.find_solver
+"write":False,       # write one deck per solved frequency
+"verbose":True       # print progress information
+}
+
+
+# ============= interpolation ===============
+
+# impedance at frequencies f_new from solved samples z [n, ports, ports],
+# with R and L interpolated linearly in log(f)
+def interpolate(frequencies, z, f_new):
+    x = np.log(frequencies)
+    x_new = np.log(f_new)
+    index = np.clip(np.searchsorted(x, x_new) - 1, 0, len(x) - 2)
+    t = ((x_new - x[index])/(x[index+1] - x[index]))[:, None, None]
+    r = z.real
+    l = z.imag/(2*np.pi*frequencies[:, None, None])
+    r_new = r[index]*(1 - t) + r[index+1]*t
+    l_new = l[index]*(1 - t) + l[index+1]*t
+    return r_new + 1j*2*np.pi*np.asarray(f_new)[:, None, None]*l_new
+
+# largest element error relative to the largest element, per frequency
+def relative_error(z_estimate, z):
+    scale = np.max(np.abs(z), axis=(1, 2))
+    return np.max(np.abs(z_estimate - z), axis=(1, 2))/np.where(scale > 0, scale, 1)
+
+
+# ============= adaptive sweep ===============
+
+# first set of frequencies: log spaced and the focus points
+def initial_frequencies(fmin, fmax, points, focus=()):
+    frequencies = list(np.logspace(np.log10(fmin), np.log10(fmax), max(points, 2)))
+    frequencies += [f for f in focus if fmin < f < fmax]
+    return np.unique(frequencies)
+
+# solve(frequencies) returns the impedance matrices [n, ports, ports]; returns
+# a dict with the solved frequencies and impedances in order, whether the
+# sweep converged and per refinement round the number of new points and the
+# largest error found
+def adaptive_sweep(solve, fmin, fmax, options=None):
+    opts = dict(default_options)
+    if options:
+        opts.update(options)
+    frequencies = initial_frequencies(fmin, fmax, opts["points"], opts["focus"])
+    z = np.asarray(solve(frequencies), dtype=complex)
+    rounds = []
+
+    # intervals still to check, as (low, high) frequency pairs
+    intervals = list(zip(frequencies[:-1], frequencies[1:]))
+    while intervals:
+        intervals = [(a, b) for a, b in intervals if b/a > opts["min_ratio"]]
+        room = opts["max_points"] - len(frequencies)
+        if not intervals or room <= 0:
+            break
+        # intervals beyond the point budget are checked first next round,
+        # or keep the sweep from converging
+        unchecked = intervals[room:]
+        intervals = intervals[:room]
+        midpoints = np.array([np.sqrt(a*b) for a, b in intervals])
+
+        z_mid = np.asarray(solve(midpoints), dtype=complex)
+        error = relative_error(interpolate(frequencies, z, midpoints), z_mid)
+        rounds.append({"points":len(midpoints), "max_error":float(error.max())})
+        if opts["verbose"]:
+            print("sweep: " + str(len(midpoints)) + " new points, max error "
+            + ('%.3g' % error.max()))
+
+        frequencies = np.concatenate([frequencies, midpoints])
+        z = np.concatenate([z, z_mid])
+        order = np.argsort(frequencies)
+        frequencies = frequencies[order]
+        z = z[order]
+
+        refined = []
+        for (a, b), f, e in zip(intervals, midpoints, error):
+            if e > opts["tolerance"]:
+                refined += [(a, f), (f, b)]
+        intervals = unchecked + refined
+
+    return {
+        "frequencies":frequencies,
+        "z":z,
+        "converged":not intervals,
+        "rounds":rounds
+    }
+
+
+# ============= FastHenry2 ===============
+
+# the deck with a single frequency in its .freq card
+def with_frequency(deck, frequency):
+    return re.sub(r"^\.freq .*\n", lambda m: gds2fasthenry.freq_card(frequency,
+        frequency), deck, count=1, flags=re.MULTILINE)
+
+# solve function for adaptive_sweep running FastHenry2 once per frequency
+def fasthenry_solver(deck, executable=None, workers=1):
+    def solve_one(frequency):
+        zc = fastsolve.run_fasthenry(with_frequency(deck, frequency), executable)
+        return zc[0][1]
+    def solve(frequencies):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return np.array(list(executor.map(solve_one, frequencies)))
+    return solve
+
+# one deck per frequency, named like the deck of gds2fasthenry.py with the
+# index of the frequency added
+def write_decks(deck, frequencies, stem):
+    names = []
+    for k, frequency in enumerate(frequencies):
+        name = stem + "out_fasthenry_" + str(k) + ".inp"
+        with open(name, 'w') as f:
+            f.write(with_frequency(deck, frequency))
+        names.append(name)
+    return names
+
+# convert a layout (or .npz model) and sweep it adaptively with FastHenry2;
+# returns the adaptive_sweep dict plus the deck and, with "write", the names
+# of the written decks
+def sweep_fasthenry(library_or_path, options=None):
+    opts = dict(default_options)
+    if options:
+        opts.update(options)
+    converted = gds2fasthenry.convert_fasthenry(library_or_path,
+        {"write":False, "verbose":False})
+    fmax = opts["fmax"] or converted["f_max"]
+
+    solve = fasthenry_solver(converted["deck"], opts["fasthenry"], opts["workers"])
+    result = adaptive_sweep(solve, opts["fmin"], fmax, opts)
+    result["deck"] = converted["deck"]
+    if opts["write"]:
+        if isinstance(library_or_path, (str, Path)):
+            stem = Path(library_or_path).stem
+        else:
+            stem = converted["cell"]
+        result["output_names"] = write_decks(converted["deck"],
+            result["frequencies"], stem)
+    return result
+
+
+# ============= main ===============
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2:
+        options = {}
+        if len(sys.argv) >= 3:
+            options["tolerance"] = float(sys.argv[2])
+        result = sweep_fasthenry(sys.argv[1], options)
+        for f, z in zip(result["frequencies"], result["z"]):
+            print(('%e' % f) + " R=" + ('%.4g' % z[0, 0].real)
+            + " L=" + ('%.4g' % (z[0, 0].imag/(2*np.pi*f))))
+        if not result["converged"]:
+            print("WARNING: not converged within max_points")
+    else:
+        print ("Usage: freq_sweep.py [gds_file] [tolerance]")
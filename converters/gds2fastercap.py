@@ -22,412 +22,358 @@
 #   name on purpose 5, there are no overlapping ports, port pairs are denoted
 #   by port_[port number][p/m]. This converter still a work in progress. 
 #   Currently, only single layer coils without center taps are supported.
+#   Patterned ground shields are written per finger group as one plate,
+#   conductor PGS, see deck_shield.
 
 # File history: 
 # Initial version 
 
 
-import gdspy
 import sys
+import io
 import numpy as np
 from pathlib import Path
 
+import gds_model
+import dbu_geometry
+import validate
+from sky130_stack import layerlist, default_stack, layernum2layername
 
 
-# SKY130 data
-
-# layers to be examined  
-layerlist = [
-67, # LI
-68, # M1
-69, # M2
-70, # M3
-71, # M4
-72  # M5
-]
-
-# list of purpose to evaluate
-purposelist = [
-16, # pin
-20, # drawing
-44, # via
-]
-
-# list of materialnames for each GDSII layer number
-layermapping_metal = {
-"67":"LI",
-"68":"Metal1",
-"69":"Metal2",
-"70":"Metal3",
-"71":"Metal4",
-"72":"Metal5"
-}
-layermapping_via = {
-"67":"Mcon",
-"68":"Via1",
-"69":"Via2",
-"70":"Via3",
-"71":"Via4"
-}
 
- # as found in [1]
-stack_bottom = {
-"67":"0.9361",
-"68":"1.3761",
-"69":"2.0061",
-"70":"2.7861",
-"71":"4.0211",
-"72":"5.3711"
+# default conversion options
+default_options = {
+"output_name":None, # deck file name, derived from the input name if None
+"write":True,       # write the deck to output_name
+"verbose":True,     # print progress information
+"backend":None,     # geometry backend, gdspy or gdstk, see gds_backend.py
+"validate":True,    # check the geometry first, see validate.py
+"workers":1,        # processes for the panels and the deck, None for all
+                    #   cores, see parallel_mesh.py
+"budget":None       # solver time/memory limits, see solver_cost.py
 }
 
- # as found in [1]
-stack_top = {
-"67":"1.0361",
-"68":"1.7361",
-"69":"2.3661",
-"70":"3.6311",
-"71":"4.8661",
-"72":"6.6311"
+# default mesh parameters, never changed: the budget mode of solver_cost.py
+# passes coarser copies to the deck writers
+default_mesh = {
+"via_boxes":False,  # one box per group of via pillars instead of every pillar
+"via_box_gap":1.0   # pillars closer than this (um) are one group
 }
 
-# unit resistivity of the substrate, as given by Tim Edwards. This is allegedly in a document, which is not cited. See this as a ball-park figure [3].
-rho_subs = 4400*2; # Ohm/square
+# ============= deck sections ===============
 
+# The deck is written as a sequence of sections, each one generated from a
+# part of the model only (see fastercap_sections), so unchanged sections can
+# be reused by incremental.py.
 
- # Equivalent resistivity calculated using rho = R*A/l, with parasitic
- # resistance found in [2], in [Ohm.um]
-layer_resistivities = {
-"67":"1.28e-12",
-"68":"4.50e-14",
-"69":"4.50e-14",
-"70":"3.97e-14",
-"71":"3.97e-14",
-"72":"3.59e-14"
-}
-
-# get layername/materialname from GDSII layer number 
-def layernum2layername (num, id):
-    if(id==16) or (id==20):
-        layername = layermapping_metal.get(str(num),"unknown")
-    if(id==44):
-        layername = layermapping_via.get(str(num),"unknown")
-    return layername
-    
-def outer_product_2d(A, B):
-    return A[0]*B[1]-A[1]*B[0]
-
-def in_triangle(pt, a, b, c):
-    d1 = outer_product_2d(a-pt, b-pt)
-    d2 = outer_product_2d(b-pt, c-pt)
-    d3 = outer_product_2d(c-pt, a-pt)
-    
-    has_neg = (d1 < 0) or (d2 < 0) or (d3 < 0)
-    has_pos = (d1 > 0) or (d2 > 0) or (d3 > 0)
-    
-    return not (has_neg and has_pos)
+def deck_text(model, text):
+    return text
 
-# recursive triangulation
-def triangulate(pts):
-    
-    end = len(pts)-1
-    
-    # take 1st pnt and assume 2nd
-    A = pts[0]
-    B = pts[1]
-    
-    # choose 3rd by min dist
-    rem_pnt = []
-
-    dist_1 = sum(pow(pts[2]-A,2) + pow(pts[2]-B,2))
-    dist_2 = sum(pow(pts[end]-A,2)+pow(pts[end]-B,2))
-    if dist_1 < dist_2:
-        C = pts[2]
-        rem_pnt = B
-    else:
-        C = pts[end]
-        rem_pnt = A  
-        
-    # check if points are inside
-    point_in_triangle = False
-    for point in pts:
-        if ( (point == A).any() and 
-         (point == B).any() and
-         (point == C).any() ):
-            in_triangle(point, A, B, C)
-            # print("point in triangle found!")
-            point_in_triangle = True
-    
-    # check if det < 0
-    if (outer_product_2d(B-A, C-A) < 0) or point_in_triangle:
-        #print("assumed wrongly")
-        # redo calculations
-        A = pts[end]
-        B = pts[0]
-
-        dist_1 = sum(pow(pts[1]-A,2) + pow(pts[1]-B,2))
-        dist_2 = sum(pow(pts[end-1]-A,2)+pow(pts[end-1]-B,2))
-
-        # check distances
-        if dist_1 < dist_2:
-            C = pts[1]
-            rem_pnt = B
-        else:
-            C = pts[end-1]
-            rem_pnt = A  
-    
-    triangle = [A, B, C]
-    
-    new_pts = []
-    for x in pts:
-        if not ((x == rem_pnt).all()):
-            new_pts.append(x)
-    return [new_pts, triangle]
-    
-# ============= main ===============
-
-if len(sys.argv) >= 2:
-    input_name = sys.argv[1]
-    print("Input file: ", input_name)
-    
-    output_name = Path(input_name).stem + "_out_fastercap.qui"
-    output_file = open(output_name, 'w')
-    
-    input_library = gdspy.GdsLibrary(infile=input_name)
-    
-    # evaluate only first top level cell
-    cell = input_library.top_level()[0]
-    print(cell)
-    
-    output_file.write("* " + str(cell) + '\n')
-    output_file.write("*    automatically generated using gds2FasterCap.py\n")
-    output_file.write("*    contact: j.n.g.w.verest@tue.nl\n")
-    
-    cell.flatten(single_layer=None, single_datatype=None, single_texttype=None)
-    
+def deck_header(model):
+    return ("* " + str(model["description"][()]) + '\n'
+    + "*    automatically generated using gds2FasterCap.py\n"
+    + "*    contact: j.n.g.w.verest@tue.nl\n"
     # default settings
-    output_file.write(".units uM\n\n")
-    
-    # find pins & labels
-    max_dimension = 0
-    ports = []
-    for layer_to_extract in layerlist:
-        print("Evaluating layer ", str(layer_to_extract))
-        curr_ports = cell.get_polygons(by_spec=True).get( (layer_to_extract, 16) )
-        
-        polys = cell.get_polygons()
-        flat_list = []
-        for xs in polys:
-            for x in xs:
-                flat_list.append(x)
-        max_dimension = np.sqrt(max(np.sum( np.square(flat_list), axis=1)))
-        
-        curr_labels = cell.get_labels()
-               
-        if (curr_ports != None) and (curr_labels != None):
-
-            # quick check whether num of pins == num of labels
-            if len(curr_ports) != len(curr_labels):
-                print("ERROR: unequal amount of ports & labels on " 
-                + str(layernum2layername(layer_to_extract, 16)))
-                break
-        
-            # append them to list
-            for poly in curr_ports:
-                mean_pos = np.mean(poly, axis=0)
-                
-                # find smallest distance label
-                mindist = 99999999
-                chosen_lab = None
-                for o in curr_labels:
-                    if mindist > sum(np.square( mean_pos - o.position )):
-                        mindist = sum(np.square( mean_pos - o.position ))
-                        chosen_lab = o
-
-                # store pins
-                print("Port-label pair found! \tPrt: " + str(mean_pos) + "\tLab: "
-                + str(chosen_lab.position))
-                ports.append( (chosen_lab.text, layer_to_extract, mean_pos) )
-
-
-
-
-    # find the paths
-    paths = cell.get_paths()
+    + ".units uM\n\n")
+
+# one face of path k: "TOP" or "BOTTOM", the triangulated outline, or
+# "SIDES", one quad per outline edge
+def deck_face(model, k, face, stack=default_stack):
+    layer = str(model["path_layer"][k])
+    name = str(layernum2layername(model["path_layer"][k],20))
+    top = str(stack["stack_top"].get(layer))
+    bottom = str(stack["stack_bottom"].get(layer))
+    lines = []
     
-
-
-    int_output_label = 0
-        
-    for path in paths:
-        
-        pts = path.get_polygons()[0]
-        coords = pts
-        
-        # create geometry
-        
-        # top side
-        output_file.write("\n* TOP " +str(layernum2layername(path.layers[0],20))+ "\n")
-        for i in range(len(coords)-2):
-            [coords, triangle] = triangulate(coords)
-            
-            # round all triangle points            
-            output_file.write("T B "
-            +str(round(triangle[0][0],3))+" "
-            +str(round(triangle[0][1],3))+" "
-            +str(stack_top.get(str(path.layers[0])))+" " 
-            +str(round(triangle[1][0],3))+" "
-            +str(round(triangle[1][1],3))+" "
-            +str(stack_top.get(str(path.layers[0])))+" " 
-            +str(round(triangle[2][0],3))+" "
-            +str(round(triangle[2][1],3))+" " 
-            +str(stack_top.get(str(path.layers[0])))
-            +"\n")
-        output_file.write("\n* BOTTOM " +str(layernum2layername(path.layers[0],20))+ "\n")
-        coords = pts    
-        for i in range(len(coords)-2):
-            [coords, triangle] = triangulate(coords)
-            
+    # top and bottom side, the triangulated outline
+    if face != "SIDES":
+        triangles = dbu_geometry.PointStore.from_model(model, "tri_xy", "tri_offsets")
+        z = top if face == "TOP" else bottom
+        lines.append("\n* " + face + " " + name + "\n")
+        for triangle in dbu_geometry.to_um(triangles[k],
+            dbu_geometry.model_unit(model)):
             # round all triangle points            
-            output_file.write("T B "
+            lines.append("T B "
             +str(round(triangle[0][0],3))+" "
             +str(round(triangle[0][1],3))+" "
-            +str(stack_bottom.get(str(path.layers[0])))+" " 
+            +z+" " 
             +str(round(triangle[1][0],3))+" "
             +str(round(triangle[1][1],3))+" "
-            +str(stack_bottom.get(str(path.layers[0])))+" " 
+            +z+" " 
             +str(round(triangle[2][0],3))+" "
             +str(round(triangle[2][1],3))+" " 
-            +str(stack_bottom.get(str(path.layers[0])))
+            +z
             +"\n")
-        output_file.write("\n* SIDES " +str(layernum2layername(path.layers[0],20))+ " (except for connections)\n")
+        return "".join(lines)
     
+    lines.append("\n* SIDES " + name + " (except for connections)\n")
     
-        # find port indices
-        
-        port_indices = []
-        
-        for port in ports:
-            min_dist1 = 99999999
-            min_dist2 = 99999999
-            ind1 = -1
-            ind2 = -1
-        
-            for i in range(0, len(pts)-1):
-                if (sum(pow(pts[i]-port[2],2)) < min_dist1):
-                    
-                    if (sum(pow(pts[ind1]-port[2],2)) < min_dist2):
-                        ind2 = ind1
-                        min_dist2 = sum(pow(pts[ind2]-port[2],2))
-                    ind1 = i
-                    min_dist1 = sum(pow(pts[i]-port[2],2))
-                else:
-                    if (sum(pow(pts[ind1]-port[2],2)) < min_dist1):
-                        ind2 = i
-                        min_dist2 = sum(pow(pts[i]-port[2],2))
-                        
-            port_indices.append([ind1, ind2])
-        
-        min_indices = []
-        for x in port_indices:
-            min_indices.append(min(x))
-    
-        for i in range(0, len(pts)-1):
-            if (i not in min_indices):
-                output_file.write("Q B " 
-                +str(round(pts[i][0],3))+" "
-                +str(round(pts[i][1],3))+" "
-                +str(stack_bottom.get(str(path.layers[0])))+" "
-                +str(round(pts[i+1][0],3))+" "
-                +str(round(pts[i+1][1],3))+" "
-                +str(stack_bottom.get(str(path.layers[0])))+" "
-                +str(round(pts[i+1][0],3))+" "
-                +str(round(pts[i+1][1],3))+" "
-                +str(stack_top.get(str(path.layers[0])))+" "
-                +str(round(pts[i][0],3))+" "
-                +str(round(pts[i][1],3))+" "
-                +str(stack_top.get(str(path.layers[0])))+"\n")
-            else:
-                output_file.write("Q " + str(ports[min_indices.index(i)][0]) + " "
-                +str(round(pts[i][0],3))+" "
-                +str(round(pts[i][1],3))+" "
-                +str(stack_bottom.get(str(path.layers[0])))+" "
-                +str(round(pts[i+1][0],3))+" "
-                +str(round(pts[i+1][1],3))+" "
-                +str(stack_bottom.get(str(path.layers[0])))+" "
-                +str(round(pts[i+1][0],3))+" "
-                +str(round(pts[i+1][1],3))+" "
-                +str(stack_top.get(str(path.layers[0])))+" "
-                +str(round(pts[i][0],3))+" "
-                +str(round(pts[i][1],3))+" "
-                +str(stack_top.get(str(path.layers[0])))+"\n")
-
-
-    # vias
-    # TODO: adding all individual vias is expensive; it creates unnecessary 
-    # polygons, a simple bounding box will also suffice.
-    output_file.write("\n VIAS "  
-    + str(layernum2layername(path.layers[0],44)) )    
-    polygons = cell.get_polygons(by_spec=True)
+    # one quad per outline edge, the edges closest to a port get its name
+    port_name = model["port_name"]
+    outlines = dbu_geometry.PointStore.from_model(model, "outline_xy", "outline_offsets")
+    pts = dbu_geometry.to_um(outlines[k], dbu_geometry.model_unit(model))
+    ports = model["side_port"][outlines.offsets[k]:outlines.offsets[k+1]]
+    for i in range(0, len(pts)-1):
+        if ports[i] < 0:
+            conductor = "B"
+        else:
+            conductor = str(port_name[ports[i]])
+        lines.append("Q " + conductor + " "
+        +str(round(pts[i][0],3))+" "
+        +str(round(pts[i][1],3))+" "
+        +bottom+" "
+        +str(round(pts[i+1][0],3))+" "
+        +str(round(pts[i+1][1],3))+" "
+        +bottom+" "
+        +str(round(pts[i+1][0],3))+" "
+        +str(round(pts[i+1][1],3))+" "
+        +top+" "
+        +str(round(pts[i][0],3))+" "
+        +str(round(pts[i][1],3))+" "
+        +top+"\n")
+    return "".join(lines)
+
+faces = ("TOP", "BOTTOM", "SIDES")
+
+# top, bottom and side panels of path k
+def deck_path(model, k, stack=default_stack):
+    return "".join(deck_face(model, k, face, stack) for face in faces)
+
+# conductor name of the patterned ground shields
+shield_conductor = "PGS"
+
+# one finger group of a patterned ground shield, as a solid plate of the
+# hull of the fingers (see gds_model.extract_shields): at the finger pitch
+# of a fraction of a micrometer it shields like one; top and bottom as a
+# fan of triangles, one quad per hull edge as sides
+def deck_shield(model, s, stack=default_stack):
+    layer = str(model["shield_layer"][s])
+    name = str(layernum2layername(model["shield_layer"][s],20))
+    top = str(stack["stack_top"].get(layer))
+    bottom = str(stack["stack_bottom"].get(layer))
+    hulls = dbu_geometry.PointStore.from_model(model, "shield_xy", "shield_offsets")
+    hull = [(str(round(x,3)), str(round(y,3)))
+        for x, y in dbu_geometry.to_um(hulls[s], dbu_geometry.model_unit(model))]
+    lines = ["\n* SHIELD " + name + " (" + str(model["shield_fingers"][s])
+        + " fingers, fill " + ('%.2f' % model["shield_fill"][s]) + ")\n"]
+    for z in (top, bottom):
+        for i in range(1, len(hull)-1):
+            lines.append("T " + shield_conductor + " "
+            + " ".join(" ".join(hull[k]) + " " + z for k in (0, i, i+1))
+            + "\n")
+    for i in range(len(hull)):
+        a = hull[i-1]
+        b = hull[i]
+        lines.append("Q " + shield_conductor + " "
+        + a[0]+" "+a[1]+" "+bottom+" "
+        + b[0]+" "+b[1]+" "+bottom+" "
+        + b[0]+" "+b[1]+" "+top+" "
+        + a[0]+" "+a[1]+" "+top+"\n")
+    return "".join(lines)
+
+# vias, every pillar or one box per group of pillars (mesh["via_boxes"])
+def deck_via_header(model):
+    return ("\n VIAS "  
+    + str(layernum2layername(model["path_layer"][-1],44)) )
+
+# side panels of via pillar v
+def deck_via(model, v, stack=default_stack):
+    pillars = dbu_geometry.PointStore.from_model(model, "via_xy", "via_offsets")
+    via_pillar = dbu_geometry.to_um(pillars[v], dbu_geometry.model_unit(model))
+    layer = model["via_layer"][v]
+    bottom = str(stack["stack_bottom"].get(str(layer+1)))
+    top = str(stack["stack_top"].get(str(layer)))
+    lines = []
+    for i in range(len(via_pillar)):
+        lines.append("Q B "
+        +str(round(via_pillar[i-1][0],3))+" "
+        +str(round(via_pillar[i-1][1],3))+" "
+        +bottom+" "
+        +str(round(via_pillar[i][0],3))+" "
+        +str(round(via_pillar[i][1],3))+" "
+        +bottom+" "
+        +str(round(via_pillar[i][0],3))+" "
+        +str(round(via_pillar[i][1],3))+" "
+        +top+" "
+        +str(round(via_pillar[i-1][0],3))+" "
+        +str(round(via_pillar[i-1][1],3))+" "
+        +top+"\n")
+    return "".join(lines)
+
+# groups of via pillars on the same layer whose bounding boxes are less
+# than gap apart, as (layer, (x1, y1, x2, y2)) in the order of their first
+# pillar; neighbours are looked up on a grid of the largest pillar size
+def via_groups(model, gap):
+    offsets = model["via_offsets"]
+    layers = model["via_layer"]
+    if len(layers) == 0:
+        return []
+    xy = dbu_geometry.to_um(model["via_xy"], dbu_geometry.model_unit(model))
+    lower = np.minimum.reduceat(xy, offsets[:-1], axis=0)
+    upper = np.maximum.reduceat(xy, offsets[:-1], axis=0)
+    cell = float(np.max(upper - lower)) + gap
+    keys = np.floor(lower/cell).astype(np.int64)
+
+    parent = list(range(len(layers)))
+    def root(v):
+        while parent[v] != v:
+            parent[v] = parent[parent[v]]
+            v = parent[v]
+        return v
+    grid = {}
+    for v in range(len(layers)):
+        key = (int(layers[v]), int(keys[v, 0]), int(keys[v, 1]))
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for w in grid.get((key[0], key[1]+dx, key[2]+dy), ()):
+                    if (np.all(lower[v] <= upper[w] + gap)
+                        and np.all(lower[w] <= upper[v] + gap)):
+                        parent[root(w)] = root(v)
+        grid.setdefault(key, []).append(v)
+
+    groups = {}
+    for v in range(len(layers)):
+        groups.setdefault(root(v), []).append(v)
+    boxes = []
+    for members in sorted(groups.values()):
+        boxes.append((int(layers[members[0]]),
+            tuple(float(x) for x in np.concatenate([lower[members].min(axis=0),
+            upper[members].max(axis=0)]))))
+    return boxes
+
+# side panels of the box around a group of via pillars, see via_groups
+def deck_via_box(model, layer, box, stack=default_stack):
+    x1, y1, x2, y2 = [str(round(x, 3)) for x in box]
+    bottom = str(stack["stack_bottom"].get(str(layer+1)))
+    top = str(stack["stack_top"].get(str(layer)))
+    corners = [(x1, y1), (x2, y1), (x2, y2), (x1, y2)]
+    lines = []
+    for i in range(len(corners)):
+        a = corners[i-1]
+        b = corners[i]
+        lines.append("Q B "
+        + a[0]+" "+a[1]+" "+bottom+" "
+        + b[0]+" "+b[1]+" "+bottom+" "
+        + b[0]+" "+b[1]+" "+top+" "
+        + a[0]+" "+a[1]+" "+top+"\n")
+    return "".join(lines)
+
+# stack, the dielectric box around the geometry
+def deck_dielectric(model):
+    # maximum length in any direction
+    md = 2*round(model["max_dimension"][()], -1)
+    md = str(md)
     
-    for layer in layerlist:
-        vias_layer = polygons.get( (layer, 44) )
-        if vias_layer is None:
-            continue
-        for via_pillar in vias_layer:
-            if via_pillar is None:
-                continue
-            for i in range(len(via_pillar)):
-                if i is None:
-                    continue
-                                    
-                output_file.write("Q B "
-                +str(round(via_pillar[i-1][0],3))+" "
-                +str(round(via_pillar[i-1][1],3))+" "
-                +str(stack_bottom.get(str(layer+1)))+" "
-                +str(round(via_pillar[i][0],3))+" "
-                +str(round(via_pillar[i][1],3))+" "
-                +str(stack_bottom.get(str(layer+1)))+" "
-                +str(round(via_pillar[i][0],3))+" "
-                +str(round(via_pillar[i][1],3))+" "
-                +str(stack_top.get(str(layer)))+" "
-                +str(round(via_pillar[i-1][0],3))+" "
-                +str(round(via_pillar[i-1][1],3))+" "
-                +str(stack_top.get(str(layer)))+"\n")
+    text = "D SiO2 1 3.9 0 0 0 0 0 100\n"
     
+    # dielectric file
+    text += "\nEND\n\n* dielectric geometry\n"
+    text += "FILE SiO2\n"
+    text += "Q cube -"+md+" -"+md+" 0       "+md+" -"+md+" 0       "+md+" -"+md+" 11.8834 -"+md+" -"+md+" 11.8834 \n"
+    text += "Q cube  "+md+"  "+md+" 0       "+md+"  "+md+" 0       "+md+"  "+md+" 11.8834  "+md+" -"+md+" 11.8834 \n"
+    text += "Q cube  "+md+"  "+md+" 0      -"+md+"  "+md+" 0      -"+md+"  "+md+" 11.8834  "+md+"  "+md+" 11.8834 \n"
+    text += "Q cube -"+md+"  "+md+" 0      -"+md+" -"+md+" 0      -"+md+" -"+md+" 11.8834 -"+md+"  "+md+" 11.8834 \n"
+    text += "Q cube -"+md+" -"+md+" 0       "+md+" -"+md+" 0       "+md+"  "+md+" 0       -"+md+"  "+md+" 0 \n"
+    text += "Q cube -"+md+" -"+md+" 11.8834 "+md+" -"+md+" 11.8834 "+md+"  "+md+" 11.8834 -"+md+"  "+md+" 11.8834 \n"
     
+    text += "END"
+    return text
+
+# the sections of the deck in order, as (name, function, arguments); the
+# deck is the concatenation of function(model, *arguments). The stack is
+# the last argument of the sections that depend on it
+def fastercap_sections(model, stack=default_stack, mesh=default_mesh):
+    sections = [("header", deck_header, ())]
+    sections += [(("path", k), deck_path, (k, stack))
+        for k in range(len(model["path_layer"]))]
+    sections += [(("shield", s), deck_shield, (s, stack))
+        for s in range(len(model["shield_layer"]))]
+    sections.append(("vias", deck_via_header, ()))
+    if mesh["via_boxes"]:
+        sections += [(("via_box", g), deck_via_box, tuple(group) + (stack,))
+            for g, group in enumerate(via_groups(model, mesh["via_box_gap"]))]
+    else:
+        sections += [(("via", v), deck_via, (v, stack))
+            for v in range(len(model["via_layer"]))]
+    sections.append(("dielectric", deck_dielectric, ()))
+    return sections
+
+# write the FasterCap deck of a geometry model with panels (see gds_model.py)
+# to an open text file with a mesh
+def write_fastercap(model, output_file, mesh=default_mesh):
+    for name, function, arguments in fastercap_sections(model, mesh=mesh):
+        output_file.write(function(model, *arguments))
+
+
+# ============= conversion ===============
+
+# convert a layout, or a stored geometry model (.npz) with panels, to a
+# FasterCap deck; returns a dict with the deck text, the name of the written
+# file (None if not written) and the ports
+def convert_fastercap(library_or_path, options=None):
+    opts = dict(default_options)
+    if options:
+        opts.update(options)
+    verbose = opts["verbose"]
     
-
-    # stack
-    polys = cell.get_polygons()
-    flat_list = []
-    for xs in polys:
-        for x in xs:
-            flat_list.append(x)
-    # maximum length in any direction
-    md = np.sqrt(max(np.sum( np.square(flat_list), axis=1)))
-    md = 2*round(md, -1)
-    md = str(md)
+    if verbose and isinstance(library_or_path, (str, Path)):
+        print("Input file: ", library_or_path)
     
-    output_file.write("D SiO2 1 3.9 0 0 0 0 0 100\n")
+    # the flattened copy is extracted, a library passed in is left untouched
+    model = gds_model.get_model(library_or_path, opts["backend"], layerlist,
+        panels=False, verbose=verbose)
+    if opts["validate"]:
+        validate.require_valid(model, "fastercap", verbose)
+    if opts["workers"] != 1:
+        import parallel_mesh
+    if not bool(model["has_panels"]):
+        if opts["workers"] != 1:
+            parallel_mesh.add_panels(model, opts["workers"])
+        else:
+            gds_model.add_panels(model)
     
-    # dielectric file
-    output_file.write("\nEND\n\n* dielectric geometry\n")
-    output_file.write("FILE SiO2\n")
-    output_file.write("Q cube -"+md+" -"+md+" 0       "+md+" -"+md+" 0       "+md+" -"+md+" 11.8834 -"+md+" -"+md+" 11.8834 \n")
-    output_file.write("Q cube  "+md+"  "+md+" 0       "+md+"  "+md+" 0       "+md+"  "+md+" 11.8834  "+md+" -"+md+" 11.8834 \n")
-    output_file.write("Q cube  "+md+"  "+md+" 0      -"+md+"  "+md+" 0      -"+md+"  "+md+" 11.8834  "+md+"  "+md+" 11.8834 \n")
-    output_file.write("Q cube -"+md+"  "+md+" 0      -"+md+" -"+md+" 0      -"+md+" -"+md+" 11.8834 -"+md+"  "+md+" 11.8834 \n")
-    output_file.write("Q cube -"+md+" -"+md+" 0       "+md+" -"+md+" 0       "+md+"  "+md+" 0       -"+md+"  "+md+" 0 \n")
-    output_file.write("Q cube -"+md+" -"+md+" 11.8834 "+md+" -"+md+" 11.8834 "+md+"  "+md+" 11.8834 -"+md+"  "+md+" 11.8834 \n")
+    output_name = opts["output_name"]
+    if output_name is None:
+        if isinstance(library_or_path, (str, Path)):
+            output_name = Path(library_or_path).stem + "_out_fastercap.qui"
+        else:
+            output_name = str(model["cell_name"][()]) + "_out_fastercap.qui"
     
-    output_file.write("END")
+    output_file = io.StringIO()
+    if opts["workers"] != 1:
+        parallel_mesh.write_fastercap(model, output_file, opts["workers"])
+    else:
+        write_fastercap(model, output_file)
+    deck = output_file.getvalue()
     output_file.close()
+    cost = None
+    if opts["budget"] is not None:
+        import solver_cost
+        deck, cost = solver_cost.fit_budget("fastercap", model, deck,
+            opts["budget"], verbose)
+    
+    if opts["write"]:
+        with open(output_name, 'w') as f:
+            f.write(deck)
+    else:
+        output_name = None
     
-else:
-    print ("Usage: gds2FasterCap.py [gds_file]")
+    ports = [(port.name, port.layer, np.array(port.xy))
+        for port in dbu_geometry.model_ports(model)]
+    return {
+        "cell":str(model["cell_name"][()]),
+        "deck":deck,
+        "output_name":output_name,
+        "ports":ports,
+        "cost":cost,
+        "model":model
+    }
 
+# ============= main ===============
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2:
+        convert_fastercap(sys.argv[1])
+    else:
+        print ("Usage: gds2FasterCap.py [gds_file]")
 
-# References:
-# [1]   https://skywater-pdk.readthedocs.io/en/main/rules/assumptions.html#process-stack-diagram
-# [2]   https://skywater-pdk.readthedocs.io/en/main/rules/rcx.html#resistance-values, in “SKY130 Stackup Capacitance Data” spreadsheet.
-# [3] https://open-source-silicon.slack.com/archives/C016HUV935L/p1704550228823649?thread_ts=1704545442.597049&cid=C016HUV935L
@@ -30,348 +30,399 @@
 # Initial version 
 
 
-import gdspy
 import sys
+import io
 import numpy as np
 from pathlib import Path
 
+import gds_model
+import dbu_geometry
+import validate
+from sky130_stack import layerlist, default_stack, layernum2layername
 
 
-# SKY130 data
-
-# layers to be examined  
-layerlist = [
-67, # LI
-68, # M1
-69, # M2
-70, # M3
-71, # M4
-72  # M5
-]
-
-# list of purpose to evaluate
-purposelist = [
-16, # pin
-20, # drawing
-44, # via
-]
-
-# list of materialnames for each GDSII layer number
-layermapping_metal = {
-"67":"LI",
-"68":"Metal1",
-"69":"Metal2",
-"70":"Metal3",
-"71":"Metal4",
-"72":"Metal5"
-}
-layermapping_via = {
-"67":"Mcon",
-"68":"Via1",
-"69":"Via2",
-"70":"Via3",
-"71":"Via4"
-}
 
- # as found in [1], center value chosen
-stack_heights = {
-"67":"0.9736",
-"68":"1.5561",
-"69":"2.1861",
-"70":"3.2086",
-"71":"4.4436",
-"72":"6.0011"
+# default conversion options
+default_options = {
+"output_name":None, # deck file name, derived from the input name if None
+"write":True,       # write the deck to output_name
+"verbose":True,     # print progress information
+"backend":None,     # geometry backend, gdspy or gdstk, see gds_backend.py
+"validate":True,    # check the geometry first, see validate.py
+"budget":None       # solver time/memory limits, see solver_cost.py
 }
 
- # as found in [1]
-layer_heights = {
-"67":"0.1",
-"68":"0.36",
-"69":"0.36",
-"70":"0.845",
-"71":"0.845",
-"72":"1.26"
+# default mesh parameters, never changed: the budget mode of solver_cost.py
+# passes coarser copies to the deck writers
+default_mesh = {
+"nwinc":20,            # filaments across the width of a path segment
+"substrate_length":20, # um of total path length per substrate segment
+"shield_strips":8      # strips per finger direction of a ground shield group
 }
 
-# unit resistivity of the substrate, as given by Tim Edwards. This is allegedly in a document, which is not cited. See this as a ball-park figure [3].
-rho_subs = 4400; # Ohm/square
+# ============= deck sections ===============
 
+# The deck is written as a sequence of sections, each one generated from a
+# part of the model only (see fasthenry_sections), so unchanged sections can
+# be reused by incremental.py.
 
- # Equivalent resistivity calculated using rho = R*A/l, with parasitic
- # resistance found in [2], in [Ohm.um]
-layer_resistivities = {
-"67":"1.28",
-"68":"4.50e-2",
-"69":"4.50e-2",
-"70":"3.97e-2",
-"71":"3.97e-2",
-"72":"3.59e-2"
-}
-
-via_resistivities = {
-"68":0.375,
-"69":0.325,
-"70":0.35,
-"71":0.482
-}
+def deck_text(model, text):
+    return text
 
-via_widths = {
-"68":0.15,
-"69":0.2,
-"70":.2,
-"71":0.8
-}
+def deck_header(model):
+    return ("* " + str(model["description"][()]) + '\n'
+    + "*    automatically generated using gds2FastModel.py\n"
+    + "*    contact: j.n.g.w.verest@tue.nl\n"
+    # default settings
+    + ".units uM\n\n")
 
-# get layername/materialname from GDSII layer number 
-def layernum2layername (num, id):
-    if(id==16) or (id==20):
-        layername = layermapping_metal.get(str(num),"unknown")
-    if(id==44):
-        layername = layermapping_via.get(str(num),"unknown")
-    return layername
+# name of node index, "N" and the index unless the model names its nodes
+# itself, as the tiles of tiled.py do
+def node_name(model, index):
+    if "node_name" in model and index >= 0:
+        return str(model["node_name"][index])
+    return "N" + str(index)
 
-# ============= main ===============
+# nodes of path k
+def deck_points(model, k, stack=default_stack):
+    nodes = dbu_geometry.model_nodes(model)
+    first = int(nodes.offsets[k])
+    z = str(stack["stack_heights"].get(str(model["path_layer"][k])))
+    lines = []
+    unit = dbu_geometry.model_unit(model)
+    for index, (x, y) in enumerate(dbu_geometry.to_um(nodes[k], unit), first):
+        lines.append(node_name(model, index)
+        + " x=" + str(round(x, 3))
+        + " y=" + str(round(y, 3))
+        + " z=" + z
+        + "\n")
+    return "".join(lines)
 
-if len(sys.argv) >= 2:
-    input_name = sys.argv[1]
-    print("Input file: ", input_name)
-    
-    output_name = Path(input_name).stem + "out_fasthenry.inp"
-    output_file = open(output_name, 'w')
-    
-    input_library = gdspy.GdsLibrary(infile=input_name)
-    
-    # evaluate only first top level cell
-    cell = input_library.top_level()[0] 
-    
-    output_file.write("* " + str(cell) + '\n')
-    output_file.write("*    automatically generated using gds2FastModel.py\n")
-    output_file.write("*    contact: j.n.g.w.verest@tue.nl\n")
-    
-    cell.flatten(single_layer=None, single_datatype=None, single_texttype=None)
-    
-    # default settings
-    output_file.write(".units uM\n\n")
-    
-    # find pins & labels
-    max_dimension = 0
-    ports = []
-    for layer_to_extract in layerlist:
-        curr_ports = cell.get_polygons(by_spec=True).get( (layer_to_extract, 16) )
-        
-        polys = cell.get_polygons()
-        flat_list = []
-        for xs in polys:
-            for x in xs:
-                flat_list.append(x)
-        max_dimension = np.sqrt(max(np.sum( np.square(flat_list), axis=1)))
-        
-        
-        curr_labels = cell.get_labels()
-        
-        if (curr_ports != None) and (curr_labels != None):
-
-            # quick check whether num of pins == num of labels
-            if len(curr_ports) != len(curr_labels):
-                print("ERROR: unequal amount of ports & labels on " 
-                + str(layernum2layername(layer_to_extract, 16)))
-                break
-        
-            # append them to list
-            for poly in curr_ports:
-                mean_pos = np.mean(poly, axis=0)
-                
-                # find smallest distance label
-                mindist = 99999999
-                chosen_lab = None
-                for o in curr_labels:
-                    if mindist > sum(np.square( mean_pos - o.position )):
-                        mindist = sum(np.square( mean_pos - o.position ))
-                        chosen_lab = o
-
-                # store pins
-                ports.append( (chosen_lab.text, layer_to_extract, mean_pos) )
-    
-    
-    
-    # find the paths
-    paths = cell.get_paths()
-    
-    
-    index = 0
-    # define nodes
-    output_file.write("\n* POINTS \n")
-    for path in paths:
-        for pth in range(0,len(path.points)):
-            output_file.write("N" + str(index)
-            + " x=" + str(round(path.points[pth][0], 3))
-            + " y=" + str(round(path.points[pth][1], 3))
-            + " z=" + str(stack_heights.get(str(path.layers[0])))
-            + "\n")
-            index += 1
-    
-    
+def deck_ports(model):
+    node_xy = dbu_geometry.to_um(model["node_xy"], dbu_geometry.model_unit(model))
     chosen_node_a = -1
     chosen_node_b = -1
-    # define ports
-    output_file.write("\n* PORTS\n")
-    for i in range(0,len(ports)):        
+    for i, port in enumerate(dbu_geometry.model_ports(model)):
         # find for all ports the closest node
-        mindist = 9999999
         # TODO: change this to depend on attached label
-        index = 0
-        for path in paths:
-            for num in range(0,len(path.points)):            
-                if (mindist > sum(np.square( ports[i][2] - path.points[num] ))):
-                    mindist = sum(np.square( ports[i][2] - path.points[num] ))
-                    if i%2 == 0:
-                        chosen_node_a = index
-                    else:
-                        chosen_node_b = index
-                index+=1
+        port_xy = port.xy
+        d = np.square(port_xy[0] - node_xy[:, 0]) + np.square(port_xy[1] - node_xy[:, 1])
+        if len(d) and (d.min() < 9999999):
+            if i%2 == 0:
+                chosen_node_a = int(np.argmin(d))
+            else:
+                chosen_node_b = int(np.argmin(d))
         
-    output_file.write( ".external N" + str(chosen_node_a) 
-    + " N" + str(chosen_node_b) + " 1\n")
-   
-    # make connections
-    index = 0
-    for path in paths:
-        output_file.write("\n* EDGES PATH["+ str(paths.index(path)) +"] \n")
-        for i in range(0,len(path.points)-1):
-            output_file.write("E" + str(index)
-            + " N"      + str(index)
-            + " N"      + str(index+1)
-            + " w="     + str(round(path.widths[i][0],3))
-            + " h="     + str(layer_heights.get(str(path.layers[0])))    
-            + " rho="   + str(layer_resistivities.get(str(path.layers[0])))
-            + " nwinc=" + str(20)  
-            + "\n")
-            index+=1
-        index+=1
+    return ( ".external " + node_name(model, chosen_node_a)
+    + " " + node_name(model, chosen_node_b) + " 1\n")
+
+# segments of path k
+def deck_edges(model, k, stack=default_stack, mesh=default_mesh):
+    h = str(stack["layer_heights"].get(str(model["path_layer"][k])))
+    rho = str(stack["layer_resistivities"].get(str(model["path_layer"][k])))
+    lines = ["\n* EDGES PATH["+ str(k) +"] \n"]
+    for segment in dbu_geometry.path_segments(model, k):
+        index = int(segment.first)
+        lines.append("E" + node_name(model, index)[1:]
+        + " "       + node_name(model, index)
+        + " "       + node_name(model, index+1)
+        + " w="     + str(round(segment.width,3))
+        + " h="     + h    
+        + " rho="   + rho
+        + " nwinc=" + str(mesh["nwinc"])
+        + "\n")
+    return "".join(lines)
+
+# name of via cluster c between path i and j, the path numbers unless the
+# model names its clusters
+def cluster_name(model, c, i, j):
+    if "cluster_name" in model:
+        return str(model["cluster_name"][c])
+    return str(i)+str(j)
+
+# via cluster c, one cluster of via pillars between the closest path ends of
+# two paths on adjacent layers, see gds_model.extract_clusters
+def deck_via(model, c, stack=default_stack):
+    offsets = model["path_offsets"]
+    path_layer = model["path_layer"]
+    cluster = dbu_geometry.via_cluster(model, c)
+    i, j = cluster.paths
+    index_1, index_2 = cluster.ends
+    num_via_pillars = cluster.count
+    via_layer = cluster.layer
+    cluster_mean = cluster.center
     
-    # via connections
-        # find via group -> assume len(paths)-1 via clusters? (alternative is K-means)
-            # 1. look for path ends between adjacent layers
-            # 2. bounding box around
-    output_file.write("\n* VIAS\n")
-    for i in range(len(paths)):
-        
-        for j in range(i+1, len(paths)):
-            if (abs(paths[i].layers[0] - paths[j].layers[0]) == 1):
-                min_dist = 99999
-                index_1 = -99
-                index_2 = -99
-                for x in range(2):
-                    for y in range(2):
-                        d = sum(pow(paths[i].points[-x]-paths[j].points[-y],2))
-                        if (d < min_dist):
-                            index_1 = -x # either 0 or -1 (start or end)
-                            index_2 = -y
-                            min_dist = d
-                
-                # bounds are in 
-                    # min(x1, x2)-w  <= x <= max(x1, x2) + w
-                    # min(y1, y2)-w  <= y <= max(y1, y2) + w
-                width = max(paths[i].widths[index_1], paths[j].widths[index_2])
-                lb_x = min(paths[i].points[index_1][0], paths[j].points[index_2][0])-width/2
-                ub_x = max(paths[i].points[index_1][0], paths[j].points[index_2][0])+width/2
-                lb_y = min(paths[i].points[index_1][1], paths[j].points[index_2][1])-width/2
-                ub_y = max(paths[i].points[index_1][1], paths[j].points[index_2][1])+width/2
-                
-                vias = cell.get_polygons(by_spec=True).get( (min(paths[i].layers[0], paths[j].layers[0]), 44) )
-                                
-                if not vias:
-                    print("WARNING: no vias connecting two adjacent layers.")
-                else:
-                    num_via_pillars = 0
-                    cluster_sum = 0
-                    for via_under_inspection in vias:
-                        mean = sum(via_under_inspection)/4
-                        
-                        if ((mean[0] >= lb_x) 
-                        and (mean[0] <= ub_x)
-                        and (mean[1] >= lb_y)
-                        and (mean[1] <= ub_y) ):
-                            num_via_pillars += 1
-                            cluster_sum += mean
-                    
-                    cluster_mean = cluster_sum / num_via_pillars
-                    via_layer = min(paths[i].layers[0],paths[j].layers[0])
-                    
-                    output_file.write("N0_via" + str(i)+str(j)+
-                    " x=" + str(round(cluster_mean[0], 3)) + 
-                    " y=" + str(round(cluster_mean[1], 3)) + 
-                    " z=" + str(stack_heights.get(str(paths[i].layers[0]))) + "\n"
-                    )
-                    output_file.write("N1_via" + str(i)+str(j)+
-                    " x=" + str(round(cluster_mean[0], 3)) + 
-                    " y=" + str(round(cluster_mean[1], 3)) + 
-                    " z=" + str(stack_heights.get(str(paths[j].layers[0]))) + "\n"
-                    )
-                
-                    output_file.write("E_via" + str(i)+str(j)+
-                    " N0_via" + str(i)+str(j)+
-                    " N1_via" + str(i)+str(j)+
-                    " w=" + str(1) + 
-                    " h=" + str(1) + 
-                    " rho=" + str(via_resistivities.get(str(via_layer))/num_via_pillars) + 
-                    " nwinc=1 nhinc=1 \n")
-                   
-                   
-                    i_pt_1 = -(len(paths[i].points)-1)*index_1
-                    for ind in range(i):
-                        i_pt_1 += len(paths[ind].points)
-                    i_pt_2 = -(len(paths[j].points)-1)*index_2
-                    for ind in range(j):
-                        i_pt_2 += len(paths[ind].points)
-                    
-                    output_file.write(".equiv N0_via"+str(i)+str(j)+" N"+str(i_pt_1)+"\n")
-                    output_file.write(".equiv N1_via"+str(i)+str(j)+" N"+str(i_pt_2)+"\n")
-        
-   
-    # simulation settings
-    total_length = 0
-    for path in paths:
-        for i in range(0,len(path.points)-1):
-            curr_point = path.points[i]
-            next_point = path.points[i+1]
-            
-            total_length += np.sqrt( sum(pow(curr_point-next_point,2) ))
+    if num_via_pillars < 0:
+        print("WARNING: no vias connecting two adjacent layers.")
+        return ""
+    if num_via_pillars == 0:
+        raise ZeroDivisionError("no via pillars between path "
+        + str(i) + " and path " + str(j))
     
+    name = cluster_name(model, c, i, j)
+    text = ("N0_via" + name +
+    " x=" + str(round(cluster_mean[0], 3)) + 
+    " y=" + str(round(cluster_mean[1], 3)) + 
+    " z=" + str(stack["stack_heights"].get(str(path_layer[i]))) + "\n"
+    )
+    text += ("N1_via" + name +
+    " x=" + str(round(cluster_mean[0], 3)) + 
+    " y=" + str(round(cluster_mean[1], 3)) + 
+    " z=" + str(stack["stack_heights"].get(str(path_layer[j]))) + "\n"
+    )
+
+    text += ("E_via" + name +
+    " N0_via" + name +
+    " N1_via" + name +
+    " w=" + str(1) + 
+    " h=" + str(1) + 
+    " rho=" + str(stack["via_resistivities"].get(str(via_layer))/num_via_pillars) + 
+    " nwinc=1 nhinc=1 \n")
+   
+    # path start or end node
+    i_pt_1 = -(offsets[i+1]-offsets[i]-1)*index_1 + offsets[i]
+    i_pt_2 = -(offsets[j+1]-offsets[j]-1)*index_2 + offsets[j]
     
+    text += ".equiv N0_via"+name+" "+node_name(model, i_pt_1)+"\n"
+    text += ".equiv N1_via"+name+" "+node_name(model, i_pt_2)+"\n"
+    return text
+
+# name of shield group s, the group number unless the model names its
+# shields, as the tiles of tiled.py do
+def shield_name(model, s):
+    if "shield_name" in model:
+        return str(model["shield_name"][s])
+    return str(s)
+
+# the part of the line where coordinate 1-axis equals position that lies
+# within a convex hull, as [start, end] along axis
+def hull_chord(hull, axis, position):
+    a = hull
+    b = np.roll(hull, -1, axis=0)
+    across = 1 - axis
+    hit = ((np.minimum(a[:, across], b[:, across]) <= position)
+        & (np.maximum(a[:, across], b[:, across]) >= position)
+        & (a[:, across] != b[:, across]))
+    t = (position - a[hit, across])/(b[hit, across] - a[hit, across])
+    ends = a[hit, axis] + t*(b[hit, axis] - a[hit, axis])
+    return [ends.min(), ends.max()]
+
+# one finger group of a patterned ground shield (see gds_model.
+# extract_shields) as grouped filaments: the fingers along x and the ones
+# along y become at most mesh["shield_strips"] parallel strips each, cut to
+# the hull at evenly spaced positions, which together have the metal area of the
+# fingers (the fill of the hull). One end of every strip, the one towards
+# the shield center, is tied to the ground node of the group. Like the
+# slotted shield the strips form no loops, so they only carry the eddy
+# currents within a finger, with one filament per strip.
+def deck_shield(model, s, stack=default_stack, mesh=default_mesh):
+    hulls = dbu_geometry.PointStore.from_model(model, "shield_xy", "shield_offsets")
+    hull = hulls[s]
+    layer = str(model["shield_layer"][s])
+    z = str(stack["stack_heights"].get(layer))
+    h = str(stack["layer_heights"].get(layer))
+    rho = str(stack["layer_resistivities"].get(layer))
+    fingers = int(model["shield_fingers"][s])
+    along_x = int(model["shield_fingers_x"][s])
+    unit = dbu_geometry.model_unit(model)
+    metal = (float(model["shield_fill"][s])*abs(int(dbu_geometry.area2(hull)))/2
+        *unit**2)
+    hull = dbu_geometry.to_um(hull, unit)
+    lower = hull.min(axis=0)
+    upper = hull.max(axis=0)
+
+    # center of all groups of the shield on this layer
+    same_layer = np.flatnonzero(model["shield_layer"] == model["shield_layer"][s])
+    points = np.concatenate([hulls[g] for g in same_layer])
+    center = dbu_geometry.to_um(points.min(axis=0) + points.max(axis=0), unit)/2
+
+    name = shield_name(model, s)
+    lines = ["\n* SHIELD " + str(layernum2layername(model["shield_layer"][s],20))
+        + " (" + str(fingers) + " fingers, fill "
+        + ('%.2f' % model["shield_fill"][s]) + ")\n"]
+    edges = []
+    strip = 0
+    for axis, count in ((0, along_x), (1, fingers - along_x)):
+        length = upper[axis] - lower[axis]
+        if count == 0 or length <= 0:
+            continue
+        n = min(count, mesh["shield_strips"])
+        across = 1 - axis
+        pitch = (upper[across] - lower[across])/n
+        positions = lower[across] + (np.arange(n) + 0.5)*pitch
+        chords = [hull_chord(hull, axis, position) for position in positions]
+        width = metal*count/fingers/sum(b - a for a, b in chords)
+        for position, ends in zip(positions, chords):
+            if abs(ends[1] - center[axis]) < abs(ends[0] - center[axis]):
+                ends.reverse()
+            for end in range(2):
+                xy = [0, 0]
+                xy[axis] = ends[end]
+                xy[across] = position
+                lines.append("Npgs" + name + "_" + str(2*strip+end)
+                + " x=" + str(round(xy[0], 3))
+                + " y=" + str(round(xy[1], 3))
+                + " z=" + z + "\n")
+            edges.append("Epgs" + name + "_" + str(strip)
+            + " Npgs" + name + "_" + str(2*strip)
+            + " Npgs" + name + "_" + str(2*strip+1)
+            + " w=" + str(round(width, 3))
+            + " h=" + h
+            + " rho=" + rho
+            + " nwinc=1 nhinc=1\n")
+            if strip > 0:
+                edges.append(".equiv Npgs" + name + "_0 Npgs" + name + "_"
+                + str(2*strip) + "\n")
+            strip += 1
+    return "".join(lines + edges)
+
+# total length of all paths
+def path_length(model):
+    node_xy = model["node_xy"]
+    seg_nodes = model["seg_nodes"]
+    total_length = 0
+    if len(seg_nodes):
+        diff = dbu_geometry.to_um(node_xy[seg_nodes[:, 0]] - node_xy[seg_nodes[:, 1]],
+            dbu_geometry.model_unit(model))
+        # summed in path order, like a running total
+        total_length = np.cumsum(np.sqrt(pow(diff[:, 0],2) + pow(diff[:, 1],2)))[-1]
+    return total_length
+
+# limit the electrical length to 1/10th lambda
+def max_frequency(total_length):
     f_max = 3e8 / (10*total_length*1e-6*np.sqrt(3.9))
-    f_max = np.round(f_max, 1-int(np.floor(np.log10(f_max))))
+    return np.round(f_max, 1-int(np.floor(np.log10(f_max))))
+
+# frequency card, FastHenry2 solves ndec log spaced points per decade
+def freq_card(fmin, fmax, ndec=1):
+    return (".freq fmin=" + ('%e' % fmin) + " fmax=" + str(fmax)
+    + " ndec=" + str(ndec) + "\n")
+
+# substrate and simulation settings
+def deck_settings(model, total_length, stack=default_stack, mesh=default_mesh):
+    f_max = max_frequency(total_length)
     #print("total length of path: " + str(round(total_length,-1)) + " um")
-    #print("limit the electrical length to 1/10th lambda")
-    print("maximum usable frequency = " + str(f_max/1e9) + " GHz")
-        # resonance rule of thumb: f_r @ 70% of 3/4 lambda
-        # Graduation thesis, IC group TUe
-    f_r = 0.7*0.75*3e8/(total_length*1e-6*np.sqrt(3.9))
+    # resonance rule of thumb: f_r @ 70% of 3/4 lambda
+    # Graduation thesis, IC group TUe
+    #f_r = 0.7*0.75*3e8/(total_length*1e-6*np.sqrt(3.9))
     #print("resonance frequency estimate: f_r = " + str(int(f_r/1e9))+" GHz")
     
-    gr_len = 2 * round(max_dimension, 0)
-    lam = int(np.ceil(total_length / 20))
+    gr_len = 2 * round(model["max_dimension"][()], 0)
+    lam = int(np.ceil(total_length / mesh["substrate_length"]))
     
     # substrate
-    output_file.write("\n* SUBSTRATE\n")
-    output_file.write("G1\n")
-    output_file.write("+ x1="+str(-gr_len)+" y1="+str(-gr_len)+" z1="+str(0)+"\n")
-    output_file.write("+ x2="+str(gr_len)+" y2="+str(-gr_len)+" z2="+str(0)+"\n")
-    output_file.write("+ x3="+str(gr_len)+" y3="+str(gr_len)+" z3="+str(0)+"\n")
-    output_file.write("+ thick=0.1\n+ seg1="+str(lam)+" seg2="+str(lam)+"\n")
-    output_file.write("+ rho="+str(rho_subs)+"\n")
+    text = "\n* SUBSTRATE\n"
+    text += "G1\n"
+    text += "+ x1="+str(-gr_len)+" y1="+str(-gr_len)+" z1="+str(0)+"\n"
+    text += "+ x2="+str(gr_len)+" y2="+str(-gr_len)+" z2="+str(0)+"\n"
+    text += "+ x3="+str(gr_len)+" y3="+str(gr_len)+" z3="+str(0)+"\n"
+    text += "+ thick=0.1\n+ seg1="+str(lam)+" seg2="+str(lam)+"\n"
+    text += "+ rho="+str(stack["rho_subs"])+"\n"
     
-    output_file.write("\n* SIMULATION SETTINGS\n")
-    output_file.write(".freq fmin=1.000000e+06 fmax=" + str(f_max) + " ndec=1\n")
-    output_file.write(".end\n\n")
+    text += "\n* SIMULATION SETTINGS\n"
+    text += freq_card(1e6, f_max)
+    text += ".end\n\n"
+    return text
+
+# the sections of the deck in order, as (name, function, arguments); the
+# deck is the concatenation of function(model, *arguments). The stack is
+# the last argument of the sections that depend on it, or the one before
+# the mesh
+def fasthenry_sections(model, total_length=None, stack=default_stack,
+    mesh=default_mesh):
+    if total_length is None:
+        total_length = path_length(model)
+    paths = range(len(model["path_layer"]))
+    sections = [("header", deck_header, ())]
+    sections.append(("points", deck_text, ("\n* POINTS \n",)))
+    sections += [(("points", k), deck_points, (k, stack)) for k in paths]
+    sections.append(("ports", deck_text, ("\n* PORTS\n",)))
+    sections.append(("external", deck_ports, ()))
+    sections += [(("edges", k), deck_edges, (k, stack, mesh)) for k in paths]
+    sections.append(("vias", deck_text, ("\n* VIAS\n",)))
+    sections += [(("via", c), deck_via, (c, stack))
+        for c in range(len(model["cluster_count"]))]
+    shields = range(len(model["shield_layer"]))
+    if len(shields):
+        sections.append(("shields", deck_text, ("\n* SHIELDS\n",)))
+    sections += [(("shield", s), deck_shield, (s, stack, mesh)) for s in shields]
+    sections.append(("settings", deck_settings, (total_length, stack, mesh)))
+    return sections
+
+# write the FastHenry2 deck of a geometry model (see gds_model.py) to an open
+# text file with a mesh, returns the maximum usable frequency
+def write_fasthenry(model, output_file, verbose=True, mesh=default_mesh):
+    total_length = path_length(model)
+    for name, function, arguments in fasthenry_sections(model, total_length,
+        mesh=mesh):
+        output_file.write(function(model, *arguments))
     
+    f_max = max_frequency(total_length)
+    if verbose:
+        print("maximum usable frequency = " + str(f_max/1e9) + " GHz")
+    return f_max
+
+
+# ============= conversion ===============
+
+# convert a layout, or a stored geometry model (.npz), to a FastHenry2 deck;
+# returns a dict with the deck text, the name of the written file (None if
+# not written), the ports and f_max
+def convert_fasthenry(library_or_path, options=None):
+    opts = dict(default_options)
+    if options:
+        opts.update(options)
+    verbose = opts["verbose"]
+    
+    if verbose and isinstance(library_or_path, (str, Path)):
+        print("Input file: ", library_or_path)
+    
+    # the flattened copy is extracted, a library passed in is left untouched
+    model = gds_model.get_model(library_or_path, opts["backend"], layerlist,
+        panels=False)
+    if opts["validate"]:
+        validate.require_valid(model, "fasthenry", verbose)
+    
+    output_name = opts["output_name"]
+    if output_name is None:
+        if isinstance(library_or_path, (str, Path)):
+            output_name = Path(library_or_path).stem + "out_fasthenry.inp"
+        else:
+            output_name = str(model["cell_name"][()]) + "out_fasthenry.inp"
+    
+    output_file = io.StringIO()
+    f_max = write_fasthenry(model, output_file, verbose)
+    deck = output_file.getvalue()
     output_file.close()
+    cost = None
+    if opts["budget"] is not None:
+        import solver_cost
+        deck, cost = solver_cost.fit_budget("fasthenry", model, deck,
+            opts["budget"], verbose)
     
-else:
-    print ("Usage: gds2FastHenry.py [gds_file]")
+    if opts["write"]:
+        with open(output_name, 'w') as f:
+            f.write(deck)
+    else:
+        output_name = None
+    
+    ports = [(port.name, port.layer, np.array(port.xy))
+        for port in dbu_geometry.model_ports(model)]
+    return {
+        "cell":str(model["cell_name"][()]),
+        "deck":deck,
+        "output_name":output_name,
+        "ports":ports,
+        "f_max":f_max,
+        "cost":cost,
+        "model":model
+    }
+
+# ============= main ===============
 
+if __name__ == "__main__":
+    if len(sys.argv) >= 2:
+        convert_fasthenry(sys.argv[1])
+    else:
+        print ("Usage: gds2FastHenry.py [gds_file]")
 
-# References:
-# [1]   https://skywater-pdk.readthedocs.io/en/main/rules/assumptions.html#process-stack-diagram
-# [2]   https://skywater-pdk.readthedocs.io/en/main/rules/rcx.html#resistance-values, in “SKY130 Stackup Capacitance Data” spreadsheet.
-# [3]   https://open-source-silicon.slack.com/archives/C016HUV935L/p1704550228823649?thread_ts=1704545442.597049&cid=C016HUV935L
@@ -0,0 +1,153 @@
+# Copyright 2023 J.N.G.W. Verest
+# j.n.g.w.verest@tue.nl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Combined gds2FastHenry and gds2FasterCap conversion in one pass
+# The layout is loaded, flattened and analyzed once into a geometry model
+# (see gds_model.py), both decks are written from that same model. Port
+# assignment and stack data are therefore identical in the .inp and .qui.
+
+# CAVEATS:
+#   The decks are the same as written by gds2fasthenry.py and
+#   gds2fastercap.py. With the "parallel" option both decks are written in
+#   two worker processes, which only pays off for large layouts.
+#   The panels are always extracted, so a layout on which the FasterCap
+#   triangulation fails gives no decks at all (validation reports it as an
+#   error first); gds2fasthenry.py still works.
+#
+#   Usage:
+#     python gds2fastmodel.py [gds_file] [npz_file]
+#   the optional npz_file stores the geometry model for later conversions.
+
+# File history:
+# Initial version
+
+
+import sys
+import io
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import gds_model
+import dbu_geometry
+import gds2fasthenry
+import gds2fastercap
+import validate
+from sky130_stack import layerlist
+
+
+
+# default conversion options
+default_options = {
+"fasthenry_name":None, # .inp file name, derived from the input name if None
+"fastercap_name":None, # .qui file name, derived from the input name if None
+"model_name":None,     # also store the geometry model as .npz if given
+"write":True,          # write the decks
+"parallel":False,      # write both decks in parallel processes
+"verbose":True,        # print progress information
+"backend":None,        # geometry backend, gdspy or gdstk, see gds_backend.py
+"validate":True,       # check the geometry first, see validate.py
+"budget":None          # solver time/memory limits, see solver_cost.py
+}
+
+# deck text of one solver, module level so it can run in a worker process;
+# mesh None is the default mesh of the solver
+def render_deck(solver, model, verbose, mesh=None):
+    output_file = io.StringIO()
+    f_max = None
+    if solver == "fasthenry":
+        f_max = gds2fasthenry.write_fasthenry(model, output_file, verbose,
+            mesh or gds2fasthenry.default_mesh)
+    else:
+        gds2fastercap.write_fastercap(model, output_file,
+            mesh or gds2fastercap.default_mesh)
+    deck = output_file.getvalue()
+    output_file.close()
+    return deck, f_max
+
+# convert a layout, or a stored geometry model (.npz) with panels, to both a
+# FastHenry2 and a FasterCap deck; returns a dict with the model, the ports
+# and per solver the deck text and the name of the written file
+def convert_fastmodel(library_or_path, options=None):
+    opts = dict(default_options)
+    if options:
+        opts.update(options)
+    verbose = opts["verbose"]
+
+    if verbose and isinstance(library_or_path, (str, Path)):
+        print("Input file: ", library_or_path)
+
+    model = gds_model.get_model(library_or_path, opts["backend"], layerlist,
+        panels=False, verbose=verbose)
+    if opts["validate"]:
+        validate.require_valid(model, verbose=verbose)
+    if not bool(model["has_panels"]):
+        gds_model.add_panels(model)
+    if opts["model_name"] is not None:
+        gds_model.save_model(model, opts["model_name"])
+
+    if isinstance(library_or_path, (str, Path)):
+        stem = Path(library_or_path).stem
+    else:
+        stem = str(model["cell_name"][()])
+    output_names = {
+    "fasthenry":opts["fasthenry_name"] or stem + "out_fasthenry.inp",
+    "fastercap":opts["fastercap_name"] or stem + "_out_fastercap.qui"
+    }
+
+    solvers = ["fasthenry", "fastercap"]
+    if opts["parallel"]:
+        # plain copies, memory-mapped arrays are not passed between processes
+        arrays = {key:np.array(value) for key, value in model.items()}
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(render_deck, solver, arrays, verbose)
+                for solver in solvers]
+            decks = [future.result() for future in futures]
+    else:
+        decks = [render_deck(solver, model, verbose) for solver in solvers]
+
+    result = {
+        "cell":str(model["cell_name"][()]),
+        "model":model,
+        "ports":[(port.name, port.layer, port.xy.copy())
+            for port in dbu_geometry.model_ports(model)]
+    }
+    for solver, (deck, f_max) in zip(solvers, decks):
+        cost = None
+        if opts["budget"] is not None:
+            import solver_cost
+            deck, cost = solver_cost.fit_budget(solver, model, deck,
+                opts["budget"], verbose)
+        output_name = output_names[solver]
+        if opts["write"]:
+            with open(output_name, 'w') as f:
+                f.write(deck)
+        else:
+            output_name = None
+        result[solver] = {"deck":deck, "output_name":output_name, "cost":cost}
+        if f_max is not None:
+            result[solver]["f_max"] = f_max
+    return result
+
+# ============= main ===============
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2:
+        options = {}
+        if len(sys.argv) >= 3:
+            options["model_name"] = sys.argv[2]
+        convert_fastmodel(sys.argv[1], options)
+    else:
+        print ("Usage: gds2fastmodel.py [gds_file] [npz_file]")
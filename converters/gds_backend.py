@@ -0,0 +1,394 @@
+# Copyright 2023 J.N.G.W. Verest
+# j.n.g.w.verest@tue.nl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Geometry backends for the GDS converters
+# The converters only need a handful of operations on the first top level
+# cell: loading, flattening, get_polygons, get_paths and get_labels. These
+# are provided by gdspy (the reference) or by gdstk, whose C++ reader and
+# flattener are a lot faster on large inputs.
+
+# CAVEATS:
+#   The gdstk backend returns a gdspy-like view of the flattened cell, so the
+#   converters run unchanged on both. Path outlines are not fractured: gdspy
+#   cuts outlines of more than 199 points at other positions than gdstk
+#   does, so its fracturing is switched off on the flattened copy and both
+#   give one outline per path. 2-point paths start at the same vertex as in
+#   gdspy. gdspy sometimes leaves repeated vertices in outlines which gdstk
+#   does not, gds_model removes them for both.
+#   load_layout also returns the database unit of the library, from its GDS
+#   units record, in user units (um); a cell passed in directly has none.
+#   The backend is chosen with the "backend" conversion option or the
+#   GDS_BACKEND environment variable, default is gdspy.
+
+# File history:
+# Initial version
+
+
+import os
+import numpy as np
+
+
+
+backend_names = ["gdspy", "gdstk"]
+
+default_backend = os.environ.get("GDS_BACKEND", "gdspy")
+
+
+# ============= gdspy ===============
+
+def gdspy_load(library_or_path, verbose=True):
+    import gdspy
+    if isinstance(library_or_path, gdspy.Cell):
+        return library_or_path, None
+    if isinstance(library_or_path, gdspy.GdsLibrary):
+        input_library = library_or_path
+    else:
+        if verbose:
+            print("Input file: ", library_or_path)
+        # the coordinates are the same as without importing the units
+        input_library = gdspy.GdsLibrary(infile=str(library_or_path),
+            units="import")
+
+    # evaluate only first top level cell
+    return (input_library.top_level()[0],
+        float(input_library.precision/input_library.unit))
+
+# shallow copy of a cell which is not added to the gdspy current library, so
+# repeated conversions in one process do not collide on the cell name
+def gdspy_copy(cell):
+    import gdspy
+    new_cell = gdspy.Cell(cell.name, exclude_from_current=True)
+    new_cell.polygons = list(cell.polygons)
+    new_cell.paths = list(cell.paths)
+    new_cell.labels = list(cell.labels)
+    new_cell.references = list(cell.references)
+    return new_cell
+
+# a regular array of a cell that holds nothing but via polygons
+def gdspy_is_via_array(ref, via_datatype):
+    import gdspy
+    if not isinstance(ref, gdspy.CellArray) or not isinstance(ref.ref_cell, gdspy.Cell):
+        return False
+    cell = ref.ref_cell
+    if cell.paths or cell.labels or cell.references or not cell.polygons:
+        return False
+    return all(d == via_datatype for p in cell.polygons for d in p.datatypes)
+
+# points [..., n, 2] placed by a reference, in the same order of operations
+# as gdspy uses when flattening; arrays give one copy per element
+def gdspy_place(points, ref):
+    import gdspy
+    if isinstance(ref, gdspy.CellArray):
+        ii, jj = np.meshgrid(np.arange(ref.columns), np.arange(ref.rows), indexing='ij')
+        spc = np.stack([ref.spacing[0] * ii.ravel(), ref.spacing[1] * jj.ravel()], axis=1)
+        if ref.magnification:
+            points = points * ref.magnification
+        points = points[None] + spc.reshape((-1,) + (1,)*(points.ndim-1) + (2,))
+        points = points.reshape((-1,) + points.shape[2:])
+        if ref.x_reflection:
+            points = points * np.array((1, -1))
+    else:
+        if ref.x_reflection:
+            points = points * np.array((1, -1))
+        if ref.magnification is not None:
+            points = points * np.array((ref.magnification, ref.magnification), dtype=float)
+    if ref.rotation is not None:
+        ct = np.cos(ref.rotation * np.pi / 180.0)
+        st = np.sin(ref.rotation * np.pi / 180.0) * np.array((-1.0, 1.0))
+        points = points * ct + points[..., ::-1] * st
+    if ref.origin is not None:
+        points = points + np.array(ref.origin)
+    return points
+
+# copy of the hierarchy below cell without the via arrays, which are
+# collected as (layer, pillars [n,k,2]) in top level coordinates instead
+def gdspy_strip(cell, via_datatype, arrays, parents=(), copies=None):
+    import copy
+    if copies is None:
+        copies = {}
+    references = []
+    changed = False
+    for ref in cell.references:
+        if gdspy_is_via_array(ref, via_datatype):
+            for poly in ref.ref_cell.polygons:
+                for layer, pts in zip(poly.layers, poly.polygons):
+                    pillars = gdspy_place(np.array(pts, dtype=float)[None], ref)
+                    for parent in reversed(parents):
+                        pillars = gdspy_place(pillars, parent)
+                    arrays.append((layer, pillars))
+            changed = True
+            continue
+        if hasattr(ref.ref_cell, "references"):
+            stripped = gdspy_strip(ref.ref_cell, via_datatype, arrays,
+                parents + (ref,), copies)
+            if stripped is not ref.ref_cell:
+                ref = copy.copy(ref)
+                ref.ref_cell = stripped
+                changed = True
+        references.append(ref)
+    if not changed:
+        return cell
+    if cell.name not in copies:
+        copies[cell.name] = gdspy_copy(cell)
+        copies[cell.name].references = references
+    return copies[cell.name]
+
+def gdspy_flatten(cell, via_datatype=None):
+    arrays = []
+    if via_datatype is not None:
+        cell = gdspy_strip(cell, via_datatype, arrays)
+    new_cell = gdspy_copy(cell)
+    new_cell.flatten(single_layer=None, single_datatype=None, single_texttype=None)
+    new_cell.paths = [gdspy_whole(path) for path in new_cell.paths]
+    return new_cell, arrays
+
+# copy of a path whose outline is not fractured, the path itself may belong
+# to a library passed in by the caller
+def gdspy_whole(path):
+    import copy
+    if not hasattr(path, "max_points"):
+        return path
+    path = copy.copy(path)
+    path.max_points = 0
+    path._polygon_dict = None
+    return path
+
+
+# ============= gdstk ===============
+
+class GdstkLabel:
+    __slots__ = ("text", "position", "layer", "texttype")
+
+    def __init__(self, label):
+        self.text = label.text
+        self.position = np.array(label.origin)
+        self.layer = label.layer
+        self.texttype = label.texttype
+
+class GdstkPath:
+    __slots__ = ("path", "points", "widths", "layers", "datatypes", "_polygons")
+
+    def __init__(self, path):
+        self.path = path
+        self.points = path.spine()
+        self.widths = path.widths()
+        self.layers = list(path.layers)
+        self.datatypes = list(path.datatypes)
+        self._polygons = None
+
+    def get_polygons(self, by_spec=False):
+        if self._polygons is None:
+            self._polygons = []
+            for poly in self.path.to_polygons():
+                pts = poly.points
+                if len(self.points) == 2 and len(pts) == 4:
+                    # gdspy starts a straight segment on its right side
+                    pts = pts[[1, 0, 3, 2]]
+                self._polygons.append(((poly.layer, poly.datatype), pts))
+        if by_spec:
+            polygons = {}
+            for key, pts in self._polygons:
+                polygons.setdefault(key, []).append(pts)
+            return polygons
+        return [pts for key, pts in self._polygons]
+
+# gdspy-like read-only view of a flattened gdstk cell, the cell does not
+# change anymore so all queries are computed once
+class GdstkCell:
+    def __init__(self, cell):
+        self.cell = cell
+        self.name = cell.name
+        self.paths = [GdstkPath(p) for p in cell.paths]
+        self.labels = [GdstkLabel(l) for l in cell.labels]
+        self._by_spec = None
+
+    def __str__(self):
+        return gdstk_describe(self.cell)
+
+    def get_polygons(self, by_spec=False):
+        if self._by_spec is None:
+            self._by_spec = {}
+            for poly in self.cell.polygons:
+                key = (poly.layer, poly.datatype)
+                self._by_spec.setdefault(key, []).append(poly.points)
+            for path in self.paths:
+                for key, pts in path.get_polygons(by_spec=True).items():
+                    self._by_spec.setdefault(key, []).extend(pts)
+        if by_spec:
+            return self._by_spec
+        polygons = [poly.points for poly in self.cell.polygons]
+        for path in self.paths:
+            polygons.extend(path.get_polygons())
+        return polygons
+
+    def get_paths(self):
+        return self.paths
+
+    def get_labels(self):
+        return self.labels
+
+def gdstk_load(library_or_path, verbose=True):
+    import gdstk
+    if isinstance(library_or_path, gdstk.Cell):
+        return library_or_path, None
+    if isinstance(library_or_path, gdstk.Library):
+        input_library = library_or_path
+    else:
+        if verbose:
+            print("Input file: ", library_or_path)
+        input_library = gdstk.read_gds(str(library_or_path))
+
+    # evaluate only first top level cell
+    return (input_library.top_level()[0],
+        float(input_library.precision/input_library.unit))
+
+# same summary as str() of a gdspy cell, used in the deck headers
+def gdstk_describe(cell):
+    return ("Cell (\"" + cell.name + "\", " + str(len(cell.polygons))
+    + " polygons, " + str(len(cell.paths)) + " paths, "
+    + str(len(cell.labels)) + " labels, " + str(len(cell.references))
+    + " references)")
+
+# a regular array of a cell that holds nothing but via polygons
+def gdstk_is_via_array(ref, via_datatype):
+    import gdstk
+    if ref.repetition.size < 2 or not isinstance(ref.cell, gdstk.Cell):
+        return False
+    cell = ref.cell
+    if cell.paths or cell.labels or cell.references or not cell.polygons:
+        return False
+    return all(p.datatype == via_datatype for p in cell.polygons)
+
+# points [..., n, 2] placed by a reference, the repetition offsets are added
+# after the transformation, as in gdstk
+def gdstk_place(points, ref):
+    if ref.x_reflection:
+        points = points * np.array((1, -1))
+    points = points * ref.magnification
+    if ref.rotation != 0:
+        ct = np.cos(ref.rotation)
+        st = np.sin(ref.rotation)
+        points = np.stack([points[..., 0]*ct - points[..., 1]*st,
+            points[..., 0]*st + points[..., 1]*ct], axis=-1)
+    points = points + np.array(ref.origin)
+    if ref.repetition.size > 1:
+        offsets = np.array(ref.repetition.get_offsets())
+        points = points[None] + offsets.reshape((-1,) + (1,)*(points.ndim-1) + (2,))
+        points = points.reshape((-1,) + points.shape[2:])
+    return points
+
+def gdstk_strip(cell, via_datatype, arrays, parents=(), copies=None):
+    import gdstk
+    if copies is None:
+        copies = {}
+    removed = []
+    replaced = []
+    for ref in cell.references:
+        if gdstk_is_via_array(ref, via_datatype):
+            for poly in ref.cell.polygons:
+                pillars = gdstk_place(np.array(poly.points, dtype=float)[None], ref)
+                for parent in reversed(parents):
+                    pillars = gdstk_place(pillars, parent)
+                arrays.append((poly.layer, pillars))
+            removed.append(ref)
+            continue
+        if isinstance(ref.cell, gdstk.Cell):
+            stripped = gdstk_strip(ref.cell, via_datatype, arrays,
+                parents + (ref,), copies)
+            if stripped is not ref.cell:
+                new_ref = gdstk.Reference(stripped, ref.origin, ref.rotation,
+                    ref.magnification, ref.x_reflection)
+                new_ref.repetition = ref.repetition
+                removed.append(ref)
+                replaced.append(new_ref)
+    if not removed:
+        return cell
+    if cell.name not in copies:
+        new_cell = cell.copy(cell.name, deep_copy=False)
+        # a shallow copy shares the references, so they can be removed
+        new_cell.remove(*removed)
+        new_cell.add(*replaced)
+        copies[cell.name] = new_cell
+    return copies[cell.name]
+
+def gdstk_flatten(cell, via_datatype=None):
+    arrays = []
+    if via_datatype is not None:
+        cell = gdstk_strip(cell, via_datatype, arrays)
+    # copy keeps a library passed in by the caller untouched
+    new_cell = cell.copy(cell.name)
+    new_cell.flatten()
+    return GdstkCell(new_cell), arrays
+
+
+# ============= backend selection ===============
+
+loaders = {
+"gdspy":gdspy_load,
+"gdstk":gdstk_load
+}
+
+def is_gdstk(cell):
+    return type(cell).__module__.startswith("gdstk")
+
+# first top level cell of a file name, library or cell and the database unit
+# of the library in um (None for a cell); a library or cell object selects
+# its own backend, file names are read with the given one
+def load_layout(library_or_path, backend=None, verbose=True):
+    if backend is None:
+        backend = default_backend
+    if backend not in loaders:
+        raise ValueError("unknown geometry backend " + str(backend))
+    if type(library_or_path).__module__.startswith("gdstk"):
+        backend = "gdstk"
+    elif type(library_or_path).__module__.startswith("gdspy"):
+        backend = "gdspy"
+    return loaders[backend](library_or_path, verbose)
+
+# the same, only the cell
+def load_cell(library_or_path, backend=None, verbose=True):
+    return load_layout(library_or_path, backend, verbose)[0]
+
+# polygons of a flattened cell that were drawn as polygons, not as paths,
+# by (layer, datatype)
+def plain_polygons(cell):
+    polygons = {}
+    if isinstance(cell, GdstkCell):
+        for poly in cell.cell.polygons:
+            polygons.setdefault((poly.layer, poly.datatype), []).append(poly.points)
+        return polygons
+    for polygon_set in cell.polygons:
+        for pts, layer, datatype in zip(polygon_set.polygons, polygon_set.layers,
+            polygon_set.datatypes):
+            polygons.setdefault((layer, datatype), []).append(pts)
+    return polygons
+
+# summary of an unflattened cell
+def describe(cell):
+    if is_gdstk(cell):
+        return gdstk_describe(cell)
+    return str(cell)
+
+# flattened copy of a loaded cell, with the gdspy cell interface
+def flatten(cell):
+    return flatten_via_arrays(cell, None)[0]
+
+# as flatten, but regular arrays of cells holding only polygons on the via
+# datatype are not flattened; returns the flattened cell and these arrays
+# as a list of (layer, pillars [n,k,2]), one entry per array and polygon
+def flatten_via_arrays(cell, via_datatype):
+    if is_gdstk(cell):
+        return gdstk_flatten(cell, via_datatype)
+    return gdspy_flatten(cell, via_datatype)
@@ -0,0 +1,541 @@
+# Copyright 2023 J.N.G.W. Verest
+# j.n.g.w.verest@tue.nl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Intermediate geometry model between extraction and deck writing
+# Everything the FastHenry2 and FasterCap writers need from the layout is
+# extracted once into flat, typed numpy arrays: ports, path nodes and
+# segments with widths and layers, path outlines with their triangulated
+# panels, via pillars and via clusters. The model is a plain dict of arrays
+# and can be stored as an uncompressed .npz, which load_model opens
+# memory-mapped, so decks can be regenerated without reading the GDS again.
+
+# CAVEATS:
+#   The model contains geometry only, the stack data (heights, resistivities)
+#   is added by the writers. Port detection, panel triangulation and via
+#   clustering follow the original converters step by step, so the decks
+#   written from a model are identical to the ones written before.
+#
+#   Arrays in the model, with P ports, N nodes, K paths, M outline points,
+#   T triangles, V via points and C via clusters; the vertices (node_xy,
+#   outline_xy, tri_xy, via_xy and shield_xy) are int64 database units (see
+#   dbu_geometry.py), the centers port_xy and cluster_xy, the widths and
+#   max_dimension float micrometers:
+#     port_name [P] str, port_layer [P], port_xy [P,2]
+#     path_layer [K], path_offsets [K+1], node_xy [N,2], node_width [N]
+#     seg_nodes [N-K,2], seg_width [N-K], seg_layer [N-K]
+#     outline_offsets [K+1], outline_xy [M,2], outline_parts [K],
+#     side_port [M]
+#     tri_offsets [K+1], tri_xy [T,3,2]
+#     via_offsets [..+1], via_xy [V,2], via_layer [..], via_array [..]
+#     via_array_layer [A], via_array_count [A]
+#     cluster_paths [C,2], cluster_ends [C,2], cluster_xy [C,2],
+#     cluster_count [C], cluster_layer [C]
+#     layerlist [L], pin_count [L]
+#     shield_layer [S], shield_offsets [S+1], shield_xy [H,2],
+#     shield_fingers [S], shield_fingers_x [S], shield_fill [S],
+#     shield_width [S]
+#   plus the scalars format_version, dbu (the database unit in um, from the
+#   GDS library), cell_name, description, max_dimension, label_count and
+#   has_panels. Without panels side_port is -1 and tri_xy is empty.
+#   Regular arrays of a via cell (as written by the IndLib
+#   Oct_double_inductor) are not flattened, their pillars are generated at
+#   once and every array is a single unit in the via clusters.
+#   A patterned ground shield is not extracted finger by finger: the fingers
+#   of each sector become one convex hull (S groups, H hull points), so a
+#   shield of thousands of fingers costs a few FasterCap panels. Per group
+#   the fingers running along x are counted, for the FastHenry2 strips.
+#
+#   Usage:
+#     python gds_model.py [gds_file] [npz_file]
+
+# File history:
+# Initial version
+
+
+import sys
+import zipfile
+import numpy as np
+from pathlib import Path
+
+import gds_backend
+import dbu_geometry
+import sky130_stack
+
+
+
+format_version = 4
+
+# datatypes, as used by the IndLib PCells
+pin_datatype = 16
+drawing_datatype = 20
+via_datatype = 44
+
+# polygons, not paths, on the drawing datatype of a metal from this many on
+# are a patterned ground shield, as drawn by the IndLib PGS
+shield_min_fingers = 16
+
+# layers to be examined, LI - Metal5
+layerlist_default = sky130_stack.layerlist
+
+
+# ============= triangulation ===============
+
+# all triangles of a DBU polygon outline, as an array [T,3,2]; triangulated
+# with exact comparisons, see dbu_geometry.triangulate
+def triangulate_outline(pts):
+    return dbu_geometry.triangulate(pts).reshape(-1, 3, 2)
+
+
+# ============= extraction ===============
+
+# ports are pin polygons paired with the closest label, see the CAVEATS of
+# the converters; an unequal amount of pins and labels stops the search
+def extract_ports(cell, layerlist, verbose=False):
+    by_spec = cell.get_polygons(by_spec=True)
+    labels = [(o.text, o.position) for o in cell.get_labels()]
+    return pair_ports(by_spec, labels, layerlist, verbose)
+
+# the pairing itself, on pin polygons by (layer, datatype) and a list of
+# (text, position) labels, so it can also run on a streamed layout
+def pair_ports(by_spec, labels, layerlist, verbose=False):
+    ports = []
+    for layer_to_extract in layerlist:
+        if verbose:
+            print("Evaluating layer ", str(layer_to_extract))
+        curr_ports = by_spec.get( (layer_to_extract, pin_datatype) )
+        curr_labels = labels
+
+        if (curr_ports != None) and (curr_labels != None):
+
+            # quick check whether num of pins == num of labels
+            if len(curr_ports) != len(curr_labels):
+                print("ERROR: unequal amount of ports & labels on layer "
+                + str(layer_to_extract))
+                break
+
+            # append them to list
+            label_xy = np.array([position for text, position in curr_labels],
+                dtype=np.float64).reshape(-1, 2)
+            for poly in curr_ports:
+                mean_pos = np.mean(poly, axis=0)
+
+                # find smallest distance label, the first one on ties
+                dist = np.sum(np.square(label_xy - mean_pos), axis=1)
+                chosen_text, chosen_position = curr_labels[int(np.argmin(dist))]
+
+                # store pins
+                if verbose:
+                    print("Port-label pair found! \tPrt: " + str(mean_pos) + "\tLab: "
+                    + str(chosen_position))
+                ports.append( (chosen_text, layer_to_extract, mean_pos) )
+    return ports
+
+# for every port the outline edge which becomes the port panel: the lower of
+# the two outline points closest to the port, -1 for edges without port;
+# on a DBU outline with the port snapped to the grid, so the distances are
+# exact and equal ones are decided by the point order, not by rounding
+def side_ports(pts, port_xy, unit=dbu_geometry.dbu):
+    side_port = -np.ones(len(pts), dtype=np.int32)
+    port_indices = []
+    for xy in dbu_geometry.to_dbu(port_xy, unit):
+        d = np.square(pts[:, 0]-xy[0]) + np.square(pts[:, 1]-xy[1])
+        d = d.tolist()
+        min_dist1 = int(99999999/unit**2)
+        min_dist2 = int(99999999/unit**2)
+        ind1 = -1
+        ind2 = -1
+
+        for i in range(0, len(pts)-1):
+            if (d[i] < min_dist1):
+
+                if (d[ind1] < min_dist2):
+                    ind2 = ind1
+                    min_dist2 = d[ind2]
+                ind1 = i
+                min_dist1 = d[i]
+            else:
+                if (d[ind1] < min_dist1):
+                    ind2 = i
+                    min_dist2 = d[i]
+
+        port_indices.append([ind1, ind2])
+
+    min_indices = [min(x) for x in port_indices]
+    for i in range(0, len(pts)-1):
+        if i in min_indices:
+            side_port[i] = min_indices.index(i)
+    return side_port
+
+# centers of the via pillars, the pillars are assumed to be squares
+def via_centers(vias):
+    centers = np.empty((len(vias), 2))
+    for k, via in enumerate(vias):
+        centers[k] = sum(via)/4
+    return centers
+
+# centers and pillar counts of the vias on a layer: every separate pillar is
+# one unit, a via array (see gds_backend.flatten) is one unit as a whole
+def via_units(layer, by_spec, via_arrays=()):
+    vias = by_spec.get( (layer, via_datatype) ) or []
+    centers = [via_centers(vias)] if vias else []
+    weights = [np.ones(len(vias), dtype=np.int64)] if vias else []
+    for array_layer, pillars in via_arrays:
+        if array_layer == layer:
+            centers.append(np.mean(np.mean(pillars, axis=1), axis=0)[None])
+            weights.append(np.array([len(pillars)], dtype=np.int64))
+    if not centers:
+        return None
+    return np.concatenate(centers), np.concatenate(weights)
+
+# via cluster between path i and j on adjacent layers: the pillars within the
+# bounding box of the closest path ends, a via array counts when its center
+# is inside; count is -1 if the via layer is empty
+def extract_clusters(paths, by_spec, via_arrays=()):
+    clusters = []
+    units = {}
+    for i in range(len(paths)):
+
+        for j in range(i+1, len(paths)):
+            if (abs(paths[i].layers[0] - paths[j].layers[0]) == 1):
+                min_dist = 99999
+                index_1 = -99
+                index_2 = -99
+                for x in range(2):
+                    for y in range(2):
+                        d = sum(pow(paths[i].points[-x]-paths[j].points[-y],2))
+                        if (d < min_dist):
+                            index_1 = -x # either 0 or -1 (start or end)
+                            index_2 = -y
+                            min_dist = d
+
+                # bounds are in
+                    # min(x1, x2)-w  <= x <= max(x1, x2) + w
+                    # min(y1, y2)-w  <= y <= max(y1, y2) + w
+                width = max(paths[i].widths[index_1][0], paths[j].widths[index_2][0])
+                lb_x = min(paths[i].points[index_1][0], paths[j].points[index_2][0])-width/2
+                ub_x = max(paths[i].points[index_1][0], paths[j].points[index_2][0])+width/2
+                lb_y = min(paths[i].points[index_1][1], paths[j].points[index_2][1])-width/2
+                ub_y = max(paths[i].points[index_1][1], paths[j].points[index_2][1])+width/2
+
+                via_layer = min(paths[i].layers[0], paths[j].layers[0])
+                if via_layer not in units:
+                    units[via_layer] = via_units(via_layer, by_spec, via_arrays)
+
+                cluster_mean = np.array([np.nan, np.nan])
+                if units[via_layer] is None:
+                    num_via_pillars = -1
+                else:
+                    mean, weight = units[via_layer]
+                    inside = ((mean[:, 0] >= lb_x) & (mean[:, 0] <= ub_x)
+                        & (mean[:, 1] >= lb_y) & (mean[:, 1] <= ub_y))
+                    num_via_pillars = int(np.sum(weight[inside]))
+                    if num_via_pillars > 0:
+                        # sequential sum, as the pillars were added one by one
+                        cluster_mean = np.cumsum(mean[inside] * weight[inside, None],
+                            axis=0)[-1] / num_via_pillars
+
+                clusters.append((i, j, index_1, index_2, cluster_mean,
+                    num_via_pillars, via_layer))
+    return clusters
+
+# patterned ground shields: the fingers on each metal, grouped into the
+# four sectors of parallel fingers around the center; every group becomes its
+# convex hull, the shield as seen from a few micrometers above, with the
+# number of fingers, the fraction of the hull they cover and their width.
+# Returns a list of (layer, DBU hull [h,2], fingers, fill, width, fingers
+# along x)
+def extract_shields(cell, layerlist, unit=dbu_geometry.dbu):
+    polygons = gds_backend.plain_polygons(cell)
+    shields = []
+    for layer in layerlist:
+        fingers = polygons.get( (layer, drawing_datatype) ) or []
+        if len(fingers) < shield_min_fingers:
+            continue
+        xy, offsets = pack(fingers)
+        ixy = dbu_geometry.to_dbu(xy, unit)
+        starts = offsets[:-1]
+        counts = np.diff(offsets)
+        center = np.add.reduceat(ixy, starts, axis=0)/counts[:, None]
+        lower = np.minimum.reduceat(ixy, starts, axis=0)
+        upper = np.maximum.reduceat(ixy, starts, axis=0)
+
+        # signed areas, the last point of a polygon connects to its first
+        following = np.arange(1, len(ixy)+1)
+        following[offsets[1:]-1] = starts
+        cross = ixy[:, 0]*ixy[following, 1] - ixy[:, 1]*ixy[following, 0]
+        area = np.abs(np.add.reduceat(cross, starts))/2
+
+        # the fingers of a sector run parallel, from the centre outwards: a
+        # finger belongs to the sector of its direction on its side of the
+        # centre, so the fingers on the axes stay out of the next sector
+        along_x = (upper - lower)[:, 0] >= (upper - lower)[:, 1]
+        mid = (lower.min(axis=0) + upper.max(axis=0))/2
+        side = np.where(along_x, center[:, 0] >= mid[0], center[:, 1] >= mid[1])
+        sector = along_x*2 + side
+        for q in np.unique(sector):
+            group = np.flatnonzero(sector == q)
+            # hull of the bounding box corners of the fingers
+            corners = np.concatenate([lower[group], upper[group],
+                np.stack([lower[group, 0], upper[group, 1]], axis=1),
+                np.stack([upper[group, 0], lower[group, 1]], axis=1)])
+            hull = dbu_geometry.convex_hull(corners)
+            hull_area = dbu_geometry.area2(hull)/2
+            width = np.median(np.min(upper[group] - lower[group], axis=1))
+            shields.append((layer, hull, len(group),
+                float(area[group].sum()/hull_area) if hull_area > 0 else 0.0,
+                float(dbu_geometry.to_um(width, unit)), int(along_x[group].sum())))
+    return shields
+
+# concatenate a list of point arrays, returns points and offsets
+def pack(arrays, width=2, dtype=np.float64):
+    offsets = np.zeros(len(arrays)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(a) for a in arrays])
+    if len(arrays) == 0:
+        return np.zeros((0, width), dtype=dtype), offsets
+    return np.concatenate([np.asarray(a, dtype=dtype).reshape(-1, width)
+        for a in arrays]), offsets
+
+# the same, snapped to the DBU grid, for the points of the model
+def pack_dbu(arrays, width=2, unit=dbu_geometry.dbu):
+    xy, offsets = pack(arrays, width)
+    return dbu_geometry.to_dbu(xy, unit), offsets
+
+# extract the model from a flattened cell (see gds_backend.flatten) and its
+# via arrays (gds_backend.flatten_via_arrays), on the grid of the database
+# unit of its library; panels are only needed by FasterCap and are the
+# slowest part
+def extract_model(cell, description, layerlist=layerlist_default,
+    panels=True, verbose=False, via_arrays=(), unit=dbu_geometry.dbu):
+    model = {}
+    model["format_version"] = np.array(format_version)
+    model["dbu"] = np.array(unit, dtype=np.float64)
+    model["cell_name"] = np.array(cell.name)
+    model["description"] = np.array(description)
+
+    # maximum length in any direction
+    polys = cell.get_polygons()
+    model["max_dimension"] = np.sqrt(np.max(np.sum(np.square(
+        np.concatenate(polys)), axis=1)))
+
+    # ports
+    ports = extract_ports(cell, layerlist, verbose)
+    model["port_name"] = np.array([p[0] for p in ports], dtype=str)
+    model["port_layer"] = np.array([p[1] for p in ports], dtype=np.int32)
+    model["port_xy"] = np.array([p[2] for p in ports],
+        dtype=np.float64).reshape(-1, 2)
+
+    # paths: nodes and the segments between them
+    paths = cell.get_paths()
+    model["path_layer"] = np.array([p.layers[0] for p in paths], dtype=np.int32)
+    model["node_xy"], model["path_offsets"] = pack_dbu([p.points for p in paths],
+        unit=unit)
+    model["node_width"] = np.concatenate([np.asarray(p.widths)[:, 0]
+        for p in paths]) if paths else np.zeros(0)
+
+    offsets = model["path_offsets"]
+    first = np.concatenate([np.arange(offsets[k], offsets[k+1]-1)
+        for k in range(len(paths))]) if paths else np.zeros(0, dtype=np.int64)
+    model["seg_nodes"] = np.stack([first, first+1], axis=1).astype(np.int64)
+    model["seg_width"] = model["node_width"][first]
+    model["seg_layer"] = np.repeat(model["path_layer"], np.diff(offsets)-1)
+
+    # outlines, the first polygon of every path; the panels are added by
+    # add_panels, so a model can be validated before the triangulation
+    outlines = [dbu_geometry.distinct_vertices(dbu_geometry.to_dbu(
+        p.get_polygons()[0], unit)) for p in paths]
+    model["outline_xy"], model["outline_offsets"] = pack(outlines, dtype=np.int64)
+    model["outline_parts"] = np.array([len(p.get_polygons()) for p in paths],
+        dtype=np.int32)
+    model["has_panels"] = np.array(False)
+    model["side_port"] = -np.ones(len(model["outline_xy"]), dtype=np.int32)
+    model["tri_xy"] = np.zeros((0, 3, 2), dtype=np.int64)
+    model["tri_offsets"] = np.zeros(len(paths)+1, dtype=np.int64)
+
+    # pins per layer and labels in the cell, for the port pairing checks
+    by_spec = cell.get_polygons(by_spec=True)
+    model["layerlist"] = np.array(layerlist, dtype=np.int32)
+    model["pin_count"] = np.array([len(by_spec.get( (layer, pin_datatype) ) or [])
+        for layer in layerlist], dtype=np.int32)
+    model["label_count"] = np.array(len(cell.get_labels()))
+
+    # via pillars, grouped by layer in layerlist order; the pillars of via
+    # arrays follow the separate ones and are tagged with their array
+    vias = []
+    via_layer = []
+    via_array = []
+    for layer in layerlist:
+        for via_pillar in by_spec.get( (layer, via_datatype) ) or []:
+            vias.append(via_pillar)
+            via_layer.append(layer)
+            via_array.append(-1)
+        for a, (array_layer, pillars) in enumerate(via_arrays):
+            if array_layer == layer:
+                vias.extend(pillars)
+                via_layer.extend([layer]*len(pillars))
+                via_array.extend([a]*len(pillars))
+    vias = [dbu_geometry.distinct_vertices(dbu_geometry.to_dbu(v, unit))
+        for v in vias]
+    model["via_xy"], model["via_offsets"] = pack(vias, dtype=np.int64)
+    model["via_layer"] = np.array(via_layer, dtype=np.int32)
+    model["via_array"] = np.array(via_array, dtype=np.int32)
+    model["via_array_layer"] = np.array([a[0] for a in via_arrays], dtype=np.int32)
+    model["via_array_count"] = np.array([len(a[1]) for a in via_arrays],
+        dtype=np.int32)
+
+    # patterned ground shields, in aggregate
+    shields = extract_shields(cell, layerlist, unit)
+    model["shield_layer"] = np.array([s[0] for s in shields], dtype=np.int32)
+    model["shield_xy"], model["shield_offsets"] = pack([s[1] for s in shields],
+        dtype=np.int64)
+    model["shield_fingers"] = np.array([s[2] for s in shields], dtype=np.int32)
+    model["shield_fingers_x"] = np.array([s[5] for s in shields], dtype=np.int32)
+    model["shield_fill"] = np.array([s[3] for s in shields], dtype=np.float64)
+    model["shield_width"] = np.array([s[4] for s in shields], dtype=np.float64)
+
+    # via clusters between paths on adjacent layers
+    clusters = extract_clusters(paths, by_spec, via_arrays)
+    model["cluster_paths"] = np.array([c[0:2] for c in clusters],
+        dtype=np.int32).reshape(-1, 2)
+    model["cluster_ends"] = np.array([c[2:4] for c in clusters],
+        dtype=np.int8).reshape(-1, 2)
+    model["cluster_xy"] = np.array([c[4] for c in clusters],
+        dtype=np.float64).reshape(-1, 2)
+    model["cluster_count"] = np.array([c[5] for c in clusters], dtype=np.int32)
+    model["cluster_layer"] = np.array([c[6] for c in clusters], dtype=np.int32)
+
+    if panels:
+        add_panels(model)
+    return model
+
+# triangulated top/bottom panels and the port side panels of all outlines,
+# only needed by FasterCap and the slowest part of the extraction; with a
+# cache dict, outlines seen before are not triangulated again
+def add_panels(model, cache=None):
+    offsets = model["outline_offsets"]
+    unit = dbu_geometry.model_unit(model)
+    port_key = (np.ascontiguousarray(model["port_xy"]).tobytes(), unit)
+    side_port = []
+    triangles = []
+    for k in range(len(offsets)-1):
+        pts = np.asarray(model["outline_xy"][offsets[k]:offsets[k+1]])
+        if cache is None:
+            triangles.append(triangulate_outline(pts))
+            side_port.append(side_ports(pts, model["port_xy"], unit))
+            continue
+        key = pts.tobytes()
+        if key not in cache:
+            cache[key] = triangulate_outline(pts)
+        triangles.append(cache[key])
+        if (key, port_key) not in cache:
+            cache[(key, port_key)] = side_ports(pts, model["port_xy"], unit)
+        side_port.append(cache[(key, port_key)])
+    model["side_port"] = np.concatenate(side_port) if side_port \
+        else np.zeros(0, dtype=np.int32)
+    tri, tri_offsets = pack([t.reshape(-1, 2) for t in triangles], dtype=np.int64)
+    model["tri_xy"] = tri.reshape(-1, 3, 2)
+    model["tri_offsets"] = tri_offsets // 3
+    model["has_panels"] = np.array(True)
+    return model
+
+# load, flatten and extract in one go
+def model_from_layout(library_or_path, backend=None, layerlist=layerlist_default,
+    panels=True, verbose=False):
+    cell, unit = gds_backend.load_layout(library_or_path, backend, verbose=False)
+    description = gds_backend.describe(cell)
+    if verbose:
+        print(description)
+    cell, via_arrays = gds_backend.flatten_via_arrays(cell, via_datatype)
+    return extract_model(cell, description, layerlist, panels, verbose,
+        via_arrays, unit or dbu_geometry.dbu)
+
+
+# ============= storage ===============
+
+# uncompressed, so every array can be memory-mapped by load_model
+def save_model(model, file_name):
+    np.savez(file_name, **model)
+
+def is_model_file(library_or_path):
+    return isinstance(library_or_path, (str, Path)) \
+        and str(library_or_path).endswith(".npz")
+
+# open a stored model; with mmap the arrays are read-only views on the file
+def load_model(file_name, mmap=True):
+    model = {}
+    if not mmap:
+        with np.load(file_name) as data:
+            for key in data.files:
+                model[key] = data[key]
+        return model
+
+    with zipfile.ZipFile(file_name) as archive, open(file_name, 'rb') as f:
+        for info in archive.infolist():
+            key = info.filename[:-len(".npy")]
+            if info.compress_type != zipfile.ZIP_STORED:
+                model[key] = np.load(archive.open(info))
+                continue
+
+            # the data starts after the local file header and the npy header
+            f.seek(info.header_offset)
+            local_header = f.read(30)
+            name_len = int.from_bytes(local_header[26:28], 'little')
+            extra_len = int.from_bytes(local_header[28:30], 'little')
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+
+            if dtype.hasobject or len(shape) == 0 or int(np.prod(shape)) == 0:
+                model[key] = np.load(archive.open(info), allow_pickle=False)
+                continue
+            model[key] = np.memmap(file_name, dtype=dtype, mode='r',
+                offset=f.tell(), shape=shape, order='F' if fortran else 'C')
+
+    if int(model["format_version"]) != format_version:
+        raise ValueError("unsupported model format version "
+        + str(int(model["format_version"])))
+    return model
+
+# model from a stored .npz, or extracted from a layout
+def get_model(library_or_path, backend=None, layerlist=layerlist_default,
+    panels=True, verbose=False):
+    if isinstance(library_or_path, dict):
+        return library_or_path
+    if is_model_file(library_or_path):
+        model = load_model(library_or_path)
+        if panels and not bool(model["has_panels"]):
+            add_panels(model)
+        return model
+    return model_from_layout(library_or_path, backend, layerlist, panels,
+        verbose)
+
+
+# ============= main ===============
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2:
+        input_name = sys.argv[1]
+        if len(sys.argv) >= 3:
+            output_name = sys.argv[2]
+        else:
+            output_name = Path(input_name).stem + "_model.npz"
+        print("Input file: ", input_name)
+        model = model_from_layout(input_name, verbose=True)
+        save_model(model, output_name)
+        print("Model written to " + output_name)
+    else:
+        print ("Usage: gds_model.py [gds_file] [npz_file]")
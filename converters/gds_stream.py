@@ -0,0 +1,336 @@
+# Copyright 2023 J.N.G.W. Verest
+# j.n.g.w.verest@tue.nl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Streaming GDSII reader and writer
+# The file is memory-mapped and read record by record: one pass indexes the
+# structures (cells) by their byte range, after which the elements of a
+# cell are generated flattened, one at a time, by walking its references
+# into the other structures. Coordinates stay integer database units.
+# Nothing but the cell index is kept in memory, so a layout of any size can
+# be streamed, e.g. into tiles (see tiled.py). The writer encodes flat
+# elements back into GDSII records.
+
+# CAVEATS:
+#   Boundaries, paths, texts and their single and array references are
+#   read; boxes, nodes and properties are skipped. Text orientation and
+#   presentation are dropped when flattening, text positions are kept.
+#   Transformed coordinates are rounded to the database grid, as any
+#   flattener does; rotations by multiples of 90 degrees are exact. A path
+#   with a negative (absolute) width keeps it under magnification.
+
+# File history:
+# Initial version
+
+
+import mmap
+import numpy as np
+
+
+
+# record types, the record number and data type bytes
+HEADER = 0x0002
+BGNLIB = 0x0102
+LIBNAME = 0x0206
+UNITS = 0x0305
+ENDLIB = 0x0400
+BGNSTR = 0x0502
+STRNAME = 0x0606
+ENDSTR = 0x0700
+BOUNDARY = 0x0800
+PATH = 0x0900
+SREF = 0x0A00
+AREF = 0x0B00
+TEXT = 0x0C00
+LAYER = 0x0D02
+DATATYPE = 0x0E02
+WIDTH = 0x0F03
+XY = 0x1003
+ENDEL = 0x1100
+SNAME = 0x1206
+COLROW = 0x1302
+TEXTTYPE = 0x1602
+STRING = 0x1906
+STRANS = 0x1A01
+MAG = 0x1B05
+ANGLE = 0x1C05
+PATHTYPE = 0x2102
+BGNEXTN = 0x3003
+ENDEXTN = 0x3103
+
+
+# ============= records ===============
+
+# GDSII 8 byte real: sign, excess-64 base-16 exponent, 56 bit mantissa
+def decode_real8(data):
+    values = []
+    for k in range(0, len(data), 8):
+        raw = int.from_bytes(data[k:k+8], 'big')
+        sign = -1 if raw >> 63 else 1
+        exponent = (raw >> 56) & 0x7f
+        mantissa = raw & 0x00ffffffffffffff
+        values.append(sign*mantissa/2.0**56*16.0**(exponent - 64))
+    return values
+
+def decode(rtype, data):
+    kind = rtype & 0xff
+    if kind == 0x02:
+        return np.frombuffer(data, dtype='>i2').astype(np.int64)
+    if kind == 0x03:
+        return np.frombuffer(data, dtype='>i4').astype(np.int64)
+    if kind == 0x05:
+        return decode_real8(data)
+    if kind == 0x06:
+        return bytes(data).rstrip(b"\0").decode("latin-1")
+    if kind == 0x01:
+        return int.from_bytes(data, 'big')
+    return None
+
+# (record type, payload) of all records in buffer[start:end]
+def records(buffer, start, end):
+    position = start
+    while position < end:
+        length = int.from_bytes(buffer[position:position+2], 'big')
+        if length < 4:
+            break
+        rtype = int.from_bytes(buffer[position+2:position+4], 'big')
+        yield rtype, buffer[position+4:position+length]
+        position += length
+
+def encode(rtype, payload=b""):
+    if len(payload) % 2:
+        payload += b"\0"
+    return (len(payload) + 4).to_bytes(2, 'big') + rtype.to_bytes(2, 'big') + payload
+
+def encode_int2(rtype, values):
+    return encode(rtype, np.asarray(values, dtype='>i2').tobytes())
+
+def encode_int4(rtype, values):
+    return encode(rtype, np.asarray(values, dtype='>i4').tobytes())
+
+def encode_string(rtype, text):
+    return encode(rtype, text.encode("latin-1"))
+
+
+# ============= transformations ===============
+
+# affine transformation [2x3] of a reference: reflection about x, then
+# magnification and rotation, then the translation
+def placement(origin, reflect=False, mag=1.0, angle=0.0):
+    c = np.cos(np.radians(angle))*mag
+    s = np.sin(np.radians(angle))*mag
+    # exact for multiples of 90 degrees
+    c, s = [float(np.round(v)) if abs(v - np.round(v)) < 1e-12 else v for v in (c, s)]
+    f = -1.0 if reflect else 1.0
+    return np.array([[c, -s*f, origin[0]], [s, c*f, origin[1]]], dtype=np.float64)
+
+# transformation a applied after b
+def compose(a, b):
+    m = np.vstack([a, [0, 0, 1]]) @ np.vstack([b, [0, 0, 1]])
+    return m[:2]
+
+identity = placement((0, 0))
+
+def transform(matrix, ixy):
+    if matrix is identity:
+        return ixy
+    xy = ixy @ matrix[:, :2].T + matrix[:, 2]
+    return np.rint(xy).astype(np.int64)
+
+def scale(matrix):
+    return float(np.sqrt(abs(np.linalg.det(matrix[:, :2]))))
+
+
+# ============= reader ===============
+
+# one flat element: kind (BOUNDARY, PATH or TEXT), layer, datatype (the
+# texttype for texts), points [n,2] in database units and for paths the
+# width, path type and extensions, for texts the string
+class Element:
+    __slots__ = ("kind", "layer", "datatype", "xy", "width", "pathtype",
+        "extensions", "text")
+
+    def __init__(self, kind, layer, datatype, xy, width=0, pathtype=0,
+        extensions=None, text=None):
+        self.kind = kind
+        self.layer = layer
+        self.datatype = datatype
+        self.xy = xy
+        self.width = width
+        self.pathtype = pathtype
+        self.extensions = extensions
+        self.text = text
+
+    # lower and upper corner of the element, paths including their width
+    def bounds(self):
+        lower = self.xy.min(axis=0)
+        upper = self.xy.max(axis=0)
+        if self.kind == PATH:
+            grow = abs(self.width)//2 + (max(self.extensions) if self.extensions
+                else 0)
+            lower = lower - grow
+            upper = upper + grow
+        return lower, upper
+
+    def records(self):
+        parts = [encode(self.kind), encode_int2(LAYER, [self.layer])]
+        if self.kind == TEXT:
+            parts.append(encode_int2(TEXTTYPE, [self.datatype]))
+        else:
+            parts.append(encode_int2(DATATYPE, [self.datatype]))
+        if self.kind == PATH:
+            parts.append(encode_int2(PATHTYPE, [self.pathtype]))
+            parts.append(encode_int4(WIDTH, [self.width]))
+            if self.extensions is not None:
+                parts.append(encode_int4(BGNEXTN, [self.extensions[0]]))
+                parts.append(encode_int4(ENDEXTN, [self.extensions[1]]))
+        xy = self.xy
+        if self.kind == BOUNDARY:
+            xy = np.concatenate([xy, xy[:1]])
+        parts.append(encode_int4(XY, xy.ravel()))
+        if self.kind == TEXT:
+            parts.append(encode_string(STRING, self.text))
+        parts.append(encode(ENDEL))
+        return b"".join(parts)
+
+class GdsStream:
+    def __init__(self, file_name):
+        self.file = open(file_name, 'rb')
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        # cell name -> (first, end) byte range of its elements
+        self.cells = {}
+        self.referenced = set()
+        self.library_name = ""
+        self.units_record = None
+        self.index()
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+    # one pass over the file: units, the cells and the cells referenced
+    def index(self):
+        buffer = self.buffer
+        position = 0
+        name = None
+        first = 0
+        while position < len(buffer):
+            length = int.from_bytes(buffer[position:position+2], 'big')
+            if length < 4:
+                break
+            rtype = int.from_bytes(buffer[position+2:position+4], 'big')
+            payload = buffer[position+4:position+length]
+            if rtype == UNITS:
+                self.units_record = buffer[position:position+length]
+                self.units = decode_real8(payload)
+            elif rtype == LIBNAME:
+                self.library_name = decode(rtype, payload)
+            elif rtype == STRNAME:
+                name = decode(rtype, payload)
+                first = position + length
+            elif rtype == ENDSTR:
+                self.cells[name] = (first, position)
+            elif rtype == SNAME:
+                self.referenced.add(decode(rtype, payload))
+            elif rtype == ENDLIB:
+                break
+            position += length
+
+    # micrometer per database unit
+    def dbu(self):
+        return self.units[1]*1e6
+
+    # the top level cells in file order
+    def top_cells(self):
+        return [name for name in self.cells if name not in self.referenced]
+
+    # summary of an unflattened cell, as gds_backend.describe
+    def describe(self, name):
+        counts = {BOUNDARY:0, PATH:0, TEXT:0, SREF:0}
+        for kind, values in self.raw_elements(name):
+            counts[SREF if kind == AREF else kind] += 1
+        return ("Cell (\"" + name + "\", " + str(counts[BOUNDARY])
+        + " polygons, " + str(counts[PATH]) + " paths, "
+        + str(counts[TEXT]) + " labels, " + str(counts[SREF])
+        + " references)")
+
+    # raw elements of a cell: (element type, {record type: value})
+    def raw_elements(self, name):
+        first, end = self.cells[name]
+        element = None
+        for rtype, payload in records(self.buffer, first, end):
+            if rtype in (BOUNDARY, PATH, SREF, AREF, TEXT):
+                element = (rtype, {})
+            elif rtype == ENDEL:
+                if element is not None:
+                    yield element
+                element = None
+            elif element is not None:
+                element[1][rtype] = decode(rtype, payload)
+
+    # the flat elements of a cell under a transformation, one at a time
+    def elements(self, name, matrix=identity):
+        for kind, values in self.raw_elements(name):
+            if kind in (SREF, AREF):
+                strans = values.get(STRANS, 0)
+                reflect = bool(strans & 0x8000)
+                mag = values.get(MAG, [1.0])[0]
+                angle = values.get(ANGLE, [0.0])[0]
+                xy = values[XY].reshape(-1, 2)
+                if kind == SREF:
+                    origins = xy[:1]
+                else:
+                    cols, rows = [int(x) for x in values[COLROW]]
+                    column = (xy[1] - xy[0])/cols
+                    row = (xy[2] - xy[0])/rows
+                    origins = [xy[0] + c*column + r*row for r in range(rows)
+                        for c in range(cols)]
+                for origin in origins:
+                    inner = compose(matrix, placement(origin, reflect, mag, angle))
+                    yield from self.elements(values[SNAME], inner)
+                continue
+
+            xy = transform(matrix, values[XY].reshape(-1, 2))
+            layer = int(values[LAYER][0])
+            if kind == BOUNDARY:
+                # without the closing point
+                if len(xy) > 1 and np.all(xy[0] == xy[-1]):
+                    xy = xy[:-1]
+                yield Element(kind, layer, int(values.get(DATATYPE, [0])[0]), xy)
+            elif kind == PATH:
+                width = int(values.get(WIDTH, [0])[0])
+                if width > 0:
+                    width = int(round(width*scale(matrix)))
+                extensions = None
+                if BGNEXTN in values or ENDEXTN in values:
+                    extensions = [int(round(int(values.get(key, [0])[0])*scale(matrix)))
+                        for key in (BGNEXTN, ENDEXTN)]
+                yield Element(kind, layer, int(values.get(DATATYPE, [0])[0]), xy,
+                    width, int(values.get(PATHTYPE, [0])[0]), extensions)
+            else:
+                yield Element(kind, layer, int(values.get(TEXTTYPE, [0])[0]), xy[:1],
+                    text=values.get(STRING, ""))
+
+
+# ============= writer ===============
+
+# file header up to the elements of one cell, with the units of a stream
+def library_header(units_record, library_name, cell_name):
+    date = [2023, 1, 1, 0, 0, 0]*2
+    return (encode_int2(HEADER, [600]) + encode_int2(BGNLIB, date)
+        + encode_string(LIBNAME, library_name) + bytes(units_record)
+        + encode_int2(BGNSTR, date) + encode_string(STRNAME, cell_name))
+
+def library_trailer():
+    return encode(ENDSTR) + encode(ENDLIB)
@@ -0,0 +1,241 @@
+# Copyright 2023 J.N.G.W. Verest
+# j.n.g.w.verest@tue.nl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Incremental re-extraction for edit-extract loops
+# Both decks consist of sections (see fasthenry_sections/fastercap_sections)
+# which only depend on a part of the model and the stack data: the points
+# and edges of one path, one via cluster or pillar, the panels of one path
+# outline, the substrate or dielectric. IncrementalConverter remembers the
+# inputs of every section of the previous run and only regenerates the
+# sections whose inputs changed, the rest is spliced in from the last run.
+# Outline triangulations are reused the same way.
+
+# CAVEATS:
+#   The layout itself is still read and extracted completely, only the
+#   panels and the deck text are incremental. Changing one path (a feed
+#   length) regenerates that path, its neighbours in the node numbering and
+#   the via clusters, ports and substrate that refer to it. A changed value
+#   of the stack the sections get (layer_resistivities, ...) regenerates
+#   only the sections on that layer.
+#   The decks are identical to the ones of a full conversion.
+#
+#   Usage:
+#     engine = IncrementalConverter()
+#     for gds in sweep:
+#         result = engine.convert(gds)
+#         print(result["stats"])
+
+# File history:
+# Initial version
+
+
+import hashlib
+import numpy as np
+from pathlib import Path
+
+import gds_model
+import validate
+import sky130_stack
+import gds2fasthenry
+import gds2fastercap
+
+
+
+# default conversion options, as for gds2fastmodel.convert_fastmodel
+default_options = {
+"fasthenry_name":None, # .inp file name, derived from the input name if None
+"fastercap_name":None, # .qui file name, derived from the input name if None
+"solvers":["fasthenry", "fastercap"],
+"write":True,          # write the decks
+"verbose":False,       # print progress information
+"validate":True        # check the geometry first, see validate.py
+}
+
+# fingerprint of the inputs of a section
+def digest(*parts):
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            h.update(str(part.dtype).encode() + str(part.shape).encode())
+            h.update(np.ascontiguousarray(part).tobytes())
+        else:
+            h.update(repr(part).encode())
+        h.update(b"|")
+    return h.digest()
+
+
+# ============= section inputs ===============
+
+# Every function returns what a section is generated from, None for the
+# small sections which are cheaper to regenerate than to compare.
+
+def fasthenry_points_inputs(model, k, stack):
+    offsets = model["path_offsets"]
+    layer = str(model["path_layer"][k])
+    return (offsets[k], model["node_xy"][offsets[k]:offsets[k+1]],
+        stack["stack_heights"].get(layer))
+
+def fasthenry_edges_inputs(model, k, stack, mesh):
+    offsets = model["path_offsets"]
+    layer = str(model["path_layer"][k])
+    return (k, offsets[k], model["seg_width"][offsets[k]-k:offsets[k+1]-k-1],
+        stack["layer_heights"].get(layer),
+        stack["layer_resistivities"].get(layer), mesh["nwinc"])
+
+def fasthenry_via_inputs(model, c, stack):
+    offsets = model["path_offsets"]
+    i, j = [int(x) for x in model["cluster_paths"][c]]
+    layer = str(model["cluster_layer"][c])
+    return (i, j, model["cluster_ends"][c], model["cluster_count"][c],
+        model["cluster_xy"][c], offsets[i:i+2], offsets[j:j+2],
+        stack["stack_heights"].get(str(model["path_layer"][i])),
+        stack["stack_heights"].get(str(model["path_layer"][j])),
+        stack["via_resistivities"].get(layer))
+
+def fastercap_path_inputs(model, k, stack):
+    offsets = model["outline_offsets"]
+    tri_offsets = model["tri_offsets"]
+    layer = str(model["path_layer"][k])
+    side_port = model["side_port"][offsets[k]:offsets[k+1]]
+    names = [str(model["port_name"][p]) for p in side_port if p >= 0]
+    return (layer, model["outline_xy"][offsets[k]:offsets[k+1]],
+        model["tri_xy"][tri_offsets[k]:tri_offsets[k+1]], side_port, names,
+        stack["stack_top"].get(layer), stack["stack_bottom"].get(layer))
+
+def fastercap_via_inputs(model, v, stack):
+    offsets = model["via_offsets"]
+    layer = model["via_layer"][v]
+    return (model["via_xy"][offsets[v]:offsets[v+1]],
+        stack["stack_bottom"].get(str(layer+1)),
+        stack["stack_top"].get(str(layer)))
+
+section_inputs = {
+"fasthenry":{
+    "points":fasthenry_points_inputs,
+    "edges":fasthenry_edges_inputs,
+    "via":fasthenry_via_inputs
+    },
+"fastercap":{
+    "path":fastercap_path_inputs,
+    "via":fastercap_via_inputs
+    }
+}
+
+def deck_sections(solver, model):
+    if solver == "fasthenry":
+        return gds2fasthenry.fasthenry_sections(model)
+    return gds2fastercap.fastercap_sections(model)
+
+
+# ============= incremental conversion ===============
+
+class IncrementalConverter:
+    def __init__(self, backend=None, layerlist=sky130_stack.layerlist):
+        self.backend = backend
+        self.layerlist = layerlist
+        # per solver: fingerprint -> section text of the previous run
+        self.sections = {"fasthenry":{}, "fastercap":{}}
+        # outline -> triangles, see gds_model.add_panels
+        self.panels = {}
+        self.stats = {}
+
+    # model with panels, reusing the triangulation of known outlines
+    def model(self, library_or_path, panels=True, verbose=False):
+        model = gds_model.get_model(library_or_path, self.backend,
+            self.layerlist, panels=False, verbose=verbose)
+        if panels and not bool(model["has_panels"]):
+            offsets = model["outline_offsets"]
+            outlines = set(np.asarray(model["outline_xy"][offsets[k]:offsets[k+1]]).tobytes()
+                for k in range(len(offsets)-1))
+            self.stats["panels"] = {"reused":len(outlines & set(self.panels)),
+                "generated":len(outlines - set(self.panels))}
+            gds_model.add_panels(model, self.panels)
+            # keep only the outlines of this run
+            self.panels = {key:value for key, value in self.panels.items()
+                if (key[0] if isinstance(key, tuple) else key) in outlines}
+        return model
+
+    # deck text of one solver, unchanged sections come from the previous run
+    def deck(self, solver, model):
+        previous = self.sections[solver]
+        current = {}
+        parts = []
+        reused = 0
+        generated = 0
+        for name, function, arguments in deck_sections(solver, model):
+            inputs = None
+            if isinstance(name, tuple):
+                inputs_function = section_inputs[solver].get(name[0])
+                if inputs_function is not None:
+                    inputs = inputs_function(model, *arguments)
+            if inputs is None:
+                parts.append(function(model, *arguments))
+                continue
+            key = digest(name[0], *inputs)
+            if key in previous:
+                text = previous[key]
+                reused += 1
+            else:
+                text = function(model, *arguments)
+                generated += 1
+            current[key] = text
+            parts.append(text)
+        self.sections[solver] = current
+        self.stats[solver] = {"reused":reused, "generated":generated}
+        return "".join(parts)
+
+    # convert like gds2fastmodel.convert_fastmodel, returns the same dict
+    # plus the statistics of this run
+    def convert(self, library_or_path, options=None):
+        opts = dict(default_options)
+        if options:
+            opts.update(options)
+        verbose = opts["verbose"]
+        solvers = list(opts["solvers"])
+        self.stats = {}
+
+        model = self.model(library_or_path, panels=False, verbose=verbose)
+        if opts["validate"]:
+            validate.require_valid(model, solvers, verbose)
+        if "fastercap" in solvers:
+            model = self.model(model, panels=True)
+
+        if isinstance(library_or_path, (str, Path)):
+            stem = Path(library_or_path).stem
+        else:
+            stem = str(model["cell_name"][()])
+        output_names = {
+        "fasthenry":opts["fasthenry_name"] or stem + "out_fasthenry.inp",
+        "fastercap":opts["fastercap_name"] or stem + "_out_fastercap.qui"
+        }
+
+        result = {
+            "cell":str(model["cell_name"][()]),
+            "model":model
+        }
+        for solver in solvers:
+            deck = self.deck(solver, model)
+            output_name = output_names[solver]
+            if opts["write"]:
+                with open(output_name, 'w') as f:
+                    f.write(deck)
+            else:
+                output_name = None
+            result[solver] = {"deck":deck, "output_name":output_name}
+            if solver == "fasthenry":
+                result[solver]["f_max"] = gds2fasthenry.max_frequency(
+                    gds2fasthenry.path_length(model))
+        result["stats"] = dict(self.stats)
+        return result
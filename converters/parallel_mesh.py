@@ -0,0 +1,177 @@
+# Copyright 2023 J.N.G.W. Verest
+# j.n.g.w.verest@tue.nl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Parallel FasterCap mesh generation on all cores
+# The panels of every path (triangulation of the outline, port assignment of
+# the sides) and the deck text of every path face and via layer only depend
+# on the geometry model, so they are independent work units. The model
+# arrays are placed in shared memory once, the units run on a process pool
+# which attaches to them, and the results are collected in deck order: the
+# deck is identical to the one of gds2fastercap.write_fastercap.
+
+# CAVEATS:
+#   Starting the pool and sharing the model costs some 0.1 s, which only
+#   pays off for layouts with many paths or large outlines; with workers=1
+#   (the default of the converters) nothing changes. The via units are runs
+#   of pillars on the same layer, in model order.
+
+# File history:
+# Initial version
+
+
+import os
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+import gds_model
+import gds2fastercap
+import dbu_geometry
+
+
+
+# work units per worker and map call, fewer calls for many small units
+units_per_chunk = 4
+
+
+# ============= shared model ===============
+
+# copy the model arrays to shared memory blocks; returns the blocks, to be
+# released by the caller, and the descriptions the workers attach with
+def share_model(model):
+    blocks = []
+    descriptions = {}
+    for key, value in model.items():
+        value = np.ascontiguousarray(value)
+        block = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+        np.ndarray(value.shape, value.dtype, buffer=block.buf)[...] = value
+        blocks.append(block)
+        descriptions[key] = (block.name, value.shape, value.dtype.str)
+    return blocks, descriptions
+
+def release(blocks):
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+# the model as seen by a worker, read-only views on the shared blocks
+worker_model = {}
+worker_blocks = []
+
+def attach_model(descriptions):
+    worker_model.clear()
+    for key, (name, shape, dtype) in descriptions.items():
+        block = shared_memory.SharedMemory(name=name)
+        worker_blocks.append(block)
+        array = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+        array.flags.writeable = False
+        worker_model[key] = array
+
+def pool(descriptions, workers):
+    return ProcessPoolExecutor(max_workers=workers, initializer=attach_model,
+        initargs=(descriptions,))
+
+def chunk_size(units, workers):
+    return max(1, len(units)//(workers*units_per_chunk))
+
+def worker_count(workers):
+    return workers or os.cpu_count() or 1
+
+
+# ============= work units ===============
+
+# triangles and side ports of path k
+def panel_unit(k):
+    offsets = worker_model["outline_offsets"]
+    pts = np.array(worker_model["outline_xy"][offsets[k]:offsets[k+1]])
+    return (gds_model.triangulate_outline(pts),
+        gds_model.side_ports(pts, worker_model["port_xy"],
+            dbu_geometry.model_unit(worker_model)))
+
+# deck text of a ("face", path, face), ("shield", group),
+# ("vias", first, last) or ("via_box", layer, box) unit
+def deck_unit(unit):
+    if unit[0] == "face":
+        return gds2fastercap.deck_face(worker_model, unit[1], unit[2])
+    if unit[0] == "shield":
+        return gds2fastercap.deck_shield(worker_model, unit[1])
+    if unit[0] == "via_box":
+        return gds2fastercap.deck_via_box(worker_model, unit[1], unit[2])
+    return "".join(gds2fastercap.deck_via(worker_model, v)
+        for v in range(unit[1], unit[2]))
+
+# runs of via pillars on the same layer as (first, last+1)
+def via_runs(via_layer):
+    if len(via_layer) == 0:
+        return []
+    starts = np.flatnonzero(np.diff(via_layer)) + 1
+    edges = [0] + list(starts) + [len(via_layer)]
+    return [(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:])]
+
+
+# ============= parallel stages ===============
+
+# as gds_model.add_panels, the outlines triangulated in parallel
+def add_panels(model, workers=None):
+    workers = worker_count(workers)
+    paths = list(range(len(model["outline_offsets"])-1))
+    blocks, descriptions = share_model(model)
+    try:
+        with pool(descriptions, workers) as executor:
+            results = list(executor.map(panel_unit, paths,
+                chunksize=chunk_size(paths, workers)))
+    finally:
+        release(blocks)
+
+    triangles = [t for t, ports in results]
+    side_port = [ports for t, ports in results]
+    model["side_port"] = np.concatenate(side_port) if side_port \
+        else np.zeros(0, dtype=np.int32)
+    tri, tri_offsets = gds_model.pack([t.reshape(-1, 2) for t in triangles],
+        dtype=np.int64)
+    model["tri_xy"] = tri.reshape(-1, 3, 2)
+    model["tri_offsets"] = tri_offsets // 3
+    model["has_panels"] = np.array(True)
+    return model
+
+# as gds2fastercap.write_fastercap, the faces and via layers in parallel
+def write_fastercap(model, output_file, workers=None):
+    workers = worker_count(workers)
+    units = [("face", k, face) for k in range(len(model["path_layer"]))
+        for face in gds2fastercap.faces]
+    units += [("shield", s) for s in range(len(model["shield_layer"]))]
+    # the via header goes before the first via unit
+    first_via = len(units)
+    if gds2fastercap.default_mesh["via_boxes"]:
+        units += [("via_box", layer, box) for layer, box in
+            gds2fastercap.via_groups(model, gds2fastercap.default_mesh["via_box_gap"])]
+    else:
+        units += [("vias", a, b) for a, b in via_runs(model["via_layer"])]
+    blocks, descriptions = share_model(model)
+    try:
+        with pool(descriptions, workers) as executor:
+            # map returns the texts in the order of the units
+            texts = executor.map(deck_unit, units,
+                chunksize=chunk_size(units, workers))
+            output_file.write(gds2fastercap.deck_header(model))
+            for index, text in enumerate(texts):
+                if index == first_via:
+                    output_file.write(gds2fastercap.deck_via_header(model))
+                output_file.write(text)
+            if len(units) == first_via:
+                output_file.write(gds2fastercap.deck_via_header(model))
+    finally:
+        release(blocks)
+    output_file.write(gds2fastercap.deck_dielectric(model))
@@ -0,0 +1,161 @@
+# Copyright 2023 J.N.G.W. Verest
+# j.n.g.w.verest@tue.nl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# SKY130 layer and stack data shared by the converters
+# One copy of the tables, so the FastHenry2 and FasterCap decks of a layout
+# always use the same layers, heights and materials.
+
+# CAVEATS:
+#   FastHenry2 uses the center height of a metal (stack_heights) and its
+#   thickness (layer_heights), FasterCap the bottom and top of the metal
+#   (stack_bottom, stack_top). All values are strings as written to the decks,
+#   except for the via data.
+
+# File history:
+# Initial version
+
+
+
+# SKY130 data
+
+# layers to be examined  
+layerlist = [
+67, # LI
+68, # M1
+69, # M2
+70, # M3
+71, # M4
+72  # M5
+]
+
+# list of purpose to evaluate
+purposelist = [
+16, # pin
+20, # drawing
+44, # via
+]
+
+# list of materialnames for each GDSII layer number
+layermapping_metal = {
+"67":"LI",
+"68":"Metal1",
+"69":"Metal2",
+"70":"Metal3",
+"71":"Metal4",
+"72":"Metal5"
+}
+layermapping_via = {
+"67":"Mcon",
+"68":"Via1",
+"69":"Via2",
+"70":"Via3",
+"71":"Via4"
+}
+
+ # as found in [1], center value chosen
+stack_heights = {
+"67":"0.9736",
+"68":"1.5561",
+"69":"2.1861",
+"70":"3.2086",
+"71":"4.4436",
+"72":"6.0011"
+}
+
+ # as found in [1]
+layer_heights = {
+"67":"0.1",
+"68":"0.36",
+"69":"0.36",
+"70":"0.845",
+"71":"0.845",
+"72":"1.26"
+}
+
+ # as found in [1]
+stack_bottom = {
+"67":"0.9361",
+"68":"1.3761",
+"69":"2.0061",
+"70":"2.7861",
+"71":"4.0211",
+"72":"5.3711"
+}
+
+ # as found in [1]
+stack_top = {
+"67":"1.0361",
+"68":"1.7361",
+"69":"2.3661",
+"70":"3.6311",
+"71":"4.8661",
+"72":"6.6311"
+}
+
+# unit resistivity of the substrate, as given by Tim Edwards. This is allegedly in a document, which is not cited. See this as a ball-park figure [3].
+rho_subs = 4400; # Ohm/square
+
+
+ # Equivalent resistivity calculated using rho = R*A/l, with parasitic
+ # resistance found in [2], in [Ohm.um]
+layer_resistivities = {
+"67":"1.28",
+"68":"4.50e-2",
+"69":"4.50e-2",
+"70":"3.97e-2",
+"71":"3.97e-2",
+"72":"3.59e-2"
+}
+
+via_resistivities = {
+"68":0.375,
+"69":0.325,
+"70":0.35,
+"71":0.482
+}
+
+# all tables a deck depends on, the default stack of the deck writers; a
+# variant of the stack (see corners.py) is a dict of the same keys, the
+# tables above are never changed
+default_stack = {
+"stack_heights":stack_heights,
+"stack_bottom":stack_bottom,
+"stack_top":stack_top,
+"layer_heights":layer_heights,
+"layer_resistivities":layer_resistivities,
+"via_resistivities":via_resistivities,
+"rho_subs":rho_subs
+}
+
+via_widths = {
+"68":0.15,
+"69":0.2,
+"70":.2,
+"71":0.8
+}
+
+# get layername/materialname from GDSII layer number 
+def layernum2layername (num, id):
+    if(id==16) or (id==20):
+        layername = layermapping_metal.get(str(num),"unknown")
+    if(id==44):
+        layername = layermapping_via.get(str(num),"unknown")
+    return layername
+
+
+# References:
+# [1]   https://skywater-pdk.readthedocs.io/en/main/rules/assumptions.html#process-stack-diagram
+# [2]   https://skywater-pdk.readthedocs.io/en/main/rules/rcx.html#resistance-values, in “SKY130 Stackup Capacitance Data” spreadsheet.
+# [3]   https://open-source-silicon.slack.com/archives/C016HUV935L/p1704550228823649?thread_ts=1704545442.597049&cid=C016HUV935L
@@ -0,0 +1,385 @@
+# Copyright 2023 J.N.G.W. Verest
+# j.n.g.w.verest@tue.nl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Solver cost prediction and mesh budgeting
+# The runtime and memory of FastHenry2 and FasterCap are predicted from the
+# mesh statistics of the generated decks: the filaments of all segments
+# (nwinc x nhinc) plus the segments of the substrate plane (seg1, seg2) and
+# the number of frequencies for FastHenry2, the panels (triangles and quads
+# of the paths, shields and vias) for FasterCap. Both are power laws in the
+# number of unknowns, calibrated by solver runs on the benchmark layouts.
+# In budget mode the mesh parameters of the converters are coarsened step
+# by step, always the step that lowers the predicted cost most, until the
+# prediction fits the given time and memory limits. The coarser meshes are
+# copies passed to the deck writers, the default mesh tables of the
+# converters are never changed, so other threads are not affected.
+
+# CAVEATS:
+#   Without a calibration (solver_cost.json) rough defaults are used, fine
+#   for telling seconds from hours but not more. FasterCap refines the
+#   panels itself, so its cost also depends on the accuracy argument, which
+#   is taken to be the one of the calibration. The coarsening steps are:
+#   fewer filaments per segment (nwinc, down to 3) and a coarser substrate
+#   plane (down to 8 cells per side) for FastHenry2, one box per group of
+#   via pillars for FasterCap. Peak memory of a solver run is sampled every
+#   50 ms. Calibration cases that do not convert or solve are skipped and
+#   listed in the calibration file.
+#
+#   Usage:
+#     python solver_cost.py [gds_file]                    predicted cost
+#     python solver_cost.py [gds_file] [seconds] [MB]     decks within budget
+#     python solver_cost.py calibrate                     calibrate, needs
+#                                                         both solvers
+
+# File history:
+# Initial version
+
+
+import os
+import re
+import sys
+import json
+import time
+import tempfile
+import subprocess
+import numpy as np
+from pathlib import Path
+
+import gds2fasthenry
+import gds2fastercap
+
+
+
+converter_dir = Path(__file__).resolve().parent
+calibration_default = converter_dir / "solver_cost.json"
+
+# uncalibrated cost models: time = time*n^time_exponent per solve, memory =
+# memory_base + memory*n^memory_exponent, n the unknowns, time in s and
+# memory in bytes
+default_coefficients = {
+"fasthenry":{"time":2e-6, "time_exponent":1.5,
+    "memory_base":20e6, "memory":4e3, "memory_exponent":1.0},
+"fastercap":{"time":1e-4, "time_exponent":1.2,
+    "memory_base":20e6, "memory":3e4, "memory_exponent":1.0}
+}
+
+# coarsening steps, tried in this order of values; below 3 filaments the
+# current crowding at the edges of a segment is lost
+nwinc_steps = [20, 14, 10, 7, 5, 3]
+substrate_factor = 1.5
+# the substrate plane keeps at least this many cells per side, or as many
+# as the deck had before coarsening if that is less
+min_substrate_segments = 8
+
+# benchmark layouts of the calibration, see benchmark.py
+calibration_cases = {
+"octagon":[2, 4, 8],
+"via_farm":[8, 16, 32],
+"pgs":[50, 100]
+}
+
+
+# ============= mesh statistics ===============
+
+# unknowns and solves of a FastHenry2 deck
+def fasthenry_statistics(deck):
+    filaments = 0
+    segments = 0
+    for line in re.findall(r"^E\S*\s.*$", deck, flags=re.MULTILINE):
+        nwinc = re.search(r"\bnwinc=(\d+)", line)
+        nhinc = re.search(r"\bnhinc=(\d+)", line)
+        filaments += (int(nwinc.group(1)) if nwinc else 1)*(int(nhinc.group(1)) if nhinc else 1)
+        segments += 1
+    # a plane of seg1 x seg2 cells has a segment along every cell edge
+    plane = sum(int(a)*(int(b)+1) + int(b)*(int(a)+1) for a, b in
+        re.findall(r"\bseg1=(\d+)\s+seg2=(\d+)", deck))
+    frequencies = 1
+    card = re.search(r"^\.freq\s+fmin=(\S+)\s+fmax=(\S+)\s+ndec=(\S+)", deck,
+        flags=re.MULTILINE)
+    if card is not None:
+        fmin, fmax, ndec = [float(x) for x in card.groups()]
+        if fmax > fmin:
+            frequencies = int(np.floor(ndec*np.log10(fmax/fmin) + 1e-9)) + 1
+    return {"segments":segments, "filaments":filaments, "plane":plane,
+        "unknowns":filaments + plane, "repeats":frequencies}
+
+# unknowns of a FasterCap deck, the panels of all conductors and dielectrics
+def fastercap_statistics(deck):
+    triangles = len(re.findall(r"^T\s", deck, flags=re.MULTILINE))
+    quads = len(re.findall(r"^Q\s", deck, flags=re.MULTILINE))
+    conductors = set(re.findall(r"^[TQ]\s+(\S+)",
+        deck.split("\nEND", 1)[0], flags=re.MULTILINE))
+    return {"triangles":triangles, "quads":quads,
+        "conductors":len(conductors), "unknowns":triangles + quads, "repeats":1}
+
+def statistics(solver, deck):
+    if solver == "fasthenry":
+        return fasthenry_statistics(deck)
+    return fastercap_statistics(deck)
+
+
+# ============= cost model ===============
+
+# coefficients of the calibration file, the defaults for missing solvers
+def load_coefficients(path=None):
+    coefficients = {solver:dict(c) for solver, c in default_coefficients.items()}
+    path = Path(path or calibration_default)
+    if path.exists():
+        with open(path) as f:
+            for solver, c in json.load(f)["coefficients"].items():
+                coefficients[solver].update(c)
+    return coefficients
+
+# predicted time in s and memory in bytes of a solver run
+def predict(solver, stats, coefficients=None):
+    c = (coefficients or load_coefficients())[solver]
+    n = max(stats["unknowns"], 1)
+    return {"time":float(c["time"]*n**c["time_exponent"]*stats["repeats"]),
+        "memory":float(c["memory_base"] + c["memory"]*n**c["memory_exponent"])}
+
+# largest ratio of predicted to allowed cost, <= 1 if within the budget
+def budget_ratio(predicted, budget):
+    ratios = [predicted[key]/budget[key] for key in ("time", "memory")
+        if budget.get(key)]
+    return max(ratios, default=0.0)
+
+# coefficient and exponent of y = a*n^p, the exponent fitted if there are
+# at least two sizes, otherwise the default one
+def fit_power(n, y, exponent):
+    n = np.asarray(n, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    keep = (n > 0) & (y > 0)
+    n, y = n[keep], y[keep]
+    if len(n) == 0:
+        return None, exponent
+    if len(np.unique(n)) >= 2:
+        exponent, log_a = np.polyfit(np.log(n), np.log(y), 1)
+        return float(np.exp(log_a)), float(exponent)
+    return float(np.exp(np.mean(np.log(y) - exponent*np.log(n)))), exponent
+
+# cost coefficients of one solver from measured runs, each with the mesh
+# statistics, time and memory; the base memory is most of the smallest run
+def fit_coefficients(solver, runs):
+    c = dict(default_coefficients[solver])
+    n = [run["unknowns"] for run in runs]
+    a, p = fit_power(n, [run["time"]/run["repeats"] for run in runs],
+        c["time_exponent"])
+    if a is not None:
+        c["time"], c["time_exponent"] = a, p
+    memory = [run["memory"] for run in runs if run.get("memory")]
+    if memory:
+        c["memory_base"] = 0.9*min(memory)
+        a, p = fit_power([run["unknowns"] for run in runs if run.get("memory")],
+            [m - c["memory_base"] for m in memory], c["memory_exponent"])
+        if a is not None:
+            c["memory"], c["memory_exponent"] = a, p
+    return c
+
+
+# ============= budget mode ===============
+
+# the default mesh of a solver
+def solver_mesh(solver):
+    if solver == "fasthenry":
+        return gds2fasthenry.default_mesh
+    return gds2fastercap.default_mesh
+
+# the possible next coarsening steps of a mesh, none beyond the coarsest
+# mesh; baseline is the mesh before coarsening
+def coarsening_steps(solver, model, mesh, baseline=None):
+    if solver == "fasthenry":
+        baseline = baseline or mesh
+        steps = [("nwinc", n) for n in nwinc_steps if n < mesh["nwinc"]][:1]
+        length = gds2fasthenry.path_length(model)
+        segments = min(min_substrate_segments,
+            np.ceil(length/baseline["substrate_length"]))
+        coarser = mesh["substrate_length"]*substrate_factor
+        if np.ceil(length/coarser) >= segments:
+            steps.append(("substrate_length", coarser))
+        return steps
+    steps = []
+    if not mesh["via_boxes"] and len(model["via_layer"]):
+        steps.append(("via_boxes", True))
+    return steps
+
+def render(solver, model, mesh):
+    import gds2fastmodel
+    return gds2fastmodel.render_deck(solver, model, False, mesh)[0]
+
+# coarsen the mesh of a deck, made with the default mesh, until its
+# predicted cost fits the budget, a dict with "time" in s and/or "memory"
+# in bytes. Returns the deck and its cost: the mesh used, the statistics,
+# the prediction and whether it fits
+def fit_budget(solver, model, deck, budget, verbose=False, coefficients=None):
+    coefficients = coefficients or load_coefficients()
+    stats = statistics(solver, deck)
+    predicted = predict(solver, stats, coefficients)
+    baseline = solver_mesh(solver)
+    mesh = dict(baseline)
+    steps = coarsening_steps(solver, model, mesh)
+    applied = []
+    while budget_ratio(predicted, budget) > 1 and steps:
+        best = None
+        for key, value in steps:
+            trial_mesh = dict(mesh)
+            trial_mesh[key] = value
+            trial = render(solver, model, trial_mesh)
+            trial_stats = statistics(solver, trial)
+            trial_predicted = predict(solver, trial_stats, coefficients)
+            ratio = budget_ratio(trial_predicted, budget)
+            if best is None or ratio < best[0]:
+                best = (ratio, key, value, trial, trial_stats, trial_predicted)
+        ratio, key, value, deck, stats, predicted = best
+        mesh[key] = value
+        applied.append((key, value))
+        steps = coarsening_steps(solver, model, mesh, baseline)
+        if verbose:
+            print(solver + " mesh " + key + "=" + str(value)
+            + ": " + format_cost(predicted))
+    fits = budget_ratio(predicted, budget) <= 1
+    if verbose and not fits:
+        print("WARNING: " + solver + " deck exceeds the budget at the coarsest mesh")
+    return deck, {"mesh":mesh, "steps":applied,
+        "statistics":stats, "predicted":predicted, "fits":fits}
+
+def format_cost(predicted):
+    return (('%.3g' % predicted["time"]) + " s, "
+        + ('%.3g' % (predicted["memory"]/1e6)) + " MB")
+
+
+# ============= calibration ===============
+
+# run a solver, returns the wall time and the peak resident memory; the
+# memory is sampled from /proc, ru_maxrss of a child would include the
+# size of this process at the fork
+def measure_run(arguments, work_dir, timeout):
+    peak = 0
+    t_start = time.perf_counter()
+    with open(os.path.join(work_dir, "solver.log"), 'w') as log:
+        proc = subprocess.Popen(arguments, cwd=work_dir, stdout=log,
+            stderr=subprocess.STDOUT)
+        while True:
+            try:
+                proc.wait(timeout=0.05)
+                break
+            except subprocess.TimeoutExpired:
+                if time.perf_counter() - t_start > timeout:
+                    proc.kill()
+                    proc.wait()
+                    raise
+            try:
+                with open("/proc/" + str(proc.pid) + "/status") as status:
+                    for line in status:
+                        if line.startswith("VmHWM:"):
+                            peak = max(peak, int(line.split()[1])*1024)
+            except OSError:
+                pass
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, arguments)
+    return {"time":time.perf_counter() - t_start, "memory":peak or None}
+
+# solver run of one deck with its mesh statistics
+def solve_run(solver, deck, timeout):
+    import fastsolve
+    executable = fastsolve.find_solver(solver)
+    if executable is None:
+        raise FileNotFoundError(solver + " not found, set " + solver.upper())
+    with tempfile.TemporaryDirectory() as work_dir:
+        if solver == "fasthenry":
+            deck_name = os.path.join(work_dir, "deck.inp")
+            arguments = [executable, deck_name]
+        else:
+            deck_name = os.path.join(work_dir, "deck.qui")
+            arguments = [executable, "-b", deck_name] + list(
+                fastsolve.default_options["fastercap_args"])
+        with open(deck_name, 'w') as f:
+            f.write(deck)
+        run = measure_run(arguments, work_dir, timeout)
+    run.update(statistics(solver, deck))
+    return run
+
+# calibrate the cost models on the benchmark layouts and store them; a
+# case that does not convert (e.g. fails validation) or whose solver run
+# fails is skipped and listed with its error
+def calibrate(cases=None, solvers=("fasthenry", "fastercap"), path=None,
+    timeout=3600, verbose=True):
+    import benchmark
+    import fastsolve
+    for solver in solvers:
+        if fastsolve.find_solver(solver) is None:
+            raise FileNotFoundError(solver + " not found, set " + solver.upper())
+    runs = {solver:[] for solver in solvers}
+    skipped = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for case, sizes in (cases or calibration_cases).items():
+            for size in sizes:
+                gds_file = os.path.join(work_dir, case + "_" + str(size) + ".gds")
+                benchmark.generate_layout(case, size, gds_file)
+                for solver in solvers:
+                    try:
+                        if solver == "fasthenry":
+                            deck = gds2fasthenry.convert_fasthenry(gds_file,
+                                {"write":False, "verbose":False})["deck"]
+                        else:
+                            deck = gds2fastercap.convert_fastercap(gds_file,
+                                {"write":False, "verbose":False})["deck"]
+                        run = solve_run(solver, deck, timeout)
+                    except (ValueError, ArithmeticError, IndexError,
+                        subprocess.SubprocessError) as e:
+                        skipped.append({"solver":solver, "case":case,
+                            "size":size, "error":type(e).__name__ + ": " + str(e)})
+                        if verbose:
+                            print(solver + " " + case + " " + str(size)
+                            + ": skipped, " + skipped[-1]["error"])
+                        continue
+                    run.update(case=case, size=size)
+                    runs[solver].append(run)
+                    if verbose:
+                        print(solver + " " + case + " " + str(size) + ": "
+                        + str(run["unknowns"]) + " unknowns, " + format_cost(
+                        dict(run, memory=run["memory"] or 0)))
+    for solver in solvers:
+        if not runs[solver]:
+            raise RuntimeError("no calibration run of " + solver + " succeeded")
+    calibration = {"coefficients":{solver:fit_coefficients(solver, runs[solver])
+        for solver in solvers}, "runs":runs, "skipped":skipped}
+    with open(path or calibration_default, 'w') as f:
+        json.dump(calibration, f, indent=1)
+    return calibration
+
+
+# ============= main ===============
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "calibrate":
+        calibration = calibrate()
+        print(json.dumps(calibration["coefficients"], indent=1))
+    elif len(sys.argv) >= 2:
+        options = {"verbose":False}
+        if len(sys.argv) >= 3:
+            options["budget"] = {"time":float(sys.argv[2])}
+            if len(sys.argv) >= 4:
+                options["budget"]["memory"] = float(sys.argv[3])*1e6
+        else:
+            options["write"] = False
+        for solver, convert in (("fasthenry", gds2fasthenry.convert_fasthenry),
+            ("fastercap", gds2fastercap.convert_fastercap)):
+            result = convert(sys.argv[1], options)
+            stats = statistics(solver, result["deck"])
+            print(solver + ": " + str(stats["unknowns"]) + " unknowns, "
+            + format_cost(predict(solver, stats))
+            + ("" if result["cost"] is None else ", mesh " + str(result["cost"]["mesh"])))
+    else:
+        print ("Usage: solver_cost.py [gds_file] [seconds] [MB] | calibrate")
@@ -0,0 +1,442 @@
+# Copyright 2023 J.N.G.W. Verest
+# j.n.g.w.verest@tue.nl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tiled, out-of-core conversion of large layouts
+# The converters hold the flattened cell and the whole geometry model in
+# memory, which a full chip does not fit in. Here the layout is streamed
+# (see gds_stream.py) and cut into square tiles in two passes:
+#   1. every flat element is appended to a small GDS file per tile: paths
+#      and via pillars to all tiles whose core or halo they overlap, other
+#      polygons to their owner only, the tile of their first vertex. Pins
+#      and labels are few and are paired to ports at once.
+#   2. the tiles are extracted one after the other with gds_model, and only
+#      what a tile owns is written: paths and via pillars by their first
+#      vertex, via clusters by their center. The deck fragments are
+#      appended to spill files, which are concatenated into the decks.
+# A path crossing tiles is owned by one of them and present in the halo of
+# the others, so a via cluster always sees both of its paths. Node names
+# are derived from the path geometry, equal in every tile, which stitches
+# the .equiv of a via to a path of another tile. Peak memory depends on the
+# tile size and the layout density, not on the size of the layout.
+
+# CAVEATS:
+#   The halo has to cover the via clusters (the path ends and the pillars
+#   between them); 50 um is plenty for the IndLib devices. Clusters of
+#   paths far apart, and clusters without pillars, which extract_clusters
+#   also finds, are left out, so is the validation of the full model.
+#   Via arrays are flattened pillar by pillar. A patterned ground shield is
+#   aggregated per tile, so a shield cut by tile borders gives more (and a
+#   shield with less than gds_model.shield_min_fingers fingers in a tile no)
+#   PGS plates and FastHenry2 shield strips. Node names are hashes ("N" +
+#   12 hex digits + "_" + node); paths, vias and ports are in tile order,
+#   so the decks hold the same elements as the ones of gds2fasthenry.py and
+#   gds2fastercap.py but not in the same order. As in deck_ports, only the
+#   last port pair is written as .external.
+#
+#   Usage:
+#     python tiled.py [gds_file] [tile_um] [halo_um]
+
+# File history:
+# Initial version
+
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from pathlib import Path
+from collections import OrderedDict
+
+import gds_stream
+import gds_model
+import gds2fasthenry
+import gds2fastercap
+import dbu_geometry
+from sky130_stack import layerlist
+
+
+
+# default conversion options
+default_options = {
+"tile":500.0,          # um, edge of a square tile
+"halo":50.0,           # um around a tile which is read along with it
+"solvers":("fasthenry", "fastercap"), # decks to write
+"fasthenry_name":None, # .inp file name, derived from the input name if None
+"fastercap_name":None, # .qui file name, derived from the input name if None
+"cell":None,           # cell to convert, the first top level cell if None
+"backend":None,        # geometry backend of the tiles, see gds_backend.py
+"open_files":64,       # tile files kept open while streaming
+"work_dir":None,       # tiles and fragments, a temporary directory if None
+"verbose":True         # print progress information
+}
+
+
+# ============= pass 1: tiles ===============
+
+# appends to the tile files, a few of them open at a time; every file
+# starts with the library header and is closed with the trailer
+class TileWriter:
+    def __init__(self, directory, header, open_files):
+        self.directory = directory
+        self.header = header
+        self.open_files = open_files
+        self.files = OrderedDict()
+        self.created = set()
+
+    def path(self, tile):
+        return os.path.join(self.directory, "tile_%d_%d.gds" % tile)
+
+    def write(self, tile, data):
+        f = self.files.pop(tile, None)
+        if f is None:
+            if len(self.files) >= self.open_files:
+                self.files.popitem(last=False)[1].close()
+            f = open(self.path(tile), 'ab')
+            if tile not in self.created:
+                f.write(self.header)
+                self.created.add(tile)
+        # most recently used last
+        self.files[tile] = f
+        f.write(data)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+        for tile in self.created:
+            with open(self.path(tile), 'ab') as f:
+                f.write(gds_stream.library_trailer())
+
+# tile (column, row) of DBU points [..., 2]
+def tile_of(ixy, size):
+    return np.floor_divide(np.asarray(ixy, dtype=np.int64), size)
+
+# stream the layout into tile files; returns the cell name and summary,
+# the database unit, the tiles that own anything, the ports and the
+# extent of the pins, which are not in any tile
+def split_layout(file_name, directory, opts):
+    stream = gds_stream.GdsStream(file_name)
+    try:
+        name = opts["cell"] or stream.top_cells()[0]
+        dbu = stream.dbu()
+        size = int(round(opts["tile"]/dbu))
+        halo = int(round(opts["halo"]/dbu))
+        writer = TileWriter(directory, gds_stream.library_header(
+            stream.units_record, stream.library_name, name), opts["open_files"])
+
+        owners = set()
+        pins = {}
+        labels = []
+        pin_extent = 0.0
+        for element in stream.elements(name):
+            if element.kind == gds_stream.TEXT:
+                labels.append((element.text, element.xy[0]*dbu))
+                continue
+            if element.kind == gds_stream.BOUNDARY \
+                and element.datatype == gds_model.pin_datatype:
+                pins.setdefault((element.layer, element.datatype), []).append(
+                    element.xy*dbu)
+                pin_extent = max(pin_extent, float(np.sqrt(np.max(np.sum(
+                    np.square(element.xy*dbu), axis=1)))))
+                continue
+
+            data = element.records()
+            owner = tuple(int(x) for x in tile_of(element.xy[0], size))
+            owners.add(owner)
+            if element.kind == gds_stream.BOUNDARY \
+                and element.datatype != gds_model.via_datatype:
+                writer.write(owner, data)
+                continue
+            lower, upper = element.bounds()
+            first = tile_of(lower - halo, size)
+            last = tile_of(upper + halo, size)
+            for column in range(first[0], last[0]+1):
+                for row in range(first[1], last[1]+1):
+                    writer.write((column, row), data)
+        writer.close()
+
+        ports = gds_model.pair_ports(pins, labels, layerlist)
+        return {
+            "cell":name,
+            "description":stream.describe(name),
+            "dbu":dbu,
+            "size":size,
+            "owners":sorted(owners),
+            "tile_path":writer.path,
+            "ports":ports,
+            "pin_extent":pin_extent
+        }
+    finally:
+        stream.close()
+
+
+# ============= pass 2: extraction ===============
+
+def digest(data, size=6):
+    return hashlib.blake2b(data, digest_size=size).hexdigest()
+
+# node names of all paths of a tile model, from the layer and the DBU
+# points of the path, so the same in every tile that reads the path
+def name_nodes(model):
+    offsets = model["path_offsets"]
+    ixy = np.ascontiguousarray(model["node_xy"])
+    path_keys = []
+    names = []
+    for k in range(len(offsets)-1):
+        key = digest(np.int64(model["path_layer"][k]).tobytes()
+            + ixy[offsets[k]:offsets[k+1]].tobytes())
+        path_keys.append(key)
+        names += ["N" + key + "_" + str(i) for i in range(offsets[k+1]-offsets[k])]
+    model["node_name"] = np.array(names, dtype=str)
+
+    # clusters by their two paths and path ends
+    model["cluster_name"] = np.array([digest((path_keys[i] + path_keys[j]
+        + str(a) + str(b)).encode()) for (i, j), (a, b)
+        in zip(model["cluster_paths"], model["cluster_ends"])], dtype=str)
+    return model
+
+# the deck fragments of one tile, appended to the spill files
+class Fragments:
+    def __init__(self, directory, solvers):
+        names = []
+        if "fasthenry" in solvers:
+            names += ["points", "edges", "vias", "shields"]
+        if "fastercap" in solvers:
+            names += ["panels", "pillars"]
+        self.paths = {name:os.path.join(directory, name + ".txt") for name in names}
+        self.files = {name:open(path, 'w') for name, path in self.paths.items()}
+
+        # global parts of the decks
+        self.paths_written = 0
+        self.total_length = 0.0
+        self.max_dimension = 0.0
+        self.last_layer = None
+        self.port_nodes = []
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+    def copy(self, name, output_file):
+        with open(self.paths[name]) as f:
+            shutil.copyfileobj(f, output_file)
+
+# extract tile and write what it owns
+def extract_tile(tile, layout, opts, fragments):
+    solvers = opts["solvers"]
+    dbu = layout["dbu"]
+    size = layout["size"]
+    model = gds_model.model_from_layout(layout["tile_path"](tile), opts["backend"],
+        layerlist, panels=False)
+
+    # the ports of the whole layout, for the side panels and .external
+    ports = layout["ports"]
+    model["port_name"] = np.array([p[0] for p in ports], dtype=str)
+    model["port_layer"] = np.array([p[1] for p in ports], dtype=np.int32)
+    model["port_xy"] = np.array([p[2] for p in ports],
+        dtype=np.float64).reshape(-1, 2)
+    if "fastercap" in solvers:
+        gds_model.add_panels(model)
+    name_nodes(model)
+    model["shield_name"] = np.array([digest((str(tile) + "_" + str(s)).encode())
+        for s in range(len(model["shield_layer"]))], dtype=str)
+
+    # tile of um positions, in the database units of the stream
+    def owned(xy):
+        keys = tile_of(dbu_geometry.to_dbu(xy, dbu), size)
+        return np.all(keys == np.array(tile), axis=-1)
+
+    unit = dbu_geometry.model_unit(model)
+    offsets = model["path_offsets"]
+    paths = np.flatnonzero(owned(dbu_geometry.to_um(
+        model["node_xy"][offsets[:-1]], unit))) if len(offsets) > 1 else []
+    via_offsets = model["via_offsets"]
+    pillars = np.flatnonzero(owned(dbu_geometry.to_um(
+        model["via_xy"][via_offsets[:-1]], unit))) if len(via_offsets) > 1 else []
+    clusters = [c for c in range(len(model["cluster_count"]))
+        if model["cluster_count"][c] > 0 and owned(model["cluster_xy"][c])]
+    fragments.max_dimension = max(fragments.max_dimension,
+        float(model["max_dimension"]))
+    if len(paths):
+        fragments.last_layer = int(model["path_layer"][paths[-1]])
+
+    if "fasthenry" in solvers:
+        files = fragments.files
+        node_xy = dbu_geometry.to_um(model["node_xy"], unit)
+        for k in paths:
+            files["points"].write(gds2fasthenry.deck_points(model, k))
+            # the path number in the comment counts over all tiles
+            edges = gds2fasthenry.deck_edges(model, k)
+            header = "\n* EDGES PATH["+ str(k) +"] \n"
+            files["edges"].write("\n* EDGES PATH["+ str(fragments.paths_written)
+                +"] \n" + edges[len(header):])
+            fragments.paths_written += 1
+            diff = np.diff(node_xy[offsets[k]:offsets[k+1]], axis=0)
+            fragments.total_length += float(np.sum(np.sqrt(np.sum(
+                np.square(diff), axis=1))))
+        for c in clusters:
+            files["vias"].write(gds2fasthenry.deck_via(model, c))
+        for s in range(len(model["shield_layer"])):
+            files["shields"].write(gds2fasthenry.deck_shield(model, s))
+
+        # closest owned node of every port
+        nodes = np.concatenate([np.arange(offsets[k], offsets[k+1])
+            for k in paths]) if len(paths) else np.zeros(0, dtype=np.int64)
+        if not fragments.port_nodes:
+            fragments.port_nodes = [(np.inf, None)]*len(ports)
+        for i, xy in enumerate(model["port_xy"]):
+            if len(nodes) == 0:
+                break
+            d = np.sum(np.square(node_xy[nodes] - xy), axis=1)
+            if d.min() < fragments.port_nodes[i][0]:
+                fragments.port_nodes[i] = (float(d.min()),
+                    str(model["node_name"][nodes[int(np.argmin(d))]]))
+
+    if "fastercap" in solvers:
+        files = fragments.files
+        for k in paths:
+            files["panels"].write(gds2fastercap.deck_path(model, k))
+        for s in range(len(model["shield_layer"])):
+            files["panels"].write(gds2fastercap.deck_shield(model, s))
+        if gds2fastercap.default_mesh["via_boxes"]:
+            xy, box_offsets = gds_model.pack([model["via_xy"][via_offsets[v]:
+                via_offsets[v+1]] for v in pillars], dtype=np.int64)
+            owned_vias = {"via_xy":xy, "via_offsets":box_offsets,
+                "via_layer":model["via_layer"][pillars]}
+            for layer, box in gds2fastercap.via_groups(owned_vias,
+                gds2fastercap.default_mesh["via_box_gap"]):
+                files["pillars"].write(gds2fastercap.deck_via_box(model, layer, box))
+        else:
+            for v in pillars:
+                files["pillars"].write(gds2fastercap.deck_via(model, v))
+    return len(paths), len(pillars), len(clusters)
+
+
+# ============= stitching ===============
+
+# the .external card from the closest node of every port, the last pair
+def deck_ports(port_nodes):
+    chosen = ["N-1", "N-1"]
+    for i, (d, name) in enumerate(port_nodes):
+        if name is not None and np.isfinite(d):
+            chosen[i%2] = name
+    return ".external " + chosen[0] + " " + chosen[1] + " 1\n"
+
+def stitch_fasthenry(output_name, summary, fragments):
+    fragments.close()
+    with open(output_name, 'w') as f:
+        f.write(gds2fasthenry.deck_header(summary))
+        f.write("\n* POINTS \n")
+        fragments.copy("points", f)
+        f.write("\n* PORTS\n")
+        f.write(deck_ports(fragments.port_nodes))
+        fragments.copy("edges", f)
+        f.write("\n* VIAS\n")
+        fragments.copy("vias", f)
+        if os.path.getsize(fragments.paths["shields"]):
+            f.write("\n* SHIELDS\n")
+            fragments.copy("shields", f)
+        f.write(gds2fasthenry.deck_settings(summary, fragments.total_length))
+    return gds2fasthenry.max_frequency(fragments.total_length)
+
+def stitch_fastercap(output_name, summary, fragments):
+    fragments.close()
+    with open(output_name, 'w') as f:
+        f.write(gds2fastercap.deck_header(summary))
+        fragments.copy("panels", f)
+        f.write(gds2fastercap.deck_via_header(summary))
+        fragments.copy("pillars", f)
+        f.write(gds2fastercap.deck_dielectric(summary))
+
+
+# ============= conversion ===============
+
+# convert a GDS file tile by tile to a FastHenry2 and/or FasterCap deck,
+# written straight to disk; returns a dict with the cell, the number of
+# tiles, the ports and per solver the output name (and f_max)
+def convert_tiled(file_name, options=None):
+    opts = dict(default_options)
+    if options:
+        opts.update(options)
+    verbose = opts["verbose"]
+    if verbose:
+        print("Input file: ", file_name)
+
+    stem = Path(file_name).stem
+    output_names = {
+    "fasthenry":opts["fasthenry_name"] or stem + "out_fasthenry.inp",
+    "fastercap":opts["fastercap_name"] or stem + "_out_fastercap.qui"
+    }
+
+    temporary = None
+    directory = opts["work_dir"]
+    if directory is None:
+        temporary = tempfile.TemporaryDirectory(prefix="tiled_")
+        directory = temporary.name
+    else:
+        os.makedirs(directory, exist_ok=True)
+    try:
+        layout = split_layout(file_name, directory, opts)
+        if verbose:
+            print(layout["description"])
+            print(str(len(layout["owners"])) + " tiles of " + str(opts["tile"])
+            + " um, halo " + str(opts["halo"]) + " um")
+
+        fragments = Fragments(directory, opts["solvers"])
+        for tile in layout["owners"]:
+            counts = extract_tile(tile, layout, opts, fragments)
+            if verbose:
+                print("tile " + str(tile) + ": " + str(counts[0]) + " paths, "
+                + str(counts[1]) + " via pillars, " + str(counts[2])
+                + " via clusters")
+        fragments.close()
+
+        # the global scalars of the decks, as a model of their own
+        summary = {
+            "description":np.array(layout["description"]),
+            "max_dimension":np.array(max(fragments.max_dimension,
+                layout["pin_extent"])),
+            "path_layer":np.array([fragments.last_layer])
+        }
+        result = {"cell":layout["cell"], "tiles":len(layout["owners"]),
+            "ports":layout["ports"]}
+        if "fasthenry" in opts["solvers"]:
+            f_max = stitch_fasthenry(output_names["fasthenry"], summary, fragments)
+            if verbose:
+                print("maximum usable frequency = " + str(f_max/1e9) + " GHz")
+            result["fasthenry"] = {"output_name":output_names["fasthenry"],
+                "f_max":f_max}
+        if "fastercap" in opts["solvers"]:
+            stitch_fastercap(output_names["fastercap"], summary, fragments)
+            result["fastercap"] = {"output_name":output_names["fastercap"]}
+        return result
+    finally:
+        if temporary is not None:
+            temporary.cleanup()
+
+# ============= main ===============
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2:
+        options = {}
+        if len(sys.argv) >= 3:
+            options["tile"] = float(sys.argv[2])
+        if len(sys.argv) >= 4:
+            options["halo"] = float(sys.argv[3])
+        convert_tiled(sys.argv[1], options)
+    else:
+        print ("Usage: tiled.py [gds_file] [tile_um] [halo_um]")
@@ -0,0 +1,232 @@
+# Copyright 2023 J.N.G.W. Verest
+# j.n.g.w.verest@tue.nl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Touchstone export of the solved FastHenry2 and FasterCap results
+# The FastHenry2 impedance matrix Z [P x P] of the P port pairs and the
+# FasterCap capacitance are combined into the admittance of the 2P port
+# terminals against the substrate: every port pair is a series impedance
+# between its two terminals, the capacitance is a shunt to the substrate at
+# the terminals. Y, Z and S parameters follow with batched numpy linear
+# algebra over all frequencies and sweep variants at once, and the .snp
+# files are formatted in bulk, one string operation per file.
+
+# CAVEATS:
+#   All panels of the coil body are one FasterCap conductor, so only the
+#   total capacitance is known per layout; it is split evenly over the
+#   terminals, the pi model of fastsolve.py. A node capacitance matrix
+#   [2P x 2P] may be given instead. Touchstone version 1 files are written,
+#   Y and Z normalized to the reference impedance as the format requires.
+#   Terminal 2p-1 and 2p are the p and m side of port pair p.
+#
+#   Usage:
+#     python touchstone.py [gds_file] [points]
+#   sweeps and solves the layout, fits it (vector_fit.py) and writes the
+#   S parameters at the given number of frequencies to [gds_file]_out.s2p.
+
+# File history:
+# Initial version
+
+
+import sys
+import numpy as np
+from pathlib import Path
+
+
+
+# default export options
+default_options = {
+"parameter":"S",     # S, Y or Z
+"format":"RI",       # RI (real, imaginary), MA (magnitude, angle) or DB
+"z0":50.0,           # reference impedance in Ohm
+"unit":"GHZ",        # frequency unit, HZ, KHZ, MHZ or GHZ
+"digits":9,          # significant digits of the values
+"points":201,        # frequencies of the layout export, log spaced
+"fmin":1e6,          # lowest frequency of the layout export in Hz
+"comment":None       # comment lines for the file header
+}
+
+units = {"HZ":1.0, "KHZ":1e3, "MHZ":1e6, "GHZ":1e9}
+
+
+# ============= network parameters ===============
+
+# incidence of the P port pairs on the 2P terminals [P, 2P]
+def incidence(ports):
+    a = np.zeros((ports, 2*ports))
+    a[np.arange(ports), 2*np.arange(ports)] = 1
+    a[np.arange(ports), 2*np.arange(ports)+1] = -1
+    return a
+
+# node capacitance [..., 2P, 2P] from a total capacitance per variant or a
+# node capacitance matrix
+def node_capacitance(c, ports):
+    c = np.asarray(c, dtype=np.float64)
+    if c.ndim >= 2 and c.shape[-2:] == (2*ports, 2*ports):
+        return c
+    return c[..., None, None]/(2*ports)*np.eye(2*ports)
+
+# terminal admittance [..., F, 2P, 2P] of the impedance matrices
+# z [..., F, P, P] and capacitances c (see node_capacitance); the leading
+# axes of z and c are the sweep variants and broadcast against each other
+def admittance(frequencies, z, c):
+    z = np.asarray(z, dtype=complex)
+    ports = z.shape[-1]
+    a = incidence(ports)
+    y_series = a.T @ np.linalg.inv(z) @ a
+    w = 2*np.pi*np.asarray(frequencies, dtype=np.float64)
+    c_nodes = node_capacitance(c, ports)[..., None, :, :]
+    return y_series + 1j*w[:, None, None]*c_nodes
+
+# impedance from admittance, the inverse for all matrices at once
+def y_to_z(y):
+    return np.linalg.inv(y)
+
+# scattering parameters with one reference impedance for all ports,
+# S = (1 + z0 Y)^-1 (1 - z0 Y)
+def y_to_s(y, z0=50.0):
+    eye = np.eye(y.shape[-1])
+    return np.linalg.solve(eye + z0*y, eye - z0*y)
+
+# the requested parameter of the admittance, Y and Z normalized to z0
+def network_parameters(y, parameter="S", z0=50.0):
+    if parameter == "S":
+        return y_to_s(y, z0)
+    if parameter == "Y":
+        return y*z0
+    if parameter == "Z":
+        return y_to_z(y)/z0
+    raise ValueError("unknown network parameter " + str(parameter))
+
+
+# ============= Touchstone ===============
+
+# value pairs of complex values in a Touchstone format, [..., 2]
+def value_pairs(x, data_format="RI"):
+    if data_format == "RI":
+        return np.stack([x.real, x.imag], axis=-1)
+    angle = np.degrees(np.angle(x))
+    if data_format == "MA":
+        return np.stack([np.abs(x), angle], axis=-1)
+    if data_format == "DB":
+        return np.stack([20*np.log10(np.maximum(np.abs(x), 1e-300)), angle], axis=-1)
+    raise ValueError("unknown Touchstone format " + str(data_format))
+
+# format string of one frequency: the frequency and n*n value pairs, for
+# 2 ports on one line in the order 11 21 12 22, otherwise one line per row
+# with at most 4 pairs per line
+def line_template(n, digits):
+    value = "%." + str(digits-1) + "e"
+    pair = value + " " + value
+    if n <= 2:
+        return value + "".join(" " + pair for k in range(n*n)) + "\n"
+    rows = []
+    for row in range(n):
+        chunks = [" ".join([pair]*min(4, n - k)) for k in range(0, n, 4)]
+        rows.append("\n".join(chunks))
+    return value + " " + "\n".join(rows) + "\n"
+
+def header(n, opts):
+    lines = ["! " + line for line in (opts["comment"] or [])]
+    lines.append("! " + str(n) + "-port, automatically generated using touchstone.py")
+    lines.append("# " + opts["unit"] + " " + opts["parameter"] + " "
+        + opts["format"] + " R " + repr(float(opts["z0"])))
+    return "\n".join(lines) + "\n"
+
+# Touchstone text of one network, p [F, n, n] at the frequencies in Hz
+def touchstone_text(frequencies, p, options=None):
+    opts = dict(default_options)
+    if options:
+        opts.update(options)
+    n = p.shape[-1]
+    if n == 2:
+        # the 2-port order is 11 21 12 22, column by column
+        p = np.swapaxes(p, -1, -2)
+    pairs = value_pairs(p, opts["format"]).reshape(len(frequencies), -1)
+    f = np.asarray(frequencies, dtype=np.float64)/units[opts["unit"]]
+    data = np.concatenate([f[:, None], pairs], axis=1)
+    return header(n, opts) + (line_template(n, opts["digits"])*len(f)) \
+        % tuple(data.ravel().tolist())
+
+# file name of variant index (a tuple, empty without variants)
+def variant_name(stem, index, n):
+    suffix = "".join("_" + str(i) for i in index)
+    return stem + "_out" + suffix + ".s" + str(n) + "p"
+
+# write the Touchstone files of impedances z [..., F, P, P] and
+# capacitances c, one per sweep variant; returns the file names
+def export_touchstone(frequencies, z, c, stem, options=None):
+    opts = dict(default_options)
+    if options:
+        opts.update(options)
+    y = admittance(frequencies, z, c)
+    p = network_parameters(y, opts["parameter"], opts["z0"])
+    names = []
+    n = p.shape[-1]
+    for index in np.ndindex(p.shape[:-3]):
+        name = variant_name(stem, index, n)
+        with open(name, 'w') as f:
+            f.write(touchstone_text(frequencies, p[index], opts))
+        names.append(name)
+    return names
+
+
+# ============= layout export ===============
+
+# sweep a layout with FastHenry2, fit the impedance (vector_fit.py), solve
+# the capacitance with FasterCap and write the Touchstone file at "points"
+# log spaced frequencies up to the highest solved one
+def touchstone_from_layout(library_or_path, options=None, sweep_options=None):
+    import gds2fastercap
+    import freq_sweep
+    import vector_fit
+    import fastsolve
+    opts = dict(default_options)
+    if options:
+        opts.update(options)
+    sweep = freq_sweep.sweep_fasthenry(library_or_path, sweep_options)
+    model = vector_fit.fit_impedance(sweep["frequencies"], sweep["z"])
+    frequencies = np.logspace(np.log10(opts["fmin"]),
+        np.log10(np.max(sweep["frequencies"])), opts["points"])
+    z = vector_fit.impedance(model, frequencies)
+
+    deck = gds2fastercap.convert_fastercap(library_or_path,
+        {"write":False, "verbose":False})["deck"]
+    c, names = fastsolve.run_fastercap(deck, names=True)
+    c = np.sum(fastsolve.coil_block(c, names))
+
+    if isinstance(library_or_path, (str, Path)):
+        stem = Path(library_or_path).stem
+    else:
+        stem = vector_fit.default_options["name"]
+    names = export_touchstone(frequencies, z, c, stem, opts)
+    return {"frequencies":frequencies, "z":z, "C":c, "model":model,
+        "output_names":names}
+
+
+# ============= main ===============
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2:
+        options = {}
+        if len(sys.argv) >= 3:
+            options["points"] = int(sys.argv[2])
+        result = touchstone_from_layout(sys.argv[1], options)
+        print("Output file: " + ", ".join(result["output_names"]))
+    else:
+        print ("Usage: touchstone.py [gds_file] [points]")
+
+
+# References:
+# [1]   EIA/IBIS Open Forum, "Touchstone File Format Specification", version 1.1, 2002.
@@ -0,0 +1,355 @@
+# Copyright 2023 J.N.G.W. Verest
+# j.n.g.w.verest@tue.nl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Pre-solve validation of a geometry model
+# Checks a model (see gds_model.py) for the problems that otherwise only show
+# up after a long FastHenry2/FasterCap run, or as silently wrong results:
+# port pairing, ports snapped to the wrong node, connectivity between the
+# ports, via clusters without pillars, degenerate or self-intersecting
+# outlines and the size of the substrate and dielectric. The checks work on
+# the model arrays only and take milliseconds.
+
+# CAVEATS:
+#   Every finding is a dict
+#     {"severity":"error"|"warning", "check":..., "solvers":[...],
+#      "message":..., "where":{...}}
+#   where solvers lists the decks that are affected. The converters call
+#   check_model before writing a deck and raise ValidationError on errors
+#   for their solver; warnings are only reported.
+#
+#   Usage:
+#     python validate.py [gds_or_npz_file]
+
+# File history:
+# Initial version
+
+
+import re
+import sys
+import numpy as np
+
+import gds_model
+import dbu_geometry
+from sky130_stack import layerlist, stack_top
+
+
+
+solvers_all = ["fasthenry", "fastercap"]
+
+# a port further than this many path widths from its node is suspicious
+port_snap_widths = 1.0
+
+# substrate mesh (seg1 x seg2) above which the FastHenry2 run gets slow
+substrate_seg_max = 500
+
+# FasterCap dielectric box height, as written by gds2fastercap
+dielectric_height = 11.8834
+
+port_pattern = re.compile(r"port_(\d+)([pm])$")
+
+class ValidationError(ValueError):
+    def __init__(self, diagnostics):
+        self.diagnostics = diagnostics
+        errors = [d for d in diagnostics if d["severity"] == "error"]
+        ValueError.__init__(self, str(len(errors)) + " validation error(s): "
+            + "; ".join(d["message"] for d in errors))
+
+def diagnostic(severity, check, message, solvers=solvers_all, **where):
+    return {
+        "severity":severity,
+        "check":check,
+        "solvers":list(solvers),
+        "message":message,
+        "where":where
+    }
+
+
+# ============= helpers ===============
+
+# path index of every node
+def node_paths(model):
+    offsets = model["path_offsets"]
+    return np.repeat(np.arange(len(offsets)-1), np.diff(offsets))
+
+# closest node of every port, as chosen by the FastHenry2 writer
+def port_nodes(model):
+    node_xy = dbu_geometry.to_um(model["node_xy"], dbu_geometry.model_unit(model))
+    port_xy = model["port_xy"]
+    if len(node_xy) == 0 or len(port_xy) == 0:
+        return np.zeros(len(port_xy), dtype=np.int64), np.full(len(port_xy), np.inf)
+    d = (np.square(port_xy[:, 0, None] - node_xy[None, :, 0])
+        + np.square(port_xy[:, 1, None] - node_xy[None, :, 1]))
+    nodes = np.argmin(d, axis=1)
+    return nodes, np.sqrt(d[np.arange(len(port_xy)), nodes])
+
+# connected groups of paths, joined by via clusters with pillars
+def path_groups(model):
+    group = np.arange(len(model["path_layer"]))
+    def root(k):
+        while group[k] != k:
+            group[k] = group[group[k]]
+            k = group[k]
+        return k
+    for (i, j), count in zip(model["cluster_paths"], model["cluster_count"]):
+        if count > 0:
+            group[root(i)] = root(j)
+    return np.array([root(k) for k in range(len(group))], dtype=np.int64)
+
+
+# ============= checks ===============
+
+def check_ports(model):
+    found = []
+    names = [str(n) for n in model["port_name"]]
+    label_count = int(model["label_count"])
+    for layer, pins in zip(model["layerlist"], model["pin_count"]):
+        if pins and pins != label_count:
+            found.append(diagnostic("error", "port_pairing",
+                str(pins) + " pins on layer " + str(layer) + " but "
+                + str(label_count) + " labels in the cell, the port search stops here",
+                layer=int(layer)))
+            break
+
+    if len(names) < 2:
+        found.append(diagnostic("error", "port_pairing",
+            "need at least one port pair, found " + str(len(names)) + " ports"))
+        return found
+    if len(names) % 2:
+        found.append(diagnostic("error", "port_pairing",
+            "odd number of ports (" + str(len(names)) + ")"))
+    if len(set(names)) != len(names):
+        found.append(diagnostic("error", "port_pairing",
+            "duplicate port names " + ", ".join(sorted(set(
+            n for n in names if names.count(n) > 1)))))
+
+    # port_<n>p and port_<n>m next to each other, FastHenry2 uses the order
+    pairs = {}
+    for k, name in enumerate(names):
+        match = port_pattern.match(name)
+        if match is None:
+            found.append(diagnostic("warning", "port_pairing",
+                "port name " + name + " does not follow port_<n>p/m", port=k))
+            continue
+        pairs.setdefault(match.group(1), {})[match.group(2)] = k
+    for number, ends in pairs.items():
+        if len(ends) != 2:
+            found.append(diagnostic("error", "port_pairing",
+                "port_" + number + " has no " + ("m" if "p" in ends else "p")
+                + " side"))
+        elif abs(ends["p"] - ends["m"]) != 1 or min(ends.values()) % 2:
+            found.append(diagnostic("warning", "port_pairing",
+                "port_" + number + "p/m are not found as a pair, FastHenry2 "
+                + "pairs the ports by their order", solvers=["fasthenry"]))
+    if len(names) > 2:
+        found.append(diagnostic("warning", "port_pairing",
+            "only the last port pair is written as .external",
+            solvers=["fasthenry"]))
+    return found
+
+def check_port_nodes(model):
+    found = []
+    if len(model["node_xy"]) == 0:
+        found.append(diagnostic("error", "connectivity", "no paths found"))
+        return found
+    nodes, dist = port_nodes(model)
+    width = model["node_width"][nodes]
+    for k in np.nonzero(dist > port_snap_widths*width)[0]:
+        found.append(diagnostic("error", "port_snap",
+            "port " + str(model["port_name"][k]) + " is " + str(round(dist[k], 3))
+            + " um from the closest node N" + str(nodes[k]),
+            solvers=["fasthenry"], port=int(k), node=int(nodes[k])))
+
+    # the nodes used in .external, the last even and odd port
+    if len(nodes) >= 2:
+        a = nodes[(len(nodes)-1) // 2 * 2]
+        b = nodes[len(nodes)//2 * 2 - 1]
+        if a == b:
+            found.append(diagnostic("error", "port_snap",
+                "both external ports snap to node N" + str(a),
+                solvers=["fasthenry"], node=int(a)))
+        else:
+            group = path_groups(model)
+            path_of = node_paths(model)
+            if group[path_of[a]] != group[path_of[b]]:
+                found.append(diagnostic("error", "connectivity",
+                    "external ports N" + str(a) + " and N" + str(b)
+                    + " are not connected by paths and vias",
+                    solvers=["fasthenry"], nodes=[int(a), int(b)]))
+            floating = np.nonzero(group != group[path_of[a]])[0]
+            if len(floating):
+                found.append(diagnostic("warning", "connectivity",
+                    str(len(floating)) + " path(s) not connected to the ports",
+                    solvers=["fasthenry"], paths=floating.tolist()))
+    return found
+
+def check_vias(model):
+    found = []
+    for c in range(len(model["cluster_count"])):
+        cluster = dbu_geometry.via_cluster(model, c)
+        (i, j), count, layer = cluster.paths, cluster.count, cluster.layer
+        if count == 0:
+            found.append(diagnostic("error", "via_coverage",
+                "no via pillars between the ends of path " + str(i)
+                + " and path " + str(j) + " on via layer " + str(layer),
+                solvers=["fasthenry"], paths=[int(i), int(j)]))
+        elif count < 0:
+            found.append(diagnostic("warning", "via_coverage",
+                "paths " + str(i) + " and " + str(j) + " are on adjacent layers"
+                + " but there are no vias on layer " + str(layer),
+                solvers=["fasthenry"], paths=[int(i), int(j)]))
+    return found
+
+def check_paths(model):
+    found = []
+    # the exact DBU predicates need coordinates below 2^31, non-finite ones
+    # end up far outside as well
+    nodes = dbu_geometry.model_nodes(model)
+    if not all(np.all(np.abs(np.asarray(model[key], dtype=np.float64)) < 2**31)
+        for key in ("node_xy", "outline_xy")):
+        found.append(diagnostic("error", "geometry",
+            "coordinates outside of +-2^31 database units"))
+        return found
+    path_of = node_paths(model)
+    for k in range(len(nodes)):
+        for segment in dbu_geometry.path_segments(model, k, nodes):
+            if np.all(segment.ends[0] == segment.ends[1]):
+                found.append(diagnostic("error", "geometry",
+                    "zero length segment E" + str(segment.first),
+                    solvers=["fasthenry"], path=k))
+    for k in np.nonzero(model["node_width"] <= 0)[0][:1]:
+        found.append(diagnostic("error", "geometry",
+            "path " + str(path_of[k]) + " has zero width", path=int(path_of[k])))
+    return found
+
+def check_outlines(model):
+    found = []
+    outlines = dbu_geometry.PointStore.from_model(model, "outline_xy", "outline_offsets")
+    for k in range(len(outlines)):
+        pts = outlines[k]
+        if len(np.unique(pts, axis=0)) < 3:
+            found.append(diagnostic("error", "outline",
+                "outline of path " + str(k) + " is degenerate",
+                solvers=["fastercap"], path=k))
+            continue
+        if dbu_geometry.repeated_points(pts).any():
+            found.append(diagnostic("warning", "outline",
+                "outline of path " + str(k) + " touches itself at a repeated "
+                + "vertex", solvers=["fastercap"], path=k))
+        if dbu_geometry.area2(pts) == 0:
+            found.append(diagnostic("error", "outline",
+                "outline of path " + str(k) + " has zero area",
+                solvers=["fastercap"], path=k))
+        crossings = np.argwhere(dbu_geometry.crossing_edges(pts))
+        if len(crossings):
+            found.append(diagnostic("error", "outline",
+                "outline of path " + str(k) + " intersects itself at "
+                + str(len(crossings)) + " edge pair(s)",
+                solvers=["fastercap"], path=k, edges=crossings[:10].tolist()))
+    parts = model["outline_parts"]
+    for k in np.nonzero(parts > 1)[0]:
+        found.append(diagnostic("warning", "outline",
+            "path " + str(k) + " is fractured into " + str(parts[k])
+            + " polygons, only the first one becomes FasterCap panels",
+            solvers=["fastercap"], path=int(k)))
+    return found
+
+# substrate (FastHenry2) and dielectric (FasterCap) boxes, as sized by the
+# writers, must cover the geometry
+def check_bounds(model):
+    found = []
+    max_dimension = float(model["max_dimension"])
+    extent = float(dbu_geometry.to_um(np.max(np.abs(np.concatenate([
+        model["node_xy"].reshape(-1, 2), model["outline_xy"].reshape(-1, 2),
+        model["via_xy"].reshape(-1, 2)]))), dbu_geometry.model_unit(model)))
+    gr_len = 2 * round(max_dimension, 0)
+    md = 2 * round(max_dimension, -1)
+    if gr_len < extent:
+        found.append(diagnostic("error", "bounds",
+            "substrate half size " + str(gr_len) + " um does not cover the"
+            + " geometry (" + str(round(extent, 3)) + " um)",
+            solvers=["fasthenry"]))
+    if md < extent:
+        found.append(diagnostic("error", "bounds",
+            "dielectric half size " + str(md) + " um does not cover the"
+            + " geometry (" + str(round(extent, 3)) + " um)",
+            solvers=["fastercap"]))
+    if len(model["path_layer"]) and max(float(stack_top[str(layer)])
+        for layer in model["path_layer"]) >= dielectric_height:
+        found.append(diagnostic("error", "bounds",
+            "metal stack is higher than the dielectric", solvers=["fastercap"]))
+
+    seg = model["seg_nodes"]
+    node_xy = dbu_geometry.to_um(model["node_xy"], dbu_geometry.model_unit(model))
+    total_length = np.sum(np.hypot(*(node_xy[seg[:, 0]] - node_xy[seg[:, 1]]).T))
+    # the substrate segments of the deck, see gds2fasthenry.deck_settings
+    import gds2fasthenry
+    lam = int(np.ceil(total_length / gds2fasthenry.default_mesh["substrate_length"]))
+    if lam == 0:
+        found.append(diagnostic("error", "bounds",
+            "total path length is zero, no frequency range or substrate mesh",
+            solvers=["fasthenry"]))
+    elif lam > substrate_seg_max:
+        found.append(diagnostic("warning", "bounds",
+            "substrate mesh of " + str(lam) + " x " + str(lam)
+            + " segments, the FastHenry2 run will be slow",
+            solvers=["fasthenry"]))
+    return found
+
+checks = [
+check_ports,
+check_port_nodes,
+check_vias,
+check_paths,
+check_outlines,
+check_bounds
+]
+
+# all findings for the given solvers
+def check_model(model, solvers=solvers_all):
+    if isinstance(solvers, str):
+        solvers = [solvers]
+    found = []
+    for check in checks:
+        found.extend(check(model))
+    return [d for d in found if set(d["solvers"]) & set(solvers)]
+
+# raise ValidationError if there are errors, returns the warnings otherwise
+def require_valid(model, solvers=solvers_all, verbose=True):
+    found = check_model(model, solvers)
+    if any(d["severity"] == "error" for d in found):
+        raise ValidationError(found)
+    if verbose:
+        for d in found:
+            print("WARNING: " + d["message"])
+    return found
+
+def format_diagnostics(found):
+    return "\n".join(d["severity"].upper() + " [" + d["check"] + ", "
+        + "/".join(d["solvers"]) + "] " + d["message"] for d in found)
+
+
+# ============= main ===============
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2:
+        model = gds_model.get_model(sys.argv[1], layerlist=layerlist, panels=False)
+        found = check_model(model)
+        if found:
+            print(format_diagnostics(found))
+        else:
+            print("no problems found")
+        sys.exit(1 if any(d["severity"] == "error" for d in found) else 0)
+    else:
+        print ("Usage: validate.py [gds_or_npz_file]")
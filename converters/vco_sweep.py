@@ -0,0 +1,419 @@
+# Copyright 2023 J.N.G.W. Verest
+# j.n.g.w.verest@tue.nl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# ngspice sweeps of the VCO with extracted tank inductors
+# The VCO testbench netlist (xschem, final_VCO/Tests/TT.sch of
+# VCO_Xschem.zip) is instantiated once per tank inductor and process corner:
+# its own inductor subcircuit is replaced by a wrapper around the fitted
+# broadband model of vector_fit.py plus the FasterCap capacitance, its
+# .control block by one transient run. The runs go to ngspice in batch mode,
+# several at a time, and the oscillation frequency, amplitude, supply power
+# and phase noise are read from the raw files into one results table.
+
+# CAVEATS:
+#   The testbench is a netlist with the inductor as a subcircuit with pins
+#   A, B, CT and SUB, as the ind_* symbols of the VCO, in the order of its
+#   .subckt line in the testbench (CT, A, B, SUB as in the symbols if the
+#   testbench does not define it); 1 port models go between A and B, 2 port
+#   models (T networks) between A, B and the center tap. Half of the
+#   capacitance goes from A and from B to SUB. The corner is the section
+#   of the .lib lines of the SKY130 models. ngspice does not
+#   simulate phase noise in batch mode, so it is Leeson's estimate [1] from
+#   the simulated differential amplitude and the loss of the tank inductor
+#   at the simulated frequency, which needs the fitted model; for plain
+#   subcircuit files it is left out. Only the first plot of a raw file is
+#   read.
+#
+#   Usage:
+#     python vco_sweep.py [testbench] [corners] [inductor ...]
+#   with corners like tt,ff,ss and the inductors as gds files (swept,
+#   fitted and solved, see touchstone.py) or subcircuit files; writes the
+#   table to [testbench]_vco.csv.
+
+# File history:
+# Initial version
+
+
+import os
+import re
+import sys
+import csv
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import vector_fit
+
+
+
+# default sweep options
+default_options = {
+"inductor":"ind_2T_90R_20W_5S", # subcircuit of the tank inductor in the testbench
+"pins":["CT", "A", "B", "SUB"], # its pins in symbol order, if the testbench
+                         #   does not define the subcircuit itself
+"corners":["tt"],        # sections of the SKY130 model library
+"tran":(2e-11, 4.1e-7),  # transient step and stop time, as the testbench
+"tstart":1e-8,           # start of the steady state, cut before the FFT
+"outputs":("op", "on"),  # differential output nodes
+"supply":"vdd",          # supply voltage source
+"vdd":1.8,               # supply voltage
+"offsets":[1e6],         # phase noise offsets in Hz
+"noise_factor":2.0,      # Leeson's excess noise factor F of the active part
+"temperature":300.0,     # in K
+"ngspice":None,          # executable, from NGSPICE or the PATH if None
+"workers":None,          # parallel ngspice runs, None for all cores
+"timeout":3600,          # seconds per run
+"work_dir":None,         # directory for netlists and raw files, temporary if None
+"verbose":True
+}
+
+# corner sections of the SKY130 model library
+library_corners = ["tt", "ff", "ss", "sf", "fs", "hh", "hl", "lh", "ll",
+    "tt_mm", "ff_mm", "ss_mm", "sf_mm", "fs_mm"]
+
+boltzmann = 1.380649e-23
+
+
+# ============= netlists ===============
+
+# netlist without its .control blocks and final .end
+def strip_control(netlist):
+    netlist = re.sub(r"^\.control\b.*?^\.endc\b[^\n]*\n?", "", netlist,
+        flags=re.MULTILINE | re.DOTALL | re.IGNORECASE)
+    return re.sub(r"^\.end\s*$", "", netlist, flags=re.MULTILINE | re.IGNORECASE)
+
+# netlist without the definition of subcircuit name
+def remove_subcircuit(netlist, name):
+    return re.sub(r"^\.subckt\s+" + re.escape(name) + r"\b.*?^\.ends\b[^\n]*\n?",
+        "", netlist, flags=re.MULTILINE | re.DOTALL | re.IGNORECASE)
+
+# netlist with the model library lines switched to corner
+def set_corner(netlist, corner):
+    pattern = (r"^(\.lib\s+\S+\s+)(" + "|".join(sorted(library_corners,
+        key=len, reverse=True)) + r")\s*$")
+    return re.sub(pattern, lambda m: m.group(1) + corner, netlist,
+        flags=re.MULTILINE | re.IGNORECASE)
+
+# name and pins of the first subcircuit defined in a netlist, or of the one
+# called name; None if there is none. Only the .subckt line itself is read,
+# parameters (x=y) are not pins
+def subcircuit_pins(netlist, name=None):
+    pattern = r"^\.subckt[ \t]+" + (re.escape(name) + r"\b" if name else r"\S")
+    match = re.search(pattern + r"[^\n]*", netlist, flags=re.MULTILINE | re.IGNORECASE)
+    if match is None:
+        return None
+    tokens = match.group(0).split()
+    return tokens[1], [t for t in tokens[2:] if "=" not in t]
+
+# name of the first subcircuit defined in a netlist
+def subcircuit_name(netlist):
+    subcircuit = subcircuit_pins(netlist)
+    if subcircuit is None:
+        raise ValueError("no .subckt in the inductor netlist")
+    return subcircuit[0]
+
+# the inductor subcircuit of the testbench around the fitted subcircuit
+# model_name with the given ports, plus the capacitance c to the substrate;
+# the pins are those of the testbench, in its order, and are found by name
+def wrapper_subcircuit(model_name, ports, c, opts, pins=None):
+    pins = pins or opts["pins"]
+    by_name = {pin.upper():pin for pin in pins}
+    missing = [pin for pin in ("A", "B", "CT", "SUB") if pin not in by_name]
+    if missing:
+        raise ValueError("inductor subcircuit " + opts["inductor"]
+        + " has no pin " + ", ".join(missing))
+    a, b, ct, sub = [by_name[pin] for pin in ("A", "B", "CT", "SUB")]
+    lines = [".subckt " + opts["inductor"] + " " + " ".join(pins)]
+    if ports == 2:
+        lines.append("xfit " + a + " " + b + " " + ct + " " + model_name)
+    else:
+        lines.append("xfit " + a + " " + b + " " + model_name)
+    if c:
+        lines.append("cpa " + a + " " + sub + " " + vector_fit.value(c/2))
+        lines.append("cpb " + b + " " + sub + " " + vector_fit.value(c/2))
+    lines.append(".ends " + opts["inductor"])
+    return "\n".join(lines) + "\n"
+
+def analysis(opts):
+    step, stop = opts["tran"]
+    saved = ["v(" + node + ")" for node in opts["outputs"]]
+    saved.append("i(" + opts["supply"] + ")")
+    return (".tran " + vector_fit.value(step) + " " + vector_fit.value(stop) + "\n"
+        + ".save " + " ".join(saved) + "\n")
+
+# testbench netlist of one inductor at one corner
+def testbench(template, inductor, corner, opts):
+    subcircuit = subcircuit_pins(template, opts["inductor"])
+    pins = subcircuit[1] if subcircuit else None
+    netlist = set_corner(remove_subcircuit(strip_control(template),
+        opts["inductor"]), corner)
+    return (netlist.rstrip("\n") + "\n\n* tank inductor " + inductor["name"]
+        + "\n" + inductor["subckt"]
+        + wrapper_subcircuit(inductor["model_name"], inductor["ports"],
+        inductor.get("C"), opts, pins) + "\n" + analysis(opts) + ".end\n")
+
+
+# ============= raw files ===============
+
+# vectors of the first plot of an ngspice raw file, ascii or binary, as a
+# dict of lower case names to arrays
+def read_raw(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    names = []
+    complex_data = False
+    points = 0
+    n_variables = 0
+    position = 0
+    while True:
+        end = data.index(b"\n", position)
+        line = data[position:end].decode("latin-1")
+        position = end + 1
+        key, _, rest = line.partition(":")
+        key = key.strip().lower()
+        if key == "flags":
+            complex_data = "complex" in rest.lower()
+        elif key == "no. points":
+            points = int(rest)
+        elif key == "variables":
+            while len(names) < n_variables:
+                end = data.index(b"\n", position)
+                names.append(data[position:end].decode("latin-1").split()[1].lower())
+                position = end + 1
+        elif key == "no. variables":
+            n_variables = int(rest)
+        elif key in ("values", "binary"):
+            break
+
+    n = len(names)
+    if key == "binary":
+        dtype = np.complex128 if complex_data else np.float64
+        values = np.frombuffer(data, dtype=dtype, count=points*n,
+            offset=position).reshape(points, n)
+    else:
+        tokens = data[position:].decode("latin-1").split()
+        # every point starts with its index
+        tokens = np.array(tokens[:points*(n+1)]).reshape(points, n+1)[:, 1:]
+        if complex_data:
+            pairs = np.char.partition(tokens, ",")
+            values = (pairs[..., 0].astype(np.float64)
+                + 1j*pairs[..., 2].astype(np.float64))
+        else:
+            values = tokens.astype(np.float64)
+    return {name: values[:, k] for k, name in enumerate(names)}
+
+
+# ============= measurements ===============
+
+# frequency and amplitude of the strongest tone of a signal after tstart,
+# resampled to uniform steps (ngspice steps adaptively), Hann windowed,
+# the peak interpolated on the log spectrum and the amplitude taken at it
+def oscillation(time, signal, tstart, step):
+    t = np.arange(tstart, time[-1], step)
+    x = np.interp(t, time, signal)
+    x = x - np.mean(x)
+    window = np.hanning(len(x))
+    spectrum = np.abs(np.fft.rfft(x*window))
+    k = int(np.argmax(spectrum[1:-1])) + 1
+    a, b, c = np.log(spectrum[k-1:k+2] + 1e-300)
+    shift = 0.5*(a - c)/(a - 2*b + c) if a - 2*b + c != 0 else 0.0
+    f0 = (k + shift)/(len(x)*step)
+    tone = np.exp(-2j*np.pi*f0*(t - t[0]))
+    amplitude = 2*np.abs(np.sum(x*window*tone))/np.sum(window)
+    return float(f0), float(amplitude)
+
+# average power delivered by the supply source after tstart
+def supply_power(time, current, vdd, tstart):
+    keep = time >= tstart
+    t = time[keep]
+    i = current[keep]
+    # the source current flows into its positive terminal
+    energy = -vdd*np.sum((i[1:] + i[:-1])/2*np.diff(t))
+    return float(energy/(t[-1] - t[0]))
+
+# Leeson's phase noise in dBc/Hz at the offsets, for a tank of parallel
+# resistance rp with quality factor q and a differential amplitude
+def leeson(f0, amplitude, q, rp, offsets, opts):
+    power = amplitude**2/(2*rp)
+    offsets = np.asarray(offsets, dtype=np.float64)
+    return 10*np.log10(2*opts["noise_factor"]*boltzmann*opts["temperature"]/power
+        *(1 + (f0/(2*q*offsets))**2))
+
+# differential impedance of the tank inductor at frequency f
+def tank_impedance(inductor, f):
+    z = vector_fit.impedance(inductor["model"], [f])[inductor["variant"]][0]
+    if inductor["ports"] == 2:
+        return z[0, 0] + z[1, 1] - z[0, 1] - z[1, 0]
+    return z[0, 0]
+
+# results of one run: frequency, amplitude, power and, with a model, the
+# tank at that frequency and the phase noise at the offsets
+def measure(vectors, inductor, opts):
+    time = np.real(vectors["time"])
+    p, m = opts["outputs"]
+    signal = np.real(vectors["v(" + p + ")"] - vectors["v(" + m + ")"])
+    f0, amplitude = oscillation(time, signal, opts["tstart"], opts["tran"][0])
+    row = {"f0":f0, "amplitude":amplitude,
+        "power":supply_power(time, np.real(vectors["i(" + opts["supply"] + ")"]),
+        opts["vdd"], opts["tstart"])}
+    if inductor.get("model") is not None:
+        z = tank_impedance(inductor, f0)
+        q = z.imag/z.real
+        rp = abs(z)**2/z.real
+        row.update(L=float(z.imag/(2*np.pi*f0)), Q=float(q))
+        for offset, noise in zip(opts["offsets"], leeson(f0, amplitude, q, rp,
+            opts["offsets"], opts)):
+            row["pn_" + ('%g' % offset)] = float(noise)
+    return row
+
+
+# ============= inductors ===============
+
+# inductors of all sweep variants of a fitted model (vector_fit.py), with
+# total capacitance c (a number or an array over the variants)
+def inductors_from_model(model, name, c=None):
+    inductors = []
+    variants = model["d"].shape[:-2]
+    for index in np.ndindex(variants):
+        suffix = "".join("_" + str(i) for i in index)
+        model_name = name + suffix + "_fit"
+        inductors.append({"name":name + suffix, "model":model, "variant":index,
+            "ports":model["d"].shape[-1], "model_name":model_name,
+            "subckt":vector_fit.spice_subcircuit(model, model_name, index),
+            "C":None if c is None else float(np.broadcast_to(c, variants)[index])})
+    return inductors
+
+# inductor of a subcircuit file, without a model and capacitance
+def inductor_from_file(path):
+    with open(path) as f:
+        netlist = f.read()
+    name = subcircuit_name(netlist)
+    ports = 2 if len(subcircuit_pins(netlist)[1]) >= 3 else 1
+    return {"name":Path(path).stem, "model":None, "variant":(), "ports":ports,
+        "model_name":name, "subckt":netlist.rstrip("\n") + "\n", "C":None}
+
+# inductors of a layout: swept with FastHenry2, fitted, capacitance of the
+# coil solved with FasterCap if installed
+def inductors_from_layout(path, sweep_options=None):
+    import fastsolve
+    import gds2fastercap
+    fit = vector_fit.model_from_layout(path, sweep_options=sweep_options)
+    c = None
+    if fastsolve.find_solver("fastercap") is not None:
+        deck = gds2fastercap.convert_fastercap(path,
+            {"write":False, "verbose":False})["deck"]
+        matrix, names = fastsolve.run_fastercap(deck, names=True)
+        c = float(np.sum(fastsolve.coil_block(matrix, names)))
+    return inductors_from_model(fit["model"], Path(path).stem, c)
+
+
+# ============= simulation ===============
+
+def find_ngspice(executable=None):
+    if executable is None:
+        executable = os.environ.get("NGSPICE", "ngspice")
+    return shutil.which(executable)
+
+# run one testbench netlist in batch mode in work_dir, returns the vectors
+def run_ngspice(netlist, stem, work_dir, opts):
+    ngspice = find_ngspice(opts["ngspice"])
+    if ngspice is None:
+        raise FileNotFoundError("ngspice not found, set NGSPICE")
+    netlist_name = os.path.join(work_dir, stem + ".spice")
+    raw_name = os.path.join(work_dir, stem + ".raw")
+    with open(netlist_name, 'w') as f:
+        f.write(netlist)
+    subprocess.run([ngspice, "-b", "-r", raw_name, netlist_name], cwd=work_dir,
+        capture_output=True, text=True, timeout=opts["timeout"], check=True)
+    return read_raw(raw_name)
+
+# simulate every inductor at every corner, several ngspice processes at a
+# time; returns the table as a list of rows, failed runs with their error
+def sweep_vco(testbench_path, inductors, options=None):
+    opts = dict(default_options)
+    if options:
+        opts.update(options)
+    with open(testbench_path) as f:
+        template = f.read()
+    jobs = [(inductor, corner) for inductor in inductors
+        for corner in opts["corners"]]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = opts["work_dir"] or temp_dir
+
+        def run(job):
+            inductor, corner = job
+            stem = inductor["name"] + "_" + corner
+            row = {"inductor":inductor["name"], "corner":corner}
+            try:
+                vectors = run_ngspice(testbench(template, inductor, corner, opts),
+                    stem, work_dir, opts)
+                row.update(measure(vectors, inductor, opts))
+            except Exception as e:
+                row["error"] = type(e).__name__ + ": " + str(e)
+            if opts["verbose"]:
+                print(format_row(row))
+            return row
+
+        workers = opts["workers"] or os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(run, jobs))
+
+def format_row(row):
+    if "error" in row:
+        return row["inductor"] + " " + row["corner"] + ": " + row["error"]
+    text = (row["inductor"] + " " + row["corner"] + ": f0="
+        + ('%.4g' % (row["f0"]/1e9)) + "GHz A=" + ('%.3g' % row["amplitude"])
+        + "V P=" + ('%.3g' % (row["power"]*1e3)) + "mW")
+    for key, value in row.items():
+        if key.startswith("pn_"):
+            text += " PN(" + key[3:] + ")=" + ('%.1f' % value) + "dBc/Hz"
+    return text
+
+# write the table as csv, columns of all rows in order of appearance
+def write_table(rows, output_name):
+    columns = []
+    for row in rows:
+        columns += [key for key in row if key not in columns]
+    with open(output_name, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    return output_name
+
+
+# ============= main ===============
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 4:
+        inductors = []
+        for path in sys.argv[3:]:
+            if Path(path).suffix.lower() == ".gds":
+                inductors += inductors_from_layout(path)
+            else:
+                inductors.append(inductor_from_file(path))
+        rows = sweep_vco(sys.argv[1], inductors,
+            {"corners":sys.argv[2].split(",")})
+        print("Output file: " + write_table(rows,
+            Path(sys.argv[1]).stem + "_vco.csv"))
+    else:
+        print ("Usage: vco_sweep.py [testbench] [corners] [inductor ...]")
+
+
+# References:
+# [1]   D. B. Leeson, "A simple model of feedback oscillator noise spectrum", Proc. IEEE 54(2), 1966.
@@ -0,0 +1,389 @@
+# Copyright 2023 J.N.G.W. Verest
+# j.n.g.w.verest@tue.nl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Broadband rational model of FastHenry2 impedances and SPICE synthesis
+# A handful of impedance samples (see freq_sweep.py) is fitted by vector
+# fitting [1] to
+#   Z(s) = d + s e + sum_n r_n/(s - p_n)
+# with one set of poles shared by all port combinations and sweep variants,
+# so the fit is a few least squares solves with many right hand sides.
+# Unstable poles are flipped, passivity (Re Z >= 0) is enforced by adding
+# the smallest needed resistance to d, and every element of the model is
+# written as a compact Foster network of R, L and C for ngspice.
+
+# CAVEATS:
+#   Real poles with negative residues, the skin and proximity effect of an
+#   inductor, give an R-L ladder with positive elements; other terms can
+#   give negative elements, which ngspice accepts and which do not make the
+#   passive model as a whole active. Multiport models are written as a T
+#   network and are limited to 2 ports, the ports sharing a reference node.
+#   Passivity is checked on a dense frequency grid, not proven.
+#
+#   Usage:
+#     python vector_fit.py [gds_file] [poles]
+#   sweeps the layout adaptively with FastHenry2 and writes the subcircuit.
+
+# File history:
+# Initial version
+
+
+import sys
+import numpy as np
+from pathlib import Path
+
+
+
+# default fitting options
+default_options = {
+"poles":4,           # number of poles
+"pole_kind":"real",  # starting poles, "real" or "complex"
+"iterations":8,      # pole relocation iterations
+"weight":"relative", # "relative" weights every sample with 1/|Z|, None for none
+"passive":True,      # enforce Re(Z) >= 0
+"name":"inductor"    # subcircuit name
+}
+
+
+# ============= vector fitting ===============
+
+# starting poles spread log-uniform over the sampled band, in rad/s
+def initial_poles(frequencies, n, kind="real"):
+    w = 2*np.pi*np.asarray(frequencies)
+    w_min = max(w.min(), w.max()*1e-4)
+    if kind == "real":
+        return -np.logspace(np.log10(w_min), np.log10(w.max()), n)
+    beta = np.logspace(np.log10(w_min), np.log10(w.max()), n//2)
+    poles = []
+    for b in beta:
+        poles += [-b/100 + 1j*b, -b/100 - 1j*b]
+    if n % 2:
+        poles.append(-w.max())
+    return np.array(poles)
+
+# real poles first, then pairs (p, p*) with Im(p) > 0, small values snapped
+def order_poles(poles):
+    poles = np.where(np.abs(poles.imag) < 1e-9*np.abs(poles), poles.real, poles)
+    real = np.sort(poles[poles.imag == 0].real).astype(complex)
+    upper = poles[poles.imag > 0]
+    upper = upper[np.argsort(upper.imag)]
+    pairs = np.stack([upper, upper.conj()], axis=1).ravel()
+    return np.concatenate([real, pairs])
+
+# real basis functions [samples, poles] of a set of ordered poles
+def basis(s, poles):
+    phi = np.zeros((len(s), len(poles)), dtype=complex)
+    k = 0
+    while k < len(poles):
+        if poles[k].imag == 0:
+            phi[:, k] = 1/(s - poles[k])
+            k += 1
+        else:
+            phi[:, k] = 1/(s - poles[k]) + 1/(s - poles[k].conj())
+            phi[:, k+1] = 1j/(s - poles[k]) - 1j/(s - poles[k].conj())
+            k += 2
+    return phi
+
+# complex residues from the real coefficients of basis()
+def residues_from_coefficients(poles, c):
+    r = c.astype(complex)
+    k = 0
+    while k < len(poles):
+        if poles[k].imag == 0:
+            k += 1
+        else:
+            r[..., k] = c[..., k] + 1j*c[..., k+1]
+            r[..., k+1] = c[..., k] - 1j*c[..., k+1]
+            k += 2
+    return r
+
+# real and imaginary parts of complex rows stacked, for real least squares
+def stack_real(a):
+    return np.concatenate([a.real, a.imag], axis=0)
+
+# new poles, the zeros of the weighting function sigma
+def relocate_poles(s, h, poles, weights):
+    n = len(poles)
+    phi = basis(s, poles)
+    ones = np.ones((len(s), 1))
+    local = np.concatenate([phi, ones, s[:, None]], axis=1)
+    rows = []
+    rhs = []
+    for m in range(h.shape[1]):
+        w = weights[:, m:m+1]
+        a = stack_real(np.concatenate([w*local, -w*h[:, m:m+1]*phi], axis=1))
+        b = stack_real(w[:, 0]*h[:, m])
+        # eliminate the unknowns of this response, keep the sigma part
+        q, r = np.linalg.qr(a)
+        k = local.shape[1]
+        rows.append(r[k:, k:])
+        rhs.append(q[:, k:].T @ b)
+    c_sigma = np.linalg.lstsq(np.concatenate(rows), np.concatenate(rhs),
+        rcond=None)[0]
+
+    # eigenvalues of (poles - b c_sigma) in real block form
+    lam = np.zeros((n, n))
+    b = np.zeros(n)
+    k = 0
+    while k < n:
+        if poles[k].imag == 0:
+            lam[k, k] = poles[k].real
+            b[k] = 1
+            k += 1
+        else:
+            lam[k:k+2, k:k+2] = [[poles[k].real, poles[k].imag],
+                [-poles[k].imag, poles[k].real]]
+            b[k] = 2
+            k += 2
+    zeros = np.linalg.eigvals(lam - np.outer(b, c_sigma))
+    # stable poles only
+    zeros = np.where(zeros.real > 0, -zeros.real + 1j*zeros.imag, zeros)
+    return order_poles(zeros)
+
+# residues, d and e of all responses for fixed poles, one least squares
+# solve with a right hand side per response
+def fit_residues(s, h, poles, weights):
+    phi = basis(s, poles)
+    a = np.concatenate([phi, np.ones((len(s), 1)), s[:, None]], axis=1)
+    if np.allclose(weights, weights[:, :1]):
+        x = np.linalg.lstsq(stack_real(weights[:, :1]*a),
+            stack_real(weights*h), rcond=None)[0]
+    else:
+        x = np.stack([np.linalg.lstsq(stack_real(weights[:, m:m+1]*a),
+            stack_real(weights[:, m]*h[:, m]), rcond=None)[0]
+            for m in range(h.shape[1])], axis=1)
+    n = len(poles)
+    residues = residues_from_coefficients(poles, x[:n].T)
+    return residues, x[n], x[n+1]
+
+# value of the rational model at s, [samples, responses]
+def evaluate(s, poles, residues, d, e):
+    s = np.asarray(s)
+    return (d[None] + s[:, None]*e[None]
+        + np.sum(residues[None]/(s[:, None, None] - poles[None, None]), axis=2))
+
+# fit h [samples, responses] at frequencies (Hz) with common poles; returns
+# poles, residues [responses, poles], d and e [responses], all in rad/s
+def vector_fit(frequencies, h, options=None):
+    opts = dict(default_options)
+    if options:
+        opts.update(options)
+    frequencies = np.asarray(frequencies, dtype=float)
+    h = np.asarray(h, dtype=complex)
+
+    # normalized frequency keeps the columns of the least squares similar
+    w0 = 2*np.pi*frequencies.max()
+    s = 1j*2*np.pi*frequencies/w0
+    if opts["weight"] == "relative":
+        weights = 1/np.maximum(np.abs(h), 1e-12*np.abs(h).max())
+    else:
+        weights = np.ones(h.shape)
+
+    poles = order_poles(initial_poles(frequencies, opts["poles"],
+        opts["pole_kind"])/w0)
+    for iteration in range(opts["iterations"]):
+        poles = relocate_poles(s, h, poles, weights)
+    residues, d, e = fit_residues(s, h, poles, weights)
+    return poles*w0, residues*w0, d, e/w0
+
+
+# ============= impedance models ===============
+
+# fit impedance matrices z [..., samples, ports, ports], the leading axes
+# being sweep variants; returns the model as a dict with arrays shaped
+# [..., ports, ports(, poles)] and the largest relative error of the samples
+def fit_impedance(frequencies, z, options=None):
+    opts = dict(default_options)
+    if options:
+        opts.update(options)
+    z = np.asarray(z, dtype=complex)
+    variants = z.shape[:-3]
+    samples, ports = z.shape[-3], z.shape[-1]
+    # all responses as columns: [samples, variants*ports*ports]
+    h = np.moveaxis(z, -3, 0).reshape(samples, -1)
+    poles, residues, d, e = vector_fit(frequencies, h, opts)
+
+    shape = variants + (ports, ports)
+    model = {
+        "poles":poles,
+        "residues":residues.reshape(shape + (len(poles),)),
+        "d":d.reshape(shape),
+        "e":e.reshape(shape)
+    }
+    if opts["passive"]:
+        enforce_passivity(model, frequencies)
+    model["error"] = float(np.max(np.abs(impedance(model, frequencies) - z)
+        /np.max(np.abs(z), axis=(-2, -1), keepdims=True)))
+    return model
+
+# model impedance [..., frequencies, ports, ports]
+def impedance(model, frequencies):
+    s = 1j*2*np.pi*np.asarray(frequencies)
+    shape = model["d"].shape
+    h = evaluate(s, model["poles"], model["residues"].reshape(-1, len(model["poles"])),
+        model["d"].ravel(), model["e"].ravel())
+    return np.moveaxis(h.reshape((len(s),) + shape), 0, -3)
+
+# add the smallest resistance to d for which the symmetric part of Re(Z) is
+# positive semidefinite on a dense grid from DC to far above the samples
+def enforce_passivity(model, frequencies):
+    f_max = np.max(frequencies)
+    grid = np.concatenate([[0], np.logspace(np.log10(f_max) - 6,
+        np.log10(f_max) + 3, 400)])
+    r = impedance(model, grid).real
+    r = (r + np.swapaxes(r, -1, -2))/2
+    worst = np.min(np.linalg.eigvalsh(r), axis=(-2, -1))
+    # at infinity Re(Z) is d
+    d_sym = (model["d"] + np.swapaxes(model["d"], -1, -2))/2
+    worst = np.minimum(worst, np.min(np.linalg.eigvalsh(d_sym), axis=-1))
+    shift = np.maximum(-worst, 0)
+    ports = model["d"].shape[-1]
+    model["d"] = model["d"] + shift[..., None, None]*np.eye(ports)
+    model["passivity_shift"] = shift
+    return model
+
+
+# ============= SPICE synthesis ===============
+
+def value(x):
+    return '%.6e' % x
+
+# Foster network of one impedance d + s e + sum r/(s-p) between node_in and
+# node_out, element names start with prefix; terms contributing less than
+# prune times the largest term are left out; returns the netlist lines
+def one_port(poles, residues, d, e, prefix, node_in, node_out, prune=1e-9):
+    series = d.real
+    branches = []
+    # s e at the fastest pole counts as the size of the e term
+    e_size = abs(e)*np.max(np.abs(poles), initial=0)
+    largest = max([abs(d), e_size] + list(np.abs(residues/poles)))
+    k = 0
+    while k < len(poles):
+        p = poles[k]
+        r = residues[k]
+        if abs(r/p) < prune*largest:
+            k += 1 if p.imag == 0 else 2
+        elif p.imag == 0:
+            p = p.real
+            r = r.real
+            if r < 0:
+                # R || L minus R: skin effect ladder step
+                resistance = r/p
+                branches.append([("R", resistance), ("L", resistance/-p)])
+                series -= resistance
+            else:
+                # R || C
+                branches.append([("R", r/-p), ("C", 1/r)])
+            k += 1
+        else:
+            # (b1 s + b0)/(s^2 + a1 s + a0) as G || C || (R + L)
+            b1 = 2*r.real
+            b0 = -2*(r*p.conj()).real
+            a1 = -2*p.real
+            a0 = abs(p)**2
+            c = 1/b1
+            g = c*(a1 - b0/b1)
+            l = 1/(a0*c - g*b0/b1)
+            branches.append([("R", 1/g if g != 0 else None), ("C", c),
+                ("RL", (l*b0/b1, l))])
+            k += 2
+
+    lines = []
+    nodes = [node_in]
+    chain = []
+    if series != 0:
+        chain.append([("R", series)])
+    if e_size >= prune*largest and e != 0:
+        chain.append([("L", e.real)])
+    chain += branches
+    for n in range(len(chain)):
+        a = nodes[-1]
+        b = node_out if n == len(chain) - 1 else prefix + "n" + str(n+1)
+        nodes.append(b)
+        for kind, x in chain[n]:
+            name = prefix + kind.lower() + str(n)
+            if kind == "RL":
+                lines.append("R" + name + " " + a + " " + name + "_m " + value(x[0]))
+                lines.append("L" + name + " " + name + "_m " + b + " " + value(x[1]))
+            elif x is not None:
+                lines.append(kind + name + " " + a + " " + b + " " + value(x))
+    if not chain:
+        lines.append("R" + prefix + "short " + node_in + " " + node_out + " 0")
+    return lines
+
+# subcircuit of one variant of a fitted model; a 1 port model is a two
+# terminal network, a 2 port model a T network with the reference node "ref"
+def spice_subcircuit(model, name=None, variant=()):
+    name = name or default_options["name"]
+    poles = model["poles"]
+    residues = model["residues"][variant]
+    d = model["d"][variant]
+    e = model["e"][variant]
+    ports = d.shape[-1]
+    lines = ["* broadband model, " + str(len(poles)) + " poles, vector fitted"]
+    if "error" in model:
+        lines[0] += ", max relative error " + ('%.2g' % model["error"])
+    if ports == 1:
+        lines.append(".subckt " + name + " p1 m1")
+        lines += one_port(poles, residues[0, 0], d[0, 0], e[0, 0], "1", "p1", "m1")
+    elif ports == 2:
+        lines.append(".subckt " + name + " p1 p2 ref")
+        lines += one_port(poles, residues[0, 0] - residues[0, 1],
+            d[0, 0] - d[0, 1], e[0, 0] - e[0, 1], "a", "p1", "t")
+        lines += one_port(poles, residues[1, 1] - residues[0, 1],
+            d[1, 1] - d[0, 1], e[1, 1] - e[0, 1], "b", "p2", "t")
+        lines += one_port(poles, residues[0, 1], d[0, 1], e[0, 1], "c", "t", "ref")
+    else:
+        raise ValueError("only 1 and 2 port models can be written, got "
+        + str(ports) + " ports")
+    lines.append(".ends " + name)
+    return "\n".join(lines) + "\n"
+
+
+# ============= layout to subcircuit ===============
+
+# sweep a layout adaptively with FastHenry2, fit it and write the
+# subcircuit; returns the sweep, the model and the netlist text
+def model_from_layout(library_or_path, options=None, sweep_options=None):
+    import freq_sweep
+    opts = dict(default_options)
+    if options:
+        opts.update(options)
+    sweep = freq_sweep.sweep_fasthenry(library_or_path, sweep_options)
+    model = fit_impedance(sweep["frequencies"], sweep["z"], opts)
+    netlist = spice_subcircuit(model, opts["name"])
+    output_name = None
+    if isinstance(library_or_path, (str, Path)):
+        output_name = Path(library_or_path).stem + "_out_model.sp"
+        with open(output_name, 'w') as f:
+            f.write(netlist)
+    return {"sweep":sweep, "model":model, "netlist":netlist,
+        "output_name":output_name}
+
+
+# ============= main ===============
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2:
+        options = {}
+        if len(sys.argv) >= 3:
+            options["poles"] = int(sys.argv[2])
+        result = model_from_layout(sys.argv[1], options)
+        print(result["netlist"])
+    else:
+        print ("Usage: vector_fit.py [gds_file] [poles]")
+
+
+# References:
+# [1]   B. Gustavsen and A. Semlyen, "Rational approximation of frequency domain responses by vector fitting", IEEE Trans. Power Delivery 14(3), 1999.
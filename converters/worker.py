@@ -0,0 +1,211 @@
+# Copyright 2023 J.N.G.W. Verest
+# j.n.g.w.verest@tue.nl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Persistent conversion worker for gds2FastHenry and gds2FasterCap
+# Keeps one warm Python process with numpy, gdspy and the stack tables loaded
+# and accepts conversion jobs as JSON lines, either on stdin or on a local
+# unix socket. Every job gets exactly one JSON line as reply.
+
+# CAVEATS:
+#   Jobs are handled one at a time, in order of arrival.
+#   A job looks like
+#     {"id":1, "converter":"fasthenry", "input":"ind.gds", "options":{}}
+#   where converter is "fasthenry", "fastercap" or "both", and options are
+#   passed on to convert_fasthenry/convert_fastercap, or convert_fastmodel
+#   for "both". Set "return_deck" to true to get the deck text in the reply,
+#   and "incremental" to true to regenerate only the deck sections that
+#   changed since the previous incremental job (see incremental.py).
+#   The replies look like
+#     {"id":1, "ok":true, "time":0.004, "output_name":{"fasthenry":...}}
+#   {"command":"ping"} and {"command":"shutdown"} are also understood.
+#
+#   Usage:
+#     python worker.py                    jobs on stdin, replies on stdout
+#     python worker.py --socket [path]    jobs on a unix socket
+
+# File history:
+# Initial version
+
+
+import sys
+import json
+import time
+import argparse
+import threading
+import contextlib
+import socketserver
+from pathlib import Path
+
+import gds2fasthenry
+import gds2fastercap
+import gds2fastmodel
+import incremental
+
+
+
+socket_default = "/tmp/gds2fastmodel.sock"
+
+converter_functions = {
+"fasthenry":gds2fasthenry.convert_fasthenry,
+"fastercap":gds2fastercap.convert_fastercap
+}
+
+# the worker is quiet unless a job asks otherwise
+worker_options = {
+"verbose":False
+}
+
+# remembers the deck sections of the previous incremental job
+engine = incremental.IncrementalConverter()
+
+# run a single decoded job object, errors are reported in the reply
+def handle_job(job):
+    reply = {"id":job.get("id")}
+    command = job.get("command")
+    if command == "ping":
+        reply["ok"] = True
+        return reply
+    if command == "shutdown":
+        reply["ok"] = True
+        reply["shutdown"] = True
+        return reply
+
+    converter = job.get("converter", "both")
+    if converter == "both":
+        selected = list(converter_functions)
+    elif converter in converter_functions:
+        selected = [converter]
+    else:
+        reply["ok"] = False
+        reply["error"] = "unknown converter " + str(converter)
+        return reply
+
+    t_start = time.perf_counter()
+    reply["output_name"] = {}
+    try:
+        options = dict(worker_options)
+        options.update(job.get("options", {}))
+        # progress output must not end up in the reply stream
+        with contextlib.redirect_stdout(sys.stderr):
+            if job.get("incremental"):
+                # only the sections changed since the previous job
+                options["solvers"] = selected
+                result = engine.convert(job["input"], options)
+                reply["stats"] = result["stats"]
+            elif converter == "both":
+                # one pass, both decks from the same geometry model
+                result = gds2fastmodel.convert_fastmodel(job["input"], options)
+            else:
+                result = {converter:converter_functions[converter](job["input"], options)}
+            for name in selected:
+                reply["output_name"][name] = result[name]["output_name"]
+                if job.get("return_deck"):
+                    reply.setdefault("deck", {})[name] = result[name]["deck"]
+        reply["ok"] = True
+    except Exception as e:
+        reply["ok"] = False
+        reply["error"] = type(e).__name__ + ": " + str(e)
+        if hasattr(e, "diagnostics"):
+            reply["diagnostics"] = e.diagnostics
+    reply["time"] = time.perf_counter() - t_start
+    return reply
+
+# decode one line, run it and encode the reply; returns the reply and its
+# encoded line, never raises, so a bad job cannot stop the worker
+def handle_line(line):
+    try:
+        job = json.loads(line)
+    except ValueError as e:
+        reply = {"id":None, "ok":False, "error":"invalid job: " + str(e)}
+    else:
+        if isinstance(job, dict):
+            reply = handle_job(job)
+        else:
+            reply = {"id":None, "ok":False, "error":"job must be an object"}
+    try:
+        return reply, json.dumps(reply) + "\n"
+    except (TypeError, ValueError) as e:
+        # the id came from a decoded job, so it always encodes
+        reply = {"id":reply.get("id"), "ok":False,
+            "error":"reply cannot be encoded: " + str(e)}
+        return reply, json.dumps(reply) + "\n"
+
+
+# ============= stdin mode ===============
+
+def serve_stdin(stdin=sys.stdin, stdout=sys.stdout):
+    for line in stdin:
+        if not line.strip():
+            continue
+        reply, text = handle_line(line)
+        stdout.write(text)
+        stdout.flush()
+        if reply.get("shutdown"):
+            break
+
+
+# ============= socket mode ===============
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            reply, text = handle_line(line.decode("utf-8", "replace"))
+            self.wfile.write(text.encode())
+            self.wfile.flush()
+            if reply.get("shutdown"):
+                # shutdown() blocks until serve_forever returns, which
+                # would never happen when called from the serving thread
+                threading.Thread(target=self.server.shutdown).start()
+                break
+
+def serve_socket(socket_path=socket_default):
+    socket_path = Path(socket_path)
+    if socket_path.exists():
+        socket_path.unlink()
+    with socketserver.UnixStreamServer(str(socket_path), JobHandler) as server:
+        print("Worker listening on " + str(socket_path), file=sys.stderr)
+        try:
+            server.serve_forever(poll_interval=0.1)
+        finally:
+            socket_path.unlink()
+
+# submit jobs to a running socket worker, returns the replies in order
+def submit(jobs, socket_path=socket_default):
+    import socket
+    replies = []
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(socket_path))
+        stream = sock.makefile("rwb")
+        for job in jobs:
+            stream.write((json.dumps(job) + "\n").encode())
+            stream.flush()
+            replies.append(json.loads(stream.readline()))
+    return replies
+
+
+# ============= main ===============
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Warm GDS conversion worker")
+    parser.add_argument("--socket", nargs="?", const=socket_default,
+        help="listen on a unix socket instead of stdin")
+    args = parser.parse_args()
+
+    if args.socket:
+        serve_socket(args.socket)
+    else:
+        serve_stdin()